@@ -0,0 +1,114 @@
+"""Benchmarks bitbucklet commands against the local stand-in server.
+
+    python benchmarks/bench.py [--scales 100,1000,10000] [--only accesses-list-all] [--latency 20] [--json results.json]
+
+For every scale, a team of that many members and repositories is served by
+`mock_bitbucket.MockBitbucket`, and every scenario runs as a fresh `bitbucklet`
+process with empty caches, as in the scripts calling it. Reports the median
+wall-clock time of `--runs` runs and the number of requests the server got.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+from mock_bitbucket import MockBitbucket
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_SCALES = (100, 1000, 10000)
+
+
+class Scenario(NamedTuple):
+    name: str
+    # Builds the arguments of `bitbucklet` given the scale and a scratch directory.
+    args: Callable[[int, str], List[str]]
+
+
+def __grants_manifest(scale: int, directory: str) -> str:
+    path = os.path.join(directory, 'grants.csv')
+    with open(path, 'w') as f:
+        f.write('principal,repo,access\n')
+        for j in range(scale):
+            f.write(f"group:admins,repo-{j},write\n")
+    return path
+
+
+# Rate limits are lifted: the server decides when to answer 429 (`--rate-limit`).
+BULK = ['--concurrency', '16', '--rate', '100000', '--burst', '100']
+
+SCENARIOS = [
+    Scenario('users-list', lambda scale, directory: ['users', 'list']),
+    Scenario('groups-list-users', lambda scale, directory: ['groups', 'list-users', 'developers']),
+    Scenario('repos-list', lambda scale, directory: ['repos', 'list', '--fields', 'slug,project.key,updated_on']),
+    Scenario('repos-list-in-project', lambda scale, directory: ['repos', 'list-in-project', 'P0']),
+    Scenario('accesses-who-can', lambda scale, directory: ['accesses', 'who-can', 'repo-0']),
+    Scenario('accesses-list-all', lambda scale, directory: ['accesses', 'list-all', '--format', 'ndjson'] + BULK),
+    Scenario('repos-apply', lambda scale, directory: ['repos', 'apply', __grants_manifest(scale, directory)] + BULK),
+]
+
+
+def run(server: MockBitbucket, args: List[str], directory: str) -> float:
+    env = dict(os.environ, **server.environment(),
+        HOME=directory,
+        # Cold caches: the token and the team UUID are fetched by every run.
+        BITBUCKLET_CACHE_DIR=tempfile.mkdtemp(dir=directory),
+        BITBUCKLET_DAEMON='0',
+        PYTHONPATH=ROOT)
+    env.pop('BITBUCKLET_CONFIG_FILE', None)
+
+    started_at = time.perf_counter()
+    completed = subprocess.run([sys.executable, '-m', 'bitbucklet.cli'] + args,
+        cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - started_at
+    if completed.returncode != 0:
+        raise RuntimeError(f"bitbucklet {' '.join(args)} failed:\n{completed.stderr}")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', default=','.join(map(str, DEFAULT_SCALES)), help='Numbers of members and repositories')
+    parser.add_argument('--only', action='append', choices=[scenario.name for scenario in SCENARIOS], help='Only run this scenario. Can be repeated.')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=20, help='Latency of the server, in ms')
+    parser.add_argument('--jitter', type=float, default=10, help='Random latency added on top, up to this many ms')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Requests per second before the server answers 429. 0 for none')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of the requests failing with 503')
+    parser.add_argument('--json', dest='json_path', help='Also write the results into this file')
+    options = parser.parse_args()
+
+    scenarios = [scenario for scenario in SCENARIOS if not options.only or scenario.name in options.only]
+    results: List[Dict] = []
+
+    print(f"{'scenario':<24} {'scale':>6} {'median s':>9} {'min s':>7} {'requests':>9}")
+    for scale in (int(scale) for scale in options.scales.split(',')):
+        for scenario in scenarios:
+            server = MockBitbucket(members=scale, repos=scale, latency=options.latency / 1000,
+                jitter=options.jitter / 1000, rate_limit=options.rate_limit, failure_rate=options.failure_rate)
+            with server, tempfile.TemporaryDirectory() as directory:
+                timings = [run(server, scenario.args(scale, directory), directory) for _ in range(options.runs)]
+                requests = sum(server.stats.values()) // options.runs
+
+            result = {
+                'scenario': scenario.name,
+                'scale': scale,
+                'median': statistics.median(timings),
+                'min': min(timings),
+                'requests': requests,
+            }
+            results.append(result)
+            print(f"{scenario.name:<24} {scale:>6} {result['median']:>9.2f} {result['min']:>7.2f} {requests:>9}", flush=True)
+
+    if options.json_path:
+        with open(options.json_path, 'w') as f:
+            json.dump({'options': vars(options), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
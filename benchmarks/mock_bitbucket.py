@@ -0,0 +1,500 @@
+"""A local stand-in for the BitBucket Cloud endpoints used by bitbucklet.
+
+    python benchmarks/mock_bitbucket.py --members 1000 --repos 1000 [--latency 20] [--rate-limit 50] [--failure-rate 0.01]
+
+then point bitbucklet to it with the environment variables it prints.
+
+It serves the OAuth token, the team, paged members and repositories (v2),
+groups and their members, team privileges, invitations (v1), and the internal
+privileges and access summary endpoints, from a synthetic team:
+
+- member `i` is `user{i}`, in `developers`, in `team-{i % teams}` and, for
+  every 50th member, in `admins`;
+- repository `j` is `repo-{j}`, named `Repo {j}`, in project `P{j % 10}`;
+  `developers` can read every 10th repository, `team-{j % teams}` can write
+  it, and every 10th repository grants admin to the member `j`.
+
+Writes (group members, privileges, groups) change the team in memory. GET
+responses carry an ETag, and are answered 304 when it still matches.
+Latency, rate limiting (429 with `Retry-After`) and failures (503) can be
+injected to reproduce the behaviour of the real API.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Set
+from urllib.parse import parse_qs, unquote, urlencode, urlsplit
+
+TEAM = 'bench'
+TEAM_UUID = '{00000000-0000-4000-8000-000000000000}'
+MAX_PAGELEN = 100
+
+
+class Team:
+    """The synthetic team, and its changes."""
+
+    def __init__(self, members: int, repos: int):
+        self.lock = threading.Lock()
+        teams = max(1, members // 100)
+        # The access tokens issued, the only ones accepted.
+        self.tokens: Set[str] = set()
+
+        self.members = [{
+            'display_name': f"User {i}",
+            'account_id': f"5570:{i:08d}",
+            'uuid': f"{{00000000-0000-4000-8000-{i:012d}}}",
+            'nickname': f"user{i}",
+            'username': f"user{i}",
+            'type': 'user',
+        } for i in range(members)]
+        for member in self.members:
+            member['resource_uri'] = f"/1.0/users/{member['username']}"
+        self.members_by_id = {}
+        for member in self.members:
+            for key in ('account_id', 'uuid', 'username'):
+                self.members_by_id[member[key]] = member
+
+        self.groups: Dict[str, str] = {'developers': 'Developers', 'admins': 'Admins'}
+        self.groups.update({f"team-{k}": f"Team {k}" for k in range(teams)})
+        # slug -> account ids
+        self.group_members: Dict[str, Set[str]] = {slug: set() for slug in self.groups}
+        for i, member in enumerate(self.members):
+            self.group_members['developers'].add(member['account_id'])
+            self.group_members[f"team-{i % teams}"].add(member['account_id'])
+            if i % 50 == 0:
+                self.group_members['admins'].add(member['account_id'])
+
+        self.repos = [{
+            'type': 'repository',
+            'uuid': f"{{10000000-0000-4000-8000-{j:012d}}}",
+            'slug': f"repo-{j}",
+            'name': f"Repo {j}",
+            'full_name': f"{TEAM}/repo-{j}",
+            'is_private': True,
+            'project': {'key': f"P{j % 10}", 'name': f"Project {j % 10}"},
+            'updated_on': '2020-01-01T00:00:00+00:00',
+        } for j in range(repos)]
+        self.repos_by_slug = {repo['slug']: repo for repo in self.repos}
+        self.projects = [{
+            'type': 'project',
+            'key': f"P{k}",
+            'name': f"Project {k}",
+        } for k in range(min(repos, 10))]
+
+        # (repo slug, group slug) -> access
+        self.group_privileges: Dict[tuple, str] = {}
+        # (repo slug, account id) -> access
+        self.user_privileges: Dict[tuple, str] = {}
+        for j, repo in enumerate(self.repos):
+            if j % 10 == 0:
+                self.group_privileges[(repo['slug'], 'developers')] = 'read'
+                if self.members:
+                    self.user_privileges[(repo['slug'], self.members[j % members]['account_id'])] = 'admin'
+            self.group_privileges[(repo['slug'], f"team-{j % teams}")] = 'write'
+
+    def member(self, identifier: str) -> Optional[dict]:
+        return self.members_by_id.get(identifier)
+
+    def group(self, slug: str) -> dict:
+        return {
+            'name': self.groups[slug],
+            'slug': slug,
+            'permission': None,
+            'owner': {'username': TEAM},
+            'members': [self.members_by_id[account_id] for account_id in sorted(self.group_members[slug])],
+        }
+
+    def access_summary(self, member: dict) -> dict:
+        groups = sorted(slug for slug, members in self.group_members.items() if member['account_id'] in members)
+        repos = {repo for (repo, slug) in self.group_privileges if slug in groups}
+        repos |= {repo for (repo, account_id) in self.user_privileges if account_id == member['account_id']}
+        return {
+            'user': {key: member[key] for key in ('display_name', 'account_id', 'uuid', 'nickname')},
+            'repos': [{'name': self.repos_by_slug[repo]['name'], 'slug': repo} for repo in sorted(repos)],
+            'groups': [{'slug': slug, 'name': self.groups[slug]} for slug in groups],
+        }
+
+
+class Faults:
+    """Latency, rate limiting and failures injected into every response but the token's."""
+
+    def __init__(self, latency: float = 0, jitter: float = 0, rate_limit: float = 0, failure_rate: float = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.failure_rate = failure_rate
+        self._lock = threading.Lock()
+        self._window_started_at = time.monotonic()
+        self._window_count = 0
+
+    def delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def is_rate_limited(self) -> bool:
+        """A fixed window of one second, like the hourly windows of BitBucket but shorter."""
+        if not self.rate_limit:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_started_at >= 1:
+                self._window_started_at, self._window_count = now, 0
+            self._window_count += 1
+            return self._window_count > self.rate_limit
+
+    def is_failing(self) -> bool:
+        return self.failure_rate > 0 and random.random() < self.failure_rate
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Set by `MockBitbucket`.
+    team: Team = None
+    faults: Faults = None
+    stats: Dict[str, int] = None
+
+    ROUTES = [
+        ('POST', r'/site/oauth2/access_token', 'token'),
+        ('GET', r'/2\.0/teams/(?P<team>[^/]+)', 'get_team'),
+        ('GET', r'/2\.0/teams/(?P<team>[^/]+)/members', 'get_members'),
+        ('GET', r'/2\.0/repositories/(?P<team>[^/]+)', 'get_repositories'),
+        ('GET', r'/2\.0/workspaces/(?P<team>[^/]+)/projects', 'get_projects'),
+        ('GET', r'/1\.0/groups/(?P<team>[^/]+)', 'get_groups'),
+        ('POST', r'/1\.0/groups/(?P<team>[^/]+)', 'post_group'),
+        ('DELETE', r'/1\.0/groups/(?P<team>[^/]+)/(?P<group>[^/]+)', 'delete_group'),
+        ('GET', r'/1\.0/groups/(?P<team>[^/]+)/(?P<group>[^/]+)/members', 'get_group_members'),
+        ('PUT', r'/1\.0/groups/(?P<team>[^/]+)/(?P<group>[^/]+)/members/(?P<user>[^/]+)', 'put_group_member'),
+        ('DELETE', r'/1\.0/groups/(?P<team>[^/]+)/(?P<group>[^/]+)/members/(?P<user>[^/]+)', 'delete_group_member'),
+        ('GET', r'/1\.0/group-privileges/(?P<team>[^/]+)', 'get_group_privileges'),
+        ('GET', r'/1\.0/group-privileges/(?P<team>[^/]+)/(?P<repo>[^/]+)', 'get_group_privileges'),
+        ('GET', r'/1\.0/privileges/(?P<team>[^/]+)', 'get_user_privileges'),
+        ('GET', r'/1\.0/users/(?P<team>[^/]+)/invitations', 'get_invitations'),
+        ('PUT', r'/1\.0/users/(?P<team>[^/]+)/invitations', 'put_invitation'),
+        ('PUT', r'/!api/1\.0/group-privileges/(?P<team>[^/]+)/(?P<repo>[^/]+)/(?P<team_id>[^/]+)/(?P<group>[^/]+)/?', 'put_group_privilege'),
+        ('DELETE', r'/!api/1\.0/group-privileges/(?P<team>[^/]+)/(?P<repo>[^/]+)/(?P<team_id>[^/]+)/(?P<group>[^/]+)/?', 'delete_group_privilege'),
+        ('PUT', r'/!api/internal/privileges/(?P<team>[^/]+)/(?P<repo>[^/]+)/(?P<user>[^/]+)/?', 'put_user_privilege'),
+        ('DELETE', r'/!api/internal/privileges/(?P<team>[^/]+)/(?P<repo>[^/]+)/(?P<user>[^/]+)/?', 'delete_user_privilege'),
+        ('GET', r'/!api/internal/user/(?P<team_id>[^/]+)/access/(?P<user>[^/]+)', 'get_access_summary'),
+    ]
+
+    def do_GET(self):
+        self.__dispatch('GET')
+
+    def do_POST(self):
+        self.__dispatch('POST')
+
+    def do_PUT(self):
+        self.__dispatch('PUT')
+
+    def do_DELETE(self):
+        self.__dispatch('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+    def __dispatch(self, method: str):
+        parts = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else b''
+
+        for route_method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, unquote(parts.path))
+            if match and route_method == method:
+                break
+        else:
+            return self.__reply(404, {'error': {'message': f"No route for {method} {parts.path}"}})
+
+        with self.team.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+        if name != 'token':
+            authorization = self.headers.get('Authorization') or ''
+            if 'cloud.session.token' not in (self.headers.get('Cookie') or '') and not authorization:
+                return self.__reply(401, {'error': {'message': 'Unauthorized'}})
+            if authorization.startswith('Bearer ') and authorization[len('Bearer '):] not in self.team.tokens:
+                return self.__reply(401, {'error': {'message': 'Access token expired or revoked'}})
+            self.faults.delay()
+            if self.faults.is_rate_limited():
+                return self.__reply(429, {'error': {'message': 'Rate limit for this resource has been exceeded'}}, {'Retry-After': '1'})
+            if self.faults.is_failing():
+                return self.__reply(503, {'error': {'message': 'Injected failure'}})
+
+        getattr(self, name)(**match.groupdict())
+
+    def __reply(self, status: int, body=None, headers: dict = None):
+        payload = b'' if body is None else json.dumps(body).encode()
+        if self.command == 'GET' and status == 200:
+            etag = f'"{hashlib.sha1(payload).hexdigest()[:16]}"'
+            headers = dict(headers or {}, ETag=etag)
+            if self.headers.get('If-None-Match') == etag:
+                status, payload = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def __page(self, values: List[dict]):
+        pagelen = min(int(self.query.get('pagelen', 10)), MAX_PAGELEN)
+        page = int(self.query.get('page', 1))
+        start = (page - 1) * pagelen
+        body = {
+            'pagelen': pagelen,
+            'size': len(values),
+            'page': page,
+            'values': self.__partial(values[start:start + pagelen]),
+        }
+        if start + pagelen < len(values):
+            query = dict(self.query, page=page + 1, pagelen=pagelen)
+            body['next'] = f"http://{self.headers['Host']}{urlsplit(self.path).path}?{urlencode(query)}"
+        self.__reply(200, body)
+
+    def __partial(self, values: List[dict]) -> List[dict]:
+        # Only the `values.*` paths of `fields` are honoured.
+        paths = [field[len('values.'):].split('.') for field in self.query.get('fields', '').split(',') if field.startswith('values.')]
+        if not paths:
+            return values
+
+        partial = []
+        for value in values:
+            kept = {}
+            for path in paths:
+                source, target = value, kept
+                for key in path[:-1]:
+                    if not isinstance(source.get(key), dict):
+                        break
+                    source, target = source[key], target.setdefault(key, {})
+                else:
+                    if path[-1] in source:
+                        target[path[-1]] = source[path[-1]]
+            partial.append(kept)
+        return partial
+
+    # Endpoints
+
+    def token(self):
+        token = f"mock-{time.time()}"
+        with self.team.lock:
+            self.team.tokens.add(token)
+        self.__reply(200, {
+            'access_token': token,
+            'refresh_token': 'mock-refresh',
+            'expires_in': 7200,
+            'token_type': 'bearer',
+            'scopes': 'repository:admin team:write account:write project:write',
+        })
+
+    def get_team(self, team):
+        self.__reply(200, {'uuid': TEAM_UUID, 'username': team, 'type': 'team'})
+
+    def get_members(self, team):
+        self.__page(self.team.members)
+
+    def get_repositories(self, team):
+        repos = self.team.repos
+        q = self.query.get('q', '')
+        project = re.search(r'project\.key="([^"]+)"', q)
+        if project:
+            repos = [repo for repo in repos if repo['project']['key'] == project.group(1)]
+        updated = re.search(r'updated_on > (\S+)', q)
+        if updated:
+            repos = [repo for repo in repos if repo['updated_on'] > updated.group(1)]
+        self.__page(repos)
+
+    def get_projects(self, team):
+        self.__page(self.team.projects)
+
+    def get_groups(self, team):
+        with self.team.lock:
+            groups = [self.team.group(slug) for slug in sorted(self.team.groups)]
+        self.__reply(200, groups)
+
+    def post_group(self, team):
+        name = parse_qs(self.body.decode()).get('name', [''])[-1]
+        slug = re.sub(r'[^a-z0-9-]', '-', name.lower())
+        with self.team.lock:
+            if slug in self.team.groups:
+                return self.__reply(400, {'error': {'message': f"Group {slug} already exists"}})
+            self.team.groups[slug] = name
+            self.team.group_members[slug] = set()
+            group = self.team.group(slug)
+        self.__reply(200, group)
+
+    def delete_group(self, team, group):
+        with self.team.lock:
+            if self.team.groups.pop(group, None) is None:
+                return self.__reply(404, {'error': {'message': f"No group {group}"}})
+            del self.team.group_members[group]
+        self.__reply(204)
+
+    def get_group_members(self, team, group):
+        with self.team.lock:
+            if group not in self.team.groups:
+                return self.__reply(404, {'error': {'message': f"No group {group}"}})
+            members = self.team.group(group)['members']
+        self.__reply(200, members)
+
+    def put_group_member(self, team, group, user):
+        member = self.team.member(user)
+        with self.team.lock:
+            if group not in self.team.groups or member is None:
+                return self.__reply(404, {'error': {'message': f"No group {group} or user {user}"}})
+            if member['account_id'] in self.team.group_members[group]:
+                return self.__reply(409, {'error': {'message': f"{user} is already in {group}"}})
+            self.team.group_members[group].add(member['account_id'])
+        self.__reply(200, member)
+
+    def delete_group_member(self, team, group, user):
+        member = self.team.member(user)
+        with self.team.lock:
+            if group not in self.team.groups or member is None or member['account_id'] not in self.team.group_members[group]:
+                return self.__reply(404, {'error': {'message': f"{user} is not in {group}"}})
+            self.team.group_members[group].discard(member['account_id'])
+        self.__reply(204)
+
+    def get_group_privileges(self, team, repo=None):
+        with self.team.lock:
+            privileges = [{
+                'repo': f"{team}/{repo_slug}",
+                'privilege': access,
+                'group': {key: value for key, value in self.team.group(slug).items() if key != 'members'},
+            } for (repo_slug, slug), access in sorted(self.team.group_privileges.items()) if repo in (None, repo_slug)]
+        self.__reply(200, privileges)
+
+    def get_user_privileges(self, team):
+        with self.team.lock:
+            privileges = [{
+                'repo': f"{team}/{repo_slug}",
+                'privilege': access,
+                'user': self.team.members_by_id[account_id],
+            } for (repo_slug, account_id), access in sorted(self.team.user_privileges.items())]
+        self.__reply(200, privileges)
+
+    def get_invitations(self, team):
+        self.__reply(200, [])
+
+    def put_invitation(self, team):
+        self.__reply(200, json.loads(self.body or b'{}'))
+
+    def put_group_privilege(self, team, repo, team_id, group):
+        with self.team.lock:
+            if group not in self.team.groups:
+                return self.__reply(404, {'error': {'message': f"No group {group}"}})
+            self.team.group_privileges[(repo, group)] = self.body.decode()
+        self.__reply(200, [{'repo': f"{team}/{repo}", 'privilege': self.body.decode(), 'group': {'slug': group}}])
+
+    def delete_group_privilege(self, team, repo, team_id, group):
+        with self.team.lock:
+            self.team.group_privileges.pop((repo, group), None)
+        self.__reply(204)
+
+    def put_user_privilege(self, team, repo, user):
+        member = self.team.member(user)
+        if member is None:
+            return self.__reply(404, {'error': {'message': f"No user {user}"}})
+        with self.team.lock:
+            self.team.user_privileges[(repo, member['account_id'])] = self.body.decode()
+        self.__reply(200, {'repo': f"{team}/{repo}", 'privilege': self.body.decode()})
+
+    def delete_user_privilege(self, team, repo, user):
+        member = self.team.member(user)
+        with self.team.lock:
+            if member is not None:
+                self.team.user_privileges.pop((repo, member['account_id']), None)
+        self.__reply(204)
+
+    def get_access_summary(self, team_id, user):
+        member = self.team.member(user)
+        if team_id != TEAM_UUID or member is None:
+            return self.__reply(404, {'error': {'message': f"No user {user}"}})
+        with self.team.lock:
+            summary = self.team.access_summary(member)
+        self.__reply(200, summary)
+
+
+class MockBitbucket:
+    """Runs the stand-in server in a background thread:
+
+        with MockBitbucket(members=1000, repos=1000, latency=0.02) as server:
+            env = server.environment()
+    """
+
+    def __init__(self, members: int = 100, repos: int = 100, port: int = 0, latency: float = 0,
+                 jitter: float = 0, rate_limit: float = 0, failure_rate: float = 0):
+        handler = type('BoundHandler', (Handler,), {
+            'team': Team(members, repos),
+            'faults': Faults(latency, jitter, rate_limit, failure_rate),
+            'stats': {},
+        })
+        self.handler = handler
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name='mock-bitbucket', daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Number of requests per endpoint."""
+        return dict(self.handler.stats)
+
+    def environment(self) -> Dict[str, str]:
+        """The environment variables making bitbucklet use this server."""
+        return {
+            'BITBUCKLET_API_URL': self.url,
+            'BITBUCKLET_WEB_URL': self.url,
+            'BITBUCKET_TEAM': TEAM,
+            'BITBUCKET_CLIENT_ID': 'mock',
+            'BITBUCKET_CLIENT_SECRET': 'mock',
+            'BITBUCKET_CLOUD_SESSION': 'mock',
+        }
+
+    def start(self) -> 'MockBitbucket':
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'MockBitbucket':
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--repos', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='Latency added to every response, in ms')
+    parser.add_argument('--jitter', type=float, default=0, help='Random latency added on top, up to this many ms')
+    parser.add_argument('--rate-limit', type=float, default=0, help='Requests per second before answering 429. 0 for none')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Fraction of the requests failing with 503')
+    options = parser.parse_args()
+
+    server = MockBitbucket(options.members, options.repos, options.port, options.latency / 1000,
+        options.jitter / 1000, options.rate_limit, options.failure_rate)
+    for key, value in server.environment().items():
+        print(f"export {key}={value}")
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
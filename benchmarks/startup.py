@@ -0,0 +1,92 @@
+"""Measures the startup time of the CLI, and fails when it exceeds a budget.
+
+    python benchmarks/startup.py [--runs 20] [--budget 0.25] [--command-budget 0.6]
+
+Every invocation runs in a fresh interpreter, as in the scripts calling
+`bitbucklet` in a loop. Besides the timings, it checks that the invocations
+which do not call the API import none of the heavy dependencies.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Median wall-clock times in seconds, interpreter startup included: of an
+# invocation not calling the API, and of one loading a command calling it.
+DEFAULT_BUDGET = 0.25
+DEFAULT_COMMAND_BUDGET = 0.6
+
+# (arguments, whether the invocation must not import HEAVY_MODULES)
+INVOCATIONS = [
+    (['--help'], True),
+    (['cfg', '--help'], True),
+    (['users', '--help'], False),
+    (['accesses', '--help'], False),
+]
+
+HEAVY_MODULES = ('requests', 'urllib3', 'tabulate', 'sqlite3')
+
+# Runs the CLI in-process and prints the heavy modules it imported.
+IMPORTS_PROBE = """
+import sys
+from bitbucklet.cli import main
+try:
+    main(sys.argv[1:], prog_name='bitbucklet')
+except SystemExit:
+    pass
+print(','.join(m for m in {heavy!r} if m in sys.modules), file=sys.stderr)
+"""
+
+
+def time_invocation(args, runs: int) -> float:
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        subprocess.run([sys.executable, '-m', 'bitbucklet.cli'] + args,
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings)
+
+
+def heavy_imports(args) -> str:
+    completed = subprocess.run([sys.executable, '-c', IMPORTS_PROBE.format(heavy=HEAVY_MODULES)] + args,
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    lines = completed.stderr.strip().splitlines()
+    return lines[-1] if lines else ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--budget', type=float, default=float(os.getenv('BITBUCKLET_STARTUP_BUDGET', DEFAULT_BUDGET)),
+        help='Maximum median time of an invocation not calling the API, in seconds')
+    parser.add_argument('--command-budget', type=float, default=float(os.getenv('BITBUCKLET_COMMAND_STARTUP_BUDGET', DEFAULT_COMMAND_BUDGET)),
+        help='Maximum median time of an invocation loading a command calling the API, in seconds')
+    options = parser.parse_args()
+
+    failures = []
+    for args, light in INVOCATIONS:
+        command = ' '.join(['bitbucklet'] + args)
+        budget = options.budget if light else options.command_budget
+
+        median = time_invocation(args, options.runs)
+        print(f"{command:<32} {median * 1000:7.1f} ms  (budget {budget * 1000:.0f} ms)")
+        if median > budget:
+            failures.append(f"{command} took {median * 1000:.1f} ms, over the budget of {budget * 1000:.0f} ms")
+
+        if light:
+            imported = heavy_imports(args)
+            if imported:
+                failures.append(f"{command} imported {imported}")
+
+    for failure in failures:
+        print(f"FAILED: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,60 +2,102 @@ import click
 import os
 import logging
 import json
-import time
-from tabulate import tabulate
-from typing import Tuple, List
-
-import requests
-from requests import HTTPError
-
-from bitbucklet.token import get_access_token, BearerAuth
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Tuple, List, Iterable, Iterator
+
+# Only what the commands need to be declared: the modules sending requests
+# (and `requests` itself) are imported by the functions which send them, so
+# that `accesses --help` or an `--offline` query does not load them.
+from bitbucklet.bulk import bulk_options
+from bitbucklet.checkpoint import Checkpoint, DEFAULT_MAX_AGE
+from bitbucklet.cli import LazyGroup
+from bitbucklet.index import PermissionIndex, LEVELS
+from bitbucklet.ratelimit import TokenBucket, send, DEFAULT_RATE, DEFAULT_BURST, DEFAULT_CONCURRENCY
+from bitbucklet.snapshot import Snapshot, snapshot_options, ACCESSES, GROUPS, PRIVILEGES
 from bitbucklet.urls import teams_url, user_accesses_url
 
-@click.group(name='accesses', help = 'Managing accesses')
+@click.group(name='accesses', cls=LazyGroup, help = 'Managing accesses', lazy_subcommands={
+    'diff': ('bitbucklet.diff:diff_cli', 'Compare two exports of the accesses of all users'),
+})
 def accesses_cli():
     pass
 
 @click.command(name='list-all', help='List all accesses of all users')
-@click.option("-f", "--format", "format", type=click.Choice(['table', 'json', 'pipe'], case_sensitive=False), help="Format the output")
-def get_all_user_accesses(format: str):
+@click.option("-f", "--format", "format", type=click.Choice(['table', 'json', 'ndjson', 'pipe', 'matrix'], case_sensitive=False), help="Format the output. All but `table` and `matrix` are printed as each user is fetched.")
+@bulk_options
+@click.option("--resume", is_flag=True, default=False, help="Skip users already fetched by a previous (interrupted) run")
+@click.option("--max-age", type=click.IntRange(min=0), default=DEFAULT_MAX_AGE, envvar='BITBUCKLET_CHECKPOINT_MAX_AGE', show_default=True, help="Seconds during which a user fetched by a previous run is reused by --resume")
+def get_all_user_accesses(format: str, concurrency: int, rate: float, burst: int, resume: bool, max_age: int):
+    FORMATTERS = {
+        'default': __tabulate_format,
+        'table': __tabulate_format,
+        'json': __json_format,
+        'ndjson': __ndjson_format,
+        'pipe': __pipe_format,
+        'matrix': lambda all_member_accesses: __matrix_format(all_member_accesses, concurrency, stdout),
+    }
+
+    stdout = None
+    if format == 'matrix':
+        if sys.stdout.isatty():
+            raise click.UsageError("The matrix format is binary: redirect it into a file.")
+        # Not `sys.stdout.buffer`, which the stand-in stdout of `bitbucklet
+        # batch` lacks. Resolved before fetching anything.
+        try:
+            stdout = click.get_binary_stream('stdout')
+        except RuntimeError:
+            raise click.UsageError("The matrix format is binary: it cannot be printed into a text output, e.g in a batch.")
+
+    formatter = FORMATTERS.get(format, FORMATTERS.get('default'))
+    with Checkpoint.for_team(max_age=max_age).open(resume=resume) as checkpoint:
+        formatter(iter_all_user_accesses(concurrency=concurrency, rate=rate, burst=burst, checkpoint=checkpoint))
+
+def iter_all_user_accesses(concurrency: int = DEFAULT_CONCURRENCY, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST, checkpoint: Checkpoint = None, members: Iterable[Tuple[str, str]] = None) -> Iterator[Tuple[str, str, List[str], List[str]]]:
+    """Yields the access summary of every member of the team, in member order,
+    as soon as it (and every summary before it) has been fetched.
+
+    Members found in `checkpoint` are not fetched again, and every fetched
+    summary is recorded into it. `members`, a list of `(display_name, account_id)`,
+    restricts the fetch to these members instead of the whole team.
+    """
+    from bitbucklet.pagination import paginate
+    from bitbucklet.teams import get_team_uuid
+    from bitbucklet.token import get_access_token, BearerAuth
+
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     bitbucket_cloud_session = os.getenv('BITBUCKET_CLOUD_SESSION')
 
-    access_token = get_access_token()
-
-    # TODO: Handle pagination
-    get_all_users_response = requests.get(
-        f"{teams_url()}/members"
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token),
-    )
-    
-    if get_all_users_response.status_code != 200:
-        raise RuntimeError(get_all_users_response.status_code)
-
-    members = [(member['display_name'], member['account_id'])
-        for member in get_all_users_response.json()['values']]
-    
-    get_team_response = requests.get(
-        teams_url()
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token)
-    )
-    
-    if get_team_response.status_code != 200:
-        logging.error(get_team_response)
-        raise RuntimeError(f"Fail to obtain team {bitbucket_team_name}")
-
-    bitbucket_team_uuid = get_team_response.json()['uuid']
+    if members is None:
+        members = ((member['display_name'], member['account_id'])
+            for member in paginate(
+                f"{teams_url()}/members"
+                    .format(team=bitbucket_team_name),
+                prefetch = True,
+                auth = BearerAuth(get_access_token()),
+            ))
+
+    bitbucket_team_uuid = get_team_uuid()
     cookies = {
         'optintowebauth' : '1',
         'cloud.session.token': bitbucket_cloud_session
     }
 
-    all_members_accesses = []
+    # IMPORTANT
+    # ----
+    # Too many requests sent in a short period of time will trigger BitBucket
+    # to block the subsequent requests. All the workers share one bucket so
+    # the request budget holds regardless of the concurrency.
+    bucket = TokenBucket(rate=rate, burst=burst)
+
+    def fetch(member):
+        display_name, user_uuid = member
+        if checkpoint is not None:
+            checkpointed = checkpoint.get(user_uuid)
+            if checkpointed is not None:
+                logging.debug(f"Reusing checkpointed {display_name}")
+                return checkpointed
 
-    for display_name, user_uuid in members:
         logging.debug(f"Fetching {display_name}")
         users_accesses = __get_user_accesses(
             user_accesses_url()
@@ -63,28 +105,33 @@ def get_all_user_accesses(format: str):
                 team_id=bitbucket_team_uuid,
                 user_id=user_uuid
                 ),
+            bucket=bucket,
             cookies=cookies
         )
 
-        all_members_accesses.append(users_accesses)
-        # IMPORTANT
-        # ----
-        # Workaround for Rate Limiting.
-        # Too many requests sent in a short period of time will trigger BitBucket
-        # to block the subsequent requests.
-        time.sleep(2)
+        if checkpoint is not None:
+            checkpoint.record(users_accesses)
+        return users_accesses
 
-    FORMATTERS = {
-        'default': __tabulate_format,
-        'table': __tabulate_format,
-        'json': __json_format,
-        'pipe': __pipe_format
-    }
+    # `map` yields the results in the order of `members`.
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from executor.map(fetch, members)
 
-    formatter = FORMATTERS.get(format, FORMATTERS.get('default'))
-    formatter(all_members_accesses)
+    logging.debug(f"Waited {bucket.waited:.1f}s for the rate limiter")
+
+def __to_record(member_accesses: Tuple) -> dict:
+    display_name, account_id, repos, groups = member_accesses
+    return {
+        'display_name': display_name,
+        'account_id': account_id,
+        'repos': repos,
+        'groups': groups
+    }
 
-def __tabulate_format(all_member_accesses: List[Tuple]):
+def __tabulate_format(all_member_accesses: Iterable[Tuple]):
+    from tabulate import tabulate
+    # `tabulate` needs every row to compute the column widths,
+    # so this is the only format which is not streamed.
     headers = ['user', 'user_id', 'repos', 'groups']
     table = []
     for display_name, account_id, repos, groups in all_member_accesses:
@@ -97,30 +144,58 @@ def __tabulate_format(all_member_accesses: List[Tuple]):
     print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='pipe'))
     return None
 
-def __json_format(all_member_accesses: List[Tuple]):
-    result = []
-    for display_name, account_id, repos, groups in all_member_accesses:
-        result.append({
-            'display_name': display_name,
-            'account_id': account_id,
-            'repos': repos,
-            'groups': groups
-        })
-    print(json.dumps(result,indent=2))
-
-def __pipe_format(all_member_accesses: List[Tuple]):
+def __json_format(all_member_accesses: Iterable[Tuple]):
+    """Prints a JSON array, one element per line, as the elements arrive."""
+    print('[', flush=True)
+    separator = ''
+    for member_accesses in all_member_accesses:
+        print(f"{separator}  {json.dumps(__to_record(member_accesses))}", end='', flush=True)
+        separator = ',\n'
+    print('\n]', flush=True)
+
+def __ndjson_format(all_member_accesses: Iterable[Tuple]):
+    """Prints one JSON object per line (http://ndjson.org)."""
+    for member_accesses in all_member_accesses:
+        print(json.dumps(__to_record(member_accesses)), flush=True)
+
+def __pipe_format(all_member_accesses: Iterable[Tuple]):
     """Prints out in stdin using a format that it is possible to pipe
     into another command like `awk`.
     """
     for display_name, account_id, repos, groups in all_member_accesses:
         for repo in repos:
             print(f"{display_name}\t{account_id}\t{repo}")
-
-def __get_user_accesses(url, **options) -> Tuple[str, str, List[str], List[str]]:
-    response = requests.get(
+        sys.stdout.flush()
+
+def __matrix_format(all_member_accesses: Iterable[Tuple], concurrency: int, stdout: BinaryIO):
+    """Writes the compact binary `AccessMatrix`, with the level of every
+    access read from the team privileges."""
+    from bitbucklet.matrix import AccessMatrix
+    from bitbucklet.repos import iter_repositories
+
+    # The privileges name the repositories by slug, the access summaries by name.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        index = executor.submit(load_permission_index, concurrency=concurrency)
+        slugs = {repo['name']: repo['slug'] for repo in iter_repositories(fields='next,values.name,values.slug')}
+        levels = index.result().accesses_by_account()
+    matrix = AccessMatrix.build(all_member_accesses, lambda account_id, repo: levels.get(account_id, {}).get(slugs.get(repo, repo)))
+    sys.stdout.flush()
+    matrix.write(stdout)
+    stdout.flush()
+    click.echo(f"{len(matrix.users)} users, {len(matrix.repos)} repositories, {len(matrix.groups)} groups", err=True)
+
+def __get_user_accesses(url, bucket: TokenBucket = None, **options) -> Tuple[str, str, List[str], List[str]]:
+    from requests import HTTPError
+    from bitbucklet.session import get_session
+
+    response = send(bucket, lambda: get_session().get(
         url,
         **options
-    )
+    ))
+
+    if response.status_code != 200:
+        logging.error(response.text)
+        raise HTTPError(f"Fail to obtain accesses: {url}", response=response)
 
     logging.debug(response.json())
 
@@ -133,23 +208,41 @@ def __get_user_accesses(url, **options) -> Tuple[str, str, List[str], List[str]]
 
 @click.command(name='list', help='List all accesses of a user')
 @click.argument('user', required=True)
-def get_user_accesses(user: str):
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
-    bitbucket_cloud_session = os.getenv('BITBUCKET_CLOUD_SESSION')
+@snapshot_options(ACCESSES)
+def get_user_accesses(user: str, snapshot: Snapshot):
+    from tabulate import tabulate
+    snapshotted = snapshot.user_accesses(user) if snapshot is not None else None
+    if snapshotted is not None:
+        display_name, _, uuid, repos, groups = snapshotted
+    elif snapshot is not None and snapshot.offline:
+        raise click.ClickException(f"User {user} is not in the snapshot")
+    else:
+        display_name, uuid, repos, groups = __fetch_user_accesses(user)
+
+    headers = ['user', 'user_id', 'repos', 'groups']
+    table = [[display_name,
+        uuid,
+        '\n'.join(repos),
+        '\n'.join(groups)
+    ]]
+    print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='pipe'))
 
-    access_token = get_access_token()
+def __fetch_user_accesses(user: str) -> Tuple[str, str, List[str], List[str]]:
+    access_summary = fetch_access_summary(user)
+
+    repos = [ repo['name'] for repo in access_summary['repos'] ]
+    groups = [ group['slug'] for group in access_summary['groups']]
+    return (access_summary['user']['display_name'], access_summary['user']['uuid'], repos, groups)
 
-    get_team_response = requests.get(
-        teams_url()
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token)
-    )
-    
-    if get_team_response.status_code != 200:
-        logging.error(get_team_response)
-        raise RuntimeError(f"Fail to obtain team {bitbucket_team_name}")
+def fetch_access_summary(user: str) -> dict:
+    """Fetches the raw access summary (`user`, `repos` and `groups`) of a user
+    given their account id or UUID, from the internal API used by the website.
+    """
+    from requests import HTTPError
+    from bitbucklet.session import get_session
+    from bitbucklet.teams import with_team_uuid
 
-    bitbucket_team_uuid = get_team_response.json()['uuid']
+    bitbucket_cloud_session = os.getenv('BITBUCKET_CLOUD_SESSION')
 
     cookies = {
         'optintowebauth' : '1',
@@ -158,30 +251,65 @@ def get_user_accesses(user: str):
 
     logging.debug(f"cookies: {cookies}")
 
-    response = requests.get(
+    response = with_team_uuid(lambda bitbucket_team_uuid: get_session().get(
         user_accesses_url()
             .format(
                 team_id=bitbucket_team_uuid,
                 user_id=user
                 ),
         cookies=cookies
-    )
+    ))
+
+    if response.status_code != 200:
+        logging.error(response.text)
+        raise HTTPError(f"Fail to obtain accesses of {user}", response=response)
 
     logging.debug(response.json())
 
-    access_summary = response.json()
+    return response.json()
+
+
+@click.command(name='who-can', help='List the users who can access repositories, directly or through a group')
+@click.argument('repos', nargs=-1, required=True)
+@click.option("-a", "--access", type=click.Choice(LEVELS, case_sensitive=False), default='read', show_default=True, help="Minimum access")
+@click.option("-f", "--format", "format", type=click.Choice(['table', 'ndjson'], case_sensitive=False), default='table', help="Format the output")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, envvar='BITBUCKLET_CONCURRENCY', show_default=True, help="Number of concurrent requests")
+@snapshot_options(PRIVILEGES)
+def who_can(repos, access: str, format: str, concurrency: int, snapshot: Snapshot):
+    from tabulate import tabulate
+    index = load_permission_index(snapshot, concurrency)
+
+    for repo in repos:
+        principals = index.who_can(repo, access.lower())
+        if format == 'ndjson':
+            for principal in principals:
+                print(json.dumps(dict(principal._asdict(), repo=repo)))
+            continue
+
+        headers = ['repo', 'user', 'user_id', 'access', 'via']
+        table = [[repo, p.display_name, p.uuid, p.access, '\n'.join(p.via)] for p in principals]
+        print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='pipe'))
+
+def load_permission_index(snapshot: Snapshot = None, concurrency: int = DEFAULT_CONCURRENCY) -> PermissionIndex:
+    """Builds a `PermissionIndex` from `snapshot`, or from a live crawl of the
+    team-wide privileges and the members of every group.
+    """
+    from bitbucklet.groups_cli import fetch_groups, fetch_group_members
+    from bitbucklet.repos import fetch_team_group_privileges, fetch_team_user_privileges
 
-    repos = [ repo['name'] for repo in access_summary['repos'] ]
-    groups = [ group['slug'] for group in access_summary['groups']]
+    if snapshot is not None:
+        if snapshot.synced_at(GROUPS) is None:
+            raise click.ClickException("The snapshot has no groups. Run `bitbucklet sync` first.")
+        return PermissionIndex.build(snapshot.privileges('group'), snapshot.privileges('user'), snapshot.all_group_members())
 
-    headers = ['user', 'user_id', 'repos', 'groups']
-    table = [[access_summary['user']['display_name'],
-        access_summary['user']['uuid'],
-        '\n'.join(repos),
-        '\n'.join(groups)
-    ]]
-    print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='pipe'))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        group_privileges = executor.submit(fetch_team_group_privileges)
+        user_privileges = executor.submit(fetch_team_user_privileges)
+        slugs = [group['slug'] for group in fetch_groups()]
+        group_members = dict(zip(slugs, executor.map(fetch_group_members, slugs)))
+        return PermissionIndex.build(group_privileges.result(), user_privileges.result(), group_members)
 
 
 accesses_cli.add_command(get_user_accesses)
-accesses_cli.add_command(get_all_user_accesses)
\ No newline at end of file
+accesses_cli.add_command(get_all_user_accesses)
+accesses_cli.add_command(who_can)
\ No newline at end of file
@@ -0,0 +1,181 @@
+import click
+import io
+import json
+import logging
+import shlex
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple
+
+from bitbucklet.bulk import Result, summarize
+
+logger = logging.getLogger("batch")
+
+# Commands which make no sense inside a batch.
+EXCLUDED_COMMANDS = ('batch', 'serve')
+
+
+class Operation(NamedTuple):
+    line: int
+    args: List[str]
+
+
+@click.command(name='batch', help='Run many subcommands, from a file or stdin, in one process')
+@click.argument('file', type=click.File('r'), default='-')
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=1, show_default=True, help="Number of operations run concurrently")
+@click.option("--stop-on-error", is_flag=True, default=False, help="Do not run the operations after a failing one (sequential runs only)")
+def batch_cli(file, concurrency: int, stop_on_error: bool):
+    """Runs one operation per line, either a subcommand line:
+
+        groups add-user developers alice
+
+    or a JSON operation:
+
+        {"args": ["repos", "grant", "-g", "developers", "--access", "write", "awesome-repo"]}
+
+    Blank lines and lines starting with `#` are skipped. All the operations
+    share the access token, the team UUID and the connection pool, as they
+    are cached per process.
+
+    Prints one JSON result per operation, in the order of the input, with its
+    exit code and output. Exits with 1 when any failed.
+    """
+    root = click.get_current_context().find_root()
+    operations = read_operations(file)
+
+    results = []
+    with ThreadLocalStream('stdout') as capture:
+        def run(operation: Operation) -> Result:
+            return run_operation(root, operation, capture)
+
+        if concurrency == 1:
+            outcomes = (run(operation) for operation in operations)
+        else:
+            executor = ThreadPoolExecutor(max_workers=concurrency)
+            outcomes = executor.map(run, operations)
+
+        for result in outcomes:
+            results.append(result)
+            capture.original.write(json.dumps(dict(result.item, ok=result.ok, exit_code=result.status, output=result.detail)) + '\n')
+            capture.original.flush()
+            if stop_on_error and concurrency == 1 and not result.ok:
+                click.echo(f"Stopping after line {result.item['line']}", err=True)
+                break
+
+        if concurrency != 1:
+            executor.shutdown(wait=True)
+
+    summarize(results)
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
+def read_operations(file) -> List[Operation]:
+    operations = []
+    for number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        if line.startswith('{'):
+            try:
+                args = json.loads(line)['args']
+            except (ValueError, KeyError, TypeError):
+                raise click.ClickException(f"Line {number}: expected a JSON object with `args`")
+            if isinstance(args, str):
+                args = shlex.split(args)
+        else:
+            args = shlex.split(line)
+
+        if not args:
+            continue
+        operations.append(Operation(number, [str(arg) for arg in args]))
+    return operations
+
+
+def run_operation(root: click.Context, operation: Operation, capture: 'ThreadLocalStream') -> Result:
+    """Runs one subcommand of `root` in-process, capturing what it prints.
+
+    Returns a `Result` whose `status` is the exit code of the operation.
+    """
+    item = {'line': operation.line, 'args': operation.args}
+    with capture.buffering() as output:
+        exit_code = invoke(root, operation.args, output)
+    return Result(item, exit_code == 0, exit_code, output.getvalue())
+
+
+def invoke(root: click.Context, args: List[str], errors) -> int:
+    """Runs the subcommand line `args` of `root` in-process, as `main` would
+    with `standalone_mode`, writing error messages into `errors`.
+
+    Returns the exit code.
+    """
+    name, args = args[0], args[1:]
+
+    command = root.command.get_command(root, name) if name not in EXCLUDED_COMMANDS else None
+    if command is None:
+        errors.write(f"Error: No such command \"{name}\".\n")
+        return 2
+
+    try:
+        command.main(args, prog_name=f"{root.info_name} {name}", standalone_mode=False)
+    except click.exceptions.Exit as e:
+        return e.exit_code
+    except click.exceptions.Abort:
+        return 1
+    except click.ClickException as e:
+        errors.write(f"Error: {e.format_message()}\n")
+        return e.exit_code
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        logger.debug(f"{name} {args} failed", exc_info=True)
+        errors.write(f"{type(e).__name__}: {e}\n")
+        return 1
+    return 0
+
+
+class ThreadLocalStream:
+    """Stands in for `sys.stdout` (or `sys.stderr`), sending what a thread
+    prints into its own buffer while it runs an operation, and to the real
+    stream otherwise."""
+
+    def __init__(self, name: str = 'stdout'):
+        self.name = name
+        self.original = getattr(sys, name)
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+    def _target(self):
+        return getattr(self._local, 'buffer', None) or self.original
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        return self._target().flush()
+
+    def buffering(self):
+        return _Buffering(self)
+
+    def __enter__(self):
+        setattr(sys, self.name, self)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(sys, self.name, self.original)
+
+
+class _Buffering:
+    def __init__(self, stream: ThreadLocalStream):
+        self.stream = stream
+
+    def __enter__(self) -> io.StringIO:
+        self.stream._local.buffer = io.StringIO()
+        return self.stream._local.buffer
+
+    def __exit__(self, *exc_info):
+        self.stream._local.buffer = None
@@ -0,0 +1,60 @@
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+import click
+
+from bitbucklet.ratelimit import TokenBucket, send, DEFAULT_RATE, DEFAULT_BURST, DEFAULT_CONCURRENCY
+
+logger = logging.getLogger("bulk")
+
+
+def bulk_options(command):
+    """Adds `--concurrency`, `--rate` and `--burst` to a command sending many requests."""
+    command = click.option("--burst", type=click.IntRange(min=1), default=DEFAULT_BURST, envvar='BITBUCKLET_BURST', show_default=True, help="Maximum requests sent in a burst")(command)
+    command = click.option("--rate", type=click.FloatRange(min=0.01), default=DEFAULT_RATE, envvar='BITBUCKLET_RATE', show_default=True, help="Maximum requests per second")(command)
+    command = click.option("-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, envvar='BITBUCKLET_CONCURRENCY', show_default=True, help="Number of concurrent requests")(command)
+    return command
+
+
+class Result(NamedTuple):
+    """The outcome of one operation run by `execute`."""
+    item: Any
+    ok: bool
+    status: Optional[int]
+    detail: str
+
+
+def execute(items: Iterable[Any], request: Callable, concurrency: int, bucket: TokenBucket,
+            is_ok: Callable = None) -> Iterator[Result]:
+    """Runs `request(item)`, which sends one HTTP request and returns its
+    response, for every item over a pool of `concurrency` threads sharing
+    `bucket`. Requests refused with 429 are retried.
+
+    Yields a `Result` per item, in the order of `items`. Failures, including
+    exceptions, are reported in the result rather than raised so that one
+    failing item never aborts the others.
+    """
+    is_ok = is_ok or (lambda response: response.status_code < 300)
+
+    def run(item) -> Result:
+        try:
+            response = send(bucket, lambda: request(item))
+        except Exception as e:
+            logger.debug(f"{item} failed", exc_info=True)
+            return Result(item, False, None, str(e))
+
+        ok = is_ok(response)
+        detail = '' if ok else response.text.strip()
+        return Result(item, ok, response.status_code, detail)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        yield from executor.map(run, items)
+
+
+def summarize(results: List[Result], file=None):
+    # Resolved on every call, as `sys.stderr` may be replaced, e.g by `bitbucklet serve`.
+    file = file or sys.stderr
+    failed = [result for result in results if not result.ok]
+    print(f"{len(results) - len(failed)} succeeded, {len(failed)} failed", file=file)
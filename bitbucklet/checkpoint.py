@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Tuple, List
+
+from bitbucklet.config import cache_dir
+
+logger = logging.getLogger("checkpoint")
+
+DEFAULT_MAX_AGE = 24 * 60 * 60
+
+
+class Checkpoint:
+    """An append-only journal of the access summaries fetched by `accesses list-all`.
+
+    Every summary is appended as a JSON line as soon as it is fetched so that a
+    crawl interrupted (i.e by a 429, an expired `BITBUCKET_CLOUD_SESSION` or a
+    network drop) can be resumed. Entries older than `max_age` seconds are ignored.
+    """
+
+    def __init__(self, path: Path, max_age: float = DEFAULT_MAX_AGE):
+        self._path = path
+        self._max_age = max_age
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    @classmethod
+    def for_team(cls, team: str = None, max_age: float = DEFAULT_MAX_AGE) -> 'Checkpoint':
+        team = team or os.getenv('BITBUCKET_TEAM')
+        safe_team = re.sub(r'[^A-Za-z0-9_.-]', '_', team or '')
+        return cls(cache_dir() / f"accesses-{safe_team}.jsonl", max_age=max_age)
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def open(self, resume: bool) -> 'Checkpoint':
+        """Opens the journal, loading the fresh entries if `resume` else truncating it."""
+        if resume:
+            self._load()
+        # Rewriting the fresh entries compacts away the stale ones.
+        self._file = open(self._path, 'w')
+        os.chmod(self._path, 0o600)
+        for entry in self._entries.values():
+            self._file.write(json.dumps(entry) + '\n')
+        self._file.flush()
+        return self
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _load(self):
+        if not self._path.exists():
+            return
+        oldest = time.time() - self._max_age
+        with open(self._path) as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A crash in the middle of a write leaves a truncated last line.
+                    continue
+                if entry.get('fetched_at', 0) >= oldest:
+                    self._entries[entry['account_id']] = entry
+        logger.info(f"Resuming with {len(self._entries)} users from {self._path}")
+
+    def get(self, account_id: str) -> Optional[Tuple[str, str, List[str], List[str]]]:
+        entry = self._entries.get(account_id)
+        if entry is None:
+            return None
+        return (entry['display_name'], entry['account_id'], entry['repos'], entry['groups'])
+
+    def record(self, member_accesses: Tuple[str, str, List[str], List[str]]):
+        display_name, account_id, repos, groups = member_accesses
+        entry = {
+            'fetched_at': time.time(),
+            'display_name': display_name,
+            'account_id': account_id,
+            'repos': repos,
+            'groups': groups
+        }
+        with self._lock:
+            self._entries[account_id] = entry
+            if self._file is not None:
+                self._file.write(json.dumps(entry) + '\n')
+                self._file.flush()
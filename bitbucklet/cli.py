@@ -1,25 +1,89 @@
 import click
 import os
+import importlib
 import logging
-from dotenv import load_dotenv
-from pathlib import Path
 
-from bitbucklet.token import token_cli
-from bitbucklet.groups_cli import groups_cli
-from bitbucklet.users import users_cli
-from bitbucklet.config import cfg_cli
-from bitbucklet.repos import repos_cli
-from bitbucklet.accesses import accesses_cli
+from bitbucklet.config import load_config
 
-@click.group(no_args_is_help=True)
+
+class LazyGroup(click.Group):
+    """A group importing the module of a subcommand only when it is dispatched.
+
+    Subcommands are registered as `name -> (module:attribute, short help)` so
+    that `--help` lists them without importing anything, and so that running
+    one command does not pay for importing `requests`, `tabulate`, ... through
+    all the others.
+    """
+
+    def __init__(self, *args, lazy_subcommands: dict = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands = lazy_subcommands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_subcommands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name in self.lazy_subcommands and cmd_name not in self.commands:
+            self.add_command(self.__load(cmd_name), cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        rows = []
+        for name in self.list_commands(ctx):
+            if name in self.commands:
+                command = self.commands[name]
+                if command.hidden:
+                    continue
+                rows.append((name, command.get_short_help_str()))
+            else:
+                rows.append((name, self.lazy_subcommands[name][1]))
+
+        if rows:
+            with formatter.section('Commands'):
+                formatter.write_dl(rows)
+
+    def __load(self, cmd_name):
+        module_name, attribute = self.lazy_subcommands[cmd_name][0].split(':')
+        return getattr(importlib.import_module(module_name), attribute)
+
+
+class BitbuckletGroup(LazyGroup):
+    """Loads the configuration, then forwards the command to `bitbucklet serve`
+    when it runs, before importing anything to run it directly."""
+
+    def invoke(self, ctx):
+        load_config()
+
+        # Debug logs and profiles are of this process.
+        local = ctx.params.get('debug') or ctx.params.get('profile') or ctx.params.get('trace_file')
+        if ctx.protected_args and not local:
+            from bitbucklet.daemon import forward
+            exit_code = forward(ctx.protected_args + ctx.args)
+            if exit_code is not None:
+                ctx.exit(exit_code)
+
+        return super().invoke(ctx)
+
+
+@click.group(cls=BitbuckletGroup, no_args_is_help=True, lazy_subcommands={
+    'tokens': ('bitbucklet.token:token_cli', 'Tokens'),
+    'groups': ('bitbucklet.groups_cli:groups_cli', 'Managing groups'),
+    'users': ('bitbucklet.users:users_cli', 'Managing users'),
+    'cfg': ('bitbucklet.config:cfg_cli', ''),
+    'repos': ('bitbucklet.repos:repos_cli', 'Managing repositories and their permissions'),
+    'accesses': ('bitbucklet.accesses:accesses_cli', 'Managing accesses'),
+    'sync': ('bitbucklet.sync:sync_cli', 'Mirror the team into a local snapshot for --offline queries'),
+    'plan': ('bitbucklet.reconcile:plan_cli', 'Show the changes to reach a desired state'),
+    'apply': ('bitbucklet.reconcile:apply_cli', 'Apply a desired state of groups and permissions'),
+    'batch': ('bitbucklet.batch:batch_cli', 'Run many subcommands, from a file or stdin, in one process'),
+    'serve': ('bitbucklet.daemon:serve_cli', 'Keep a warm process to which the other commands are forwarded'),
+    'cache': ('bitbucklet.httpcache:cache_cli', 'Inspect or clear the HTTP response cache'),
+})
 @click.option('--debug', is_flag=True, default=False, help='Print log in DEBUG level')
+@click.option('--profile', is_flag=True, default=False, help='Print a summary of the requests sent, per endpoint, at exit')
+@click.option('--trace-file', type=click.Path(dir_okay=False, writable=True), default=None, help='Write one JSON line per request sent into this file')
 @click.version_option()
-def main(debug):
-    load_dotenv(dotenv_path=Path.home() / '.bitbucklet')
-    if os.getenv('BITBUCKLET_CONFIG_FILE') is not None:
-        load_dotenv(load_dotenv=os.getenv('BITBUCKLET_CONFIG_FILE'), override=True)
-    load_dotenv(dotenv_path=Path('.') / '.env', override=True)
-
+def main(debug, profile, trace_file):
     logging.basicConfig(level=logging.INFO)
 
     if debug:
@@ -28,15 +92,20 @@ def main(debug):
         requests_log.setLevel(logging.DEBUG)
         requests_log.propagate = True
 
-    for k, v in os.environ.items():
-        logging.debug(f'{k}={v}')
+        # Only the names: the values include the OAuth secret and the session cookie.
+        for k in sorted(os.environ):
+            if k.startswith(('BITBUCKET_', 'BITBUCKLET_')):
+                logging.debug(f'{k} is set')
+
+    if profile or trace_file:
+        from bitbucklet import instrumentation
+        recorder = instrumentation.enable(trace_file)
 
-main.add_command(token_cli)
-main.add_command(groups_cli)
-main.add_command(users_cli)
-main.add_command(cfg_cli)
-main.add_command(repos_cli)
-main.add_command(accesses_cli)
+        def report():
+            if profile:
+                recorder.print_summary()
+            instrumentation.disable()
+        click.get_current_context().call_on_close(report)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,187 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, List, NamedTuple, Optional
+
+from requests import HTTPError
+
+from bitbucklet.ratelimit import TokenBucket, limited, DEFAULT_RATE, DEFAULT_BURST, DEFAULT_CONCURRENCY
+
+# Marks the end of a generator consumed from the event loop; `StopIteration`
+# cannot cross a future.
+_EXHAUSTED = object()
+
+
+class AccessSummary(NamedTuple):
+    """The repositories and groups a user has access to."""
+    display_name: str
+    uuid: str
+    repos: List[str]
+    groups: List[str]
+
+
+class AsyncBitbucketClient:
+    """An asyncio API over the same functions the CLI commands use, so that
+    bitbucklet can be embedded in other tools without spawning the CLI.
+
+        from bitbucklet.client import AsyncBitbucketClient
+        from bitbucklet.config import load_config
+
+        load_config()
+        async with AsyncBitbucketClient(concurrency=8) as client:
+            groups = await client.groups()
+            members = await asyncio.gather(*(client.group_members(g['slug']) for g in groups))
+
+    The configuration is read from the environment (`BITBUCKET_TEAM`,
+    `BITBUCKET_CLIENT_ID`, ...), see `bitbucklet.config.load_config`.
+
+    Requests run on the shared pooled HTTP session, in a pool of `concurrency`
+    threads: at most `concurrency` are in flight, whatever the number of
+    coroutines awaiting, and all of them, every page included, share one
+    token bucket of `rate` requests per second. Those refused with 429 are
+    sent again. The access token and the team UUID are cached process-wide,
+    as in the CLI.
+
+    Reads return the decoded JSON. Writes return the response and raise
+    `HTTPError` when BitBucket refuses them.
+    """
+
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    async def __aenter__(self) -> 'AsyncBitbucketClient':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    # Team and members
+
+    async def team_uuid(self) -> str:
+        from bitbucklet.teams import get_team_uuid
+        return await self._read(get_team_uuid)
+
+    async def members(self) -> List[dict]:
+        return [member async for member in self.iter_members()]
+
+    def iter_members(self) -> AsyncIterator[dict]:
+        from bitbucklet.users import iter_members
+        return self._aiter(iter_members)
+
+    async def invitations(self) -> List[dict]:
+        from bitbucklet.users import fetch_invitations
+        return await self._read(fetch_invitations)
+
+    async def invite(self, email: str, group: str = 'developers'):
+        from bitbucklet.users import invite_user
+        return await self._write(invite_user, email, group)
+
+    # Groups
+
+    async def groups(self) -> List[dict]:
+        from bitbucklet.groups_cli import fetch_groups
+        return await self._read(fetch_groups)
+
+    async def group_members(self, group_slug: str) -> List[dict]:
+        from bitbucklet.groups_cli import fetch_group_members
+        return await self._read(fetch_group_members, group_slug)
+
+    async def create_group(self, group_name: str):
+        from bitbucklet.groups_cli import create_group
+        return await self._write(create_group, group_name)
+
+    async def add_group_member(self, group_slug: str, username: str):
+        from bitbucklet.groups_cli import put_group_member
+        return await self._write(put_group_member, group_slug, username)
+
+    async def remove_group_member(self, group_slug: str, username: str):
+        from bitbucklet.groups_cli import delete_group_member
+        return await self._write(delete_group_member, group_slug, username)
+
+    # Repositories and privileges
+
+    async def repositories(self, project: str = None, fields: str = None) -> List[dict]:
+        return [repo async for repo in self.iter_repositories(project, fields)]
+
+    def iter_repositories(self, project: str = None, fields: str = None) -> AsyncIterator[dict]:
+        from bitbucklet.repos import iter_repositories
+        return self._aiter(iter_repositories, project=project, fields=fields)
+
+    async def group_privileges(self) -> List[dict]:
+        from bitbucklet.repos import fetch_team_group_privileges
+        return await self._read(fetch_team_group_privileges)
+
+    async def user_privileges(self) -> List[dict]:
+        from bitbucklet.repos import fetch_team_user_privileges
+        return await self._read(fetch_team_user_privileges)
+
+    async def grant(self, repo: str, access: str, user: str = None, group: str = None):
+        """Grants `access` on `repo` to either a user (account id or UUID) or a group (slug)."""
+        from bitbucklet.repos import put_group_privilege, put_user_privilege
+        if group is not None:
+            return await self._write(put_group_privilege, group, access, repo)
+        return await self._write(put_user_privilege, user, access, repo)
+
+    async def revoke(self, repo: str, user: str = None, group: str = None):
+        from bitbucklet.repos import delete_group_privilege, delete_user_privilege
+        if group is not None:
+            return await self._write(delete_group_privilege, group, repo)
+        return await self._write(delete_user_privilege, user, repo)
+
+    async def user_accesses(self, user: str) -> AccessSummary:
+        """Requires `BITBUCKET_CLOUD_SESSION`, as `accesses list`."""
+        from bitbucklet.accesses import fetch_access_summary
+        summary = await self._read(fetch_access_summary, user)
+        return AccessSummary(
+            summary['user']['display_name'],
+            summary['user']['uuid'],
+            [repo['name'] for repo in summary['repos']],
+            [group['slug'] for group in summary['groups']])
+
+    # Plumbing
+
+    def _run(self, function: Callable, *args, **kwargs) -> asyncio.Future:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='bitbucklet')
+        return asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(function, *args, **kwargs))
+
+    def _limited(self, function: Callable) -> Callable:
+        """Wraps `function` to send every request through the token bucket,
+        sending again those refused with 429."""
+        def run(*args, **kwargs):
+            with limited(self.bucket):
+                return function(*args, **kwargs)
+        return run
+
+    async def _read(self, function: Callable, *args, **kwargs):
+        """Runs a function sending requests and returning their decoded result."""
+        return await self._run(self._limited(function), *args, **kwargs)
+
+    async def _write(self, function: Callable, *args):
+        """Runs a function sending one request and returning its response."""
+        response = await self._run(self._limited(function), *args)
+        if response.status_code >= 300:
+            raise HTTPError(response.text, response=response)
+        return response
+
+    async def _aiter(self, function: Callable, *args, **kwargs) -> AsyncIterator:
+        """Consumes a (paginating) generator in the pool, one item at a time."""
+        iterator = await self._run(self._limited(lambda: iter(function(*args, **kwargs))))
+        try:
+            while True:
+                item = await self._run(self._limited(next), iterator, _EXHAUSTED)
+                if item is _EXHAUSTED:
+                    return
+                yield item
+        finally:
+            # When the consumer stops early: runs the `finally` of the
+            # generator, which may send requests, in the pool too.
+            await self._run(self._limited(getattr(iterator, 'close', lambda: None)))
@@ -1,9 +1,53 @@
 import click
+import os
 from typing import Type
 from pathlib import Path
 
 BITBUCKLET_DOTENV_TEMPLATE = Path(__file__).parent / '__bitbucklet_config_template.env'
 
+def load_config():
+    """Loads the configuration into the environment, in order (the latter
+    overrides the former): `~/.bitbucklet`, the file `$BITBUCKLET_CONFIG_FILE`
+    and `./.env`.
+
+    Call it before using bitbucklet as a library to get the same configuration
+    as the CLI.
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv(dotenv_path=Path.home() / '.bitbucklet')
+    if os.getenv('BITBUCKLET_CONFIG_FILE') is not None:
+        load_dotenv(dotenv_path=os.getenv('BITBUCKLET_CONFIG_FILE'), override=True)
+    load_dotenv(dotenv_path=Path('.') / '.env', override=True)
+
+def cache_dir() -> Path:
+    """Returns the directory holding bitbucklet's caches, creating it if needed.
+
+    It is `$BITBUCKLET_CACHE_DIR` if set, otherwise `$XDG_CACHE_HOME/bitbucklet`
+    (defaulting to `~/.cache/bitbucklet`). The directory is only accessible
+    by the current user since it holds access tokens.
+    """
+    if os.getenv('BITBUCKLET_CACHE_DIR'):
+        path = Path(os.getenv('BITBUCKLET_CACHE_DIR'))
+    else:
+        xdg_cache_home = os.getenv('XDG_CACHE_HOME') or Path.home() / '.cache'
+        path = Path(xdg_cache_home) / 'bitbucklet'
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+def write_private_file(path: Path, content: str):
+    """Atomically writes `content` into `path` with permissions 0600."""
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp, path)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+
 @click.group(name = 'cfg')
 def cfg_cli():
     pass
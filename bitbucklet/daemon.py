@@ -0,0 +1,251 @@
+import click
+import hashlib
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from bitbucklet.config import cache_dir
+
+logger = logging.getLogger("daemon")
+
+DEFAULT_REFRESH = 300
+CONNECT_TIMEOUT = 1.0
+
+# The commands forwarded to a running `bitbucklet serve`: those which neither
+# read files nor stdin, as the server does not share the working directory
+# of the client. Anything else always runs directly.
+FORWARDED_COMMANDS = (
+    'users list',
+    'users list-pending',
+    'users invite',
+    'users del-invitation',
+    'groups list',
+    'groups list-users',
+    'groups add',
+    'groups del',
+    'groups add-user',
+    'groups del-user',
+    'repos list',
+    'repos list-in-project',
+    'repos grant',
+    'repos revoke',
+    'accesses list',
+    'accesses who-can',
+)
+
+# Forwarded commands which do not change the team, i.e which keep the served
+# snapshot valid.
+READ_ONLY_COMMANDS = (
+    'users list',
+    'users list-pending',
+    'groups list',
+    'groups list-users',
+    'repos list',
+    'repos list-in-project',
+    'accesses list',
+    'accesses who-can',
+)
+
+# The configuration a client and the server must share for the server to run
+# the commands of the client.
+CONFIG_VARIABLES = ('BITBUCKET_TEAM', 'BITBUCKET_CLIENT_ID', 'BITBUCKET_CLIENT_SECRET', 'BITBUCKET_CLOUD_SESSION')
+
+
+def socket_path() -> Path:
+    if os.getenv('BITBUCKLET_SOCKET'):
+        return Path(os.getenv('BITBUCKLET_SOCKET'))
+    safe_team = re.sub(r'[^A-Za-z0-9_.-]', '_', os.getenv('BITBUCKET_TEAM') or '')
+    return cache_dir() / f"serve-{safe_team}.sock"
+
+
+def config_fingerprint() -> str:
+    values = '\0'.join(os.getenv(name) or '' for name in CONFIG_VARIABLES)
+    return hashlib.sha256(values.encode()).hexdigest()
+
+
+def forward(args: List[str]) -> Optional[int]:
+    """Runs the subcommand line `args` on a running `bitbucklet serve`,
+    printing its output.
+
+    Returns the exit code, or `None` when it should run directly: the command
+    is not forwarded, no server runs, or it runs with another configuration.
+    """
+    if os.getenv('BITBUCKLET_DAEMON', '1') == '0' or _command_of(args) not in FORWARDED_COMMANDS:
+        return None
+
+    path = socket_path()
+    if not path.exists():
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(CONNECT_TIMEOUT)
+            client.connect(str(path))
+            # The command itself may take a while.
+            client.settimeout(None)
+            client.sendall(json.dumps({'args': args, 'config': config_fingerprint()}).encode() + b'\n')
+            with client.makefile('rb') as f:
+                response = json.loads(f.readline())
+    except (OSError, ValueError) as e:
+        logger.debug(f"Running directly, the server at {path} is not available: {e}")
+        return None
+
+    if 'exit_code' not in response:
+        logger.debug(f"Running directly, the server refused: {response.get('error')}")
+        return None
+
+    sys.stdout.write(response['output'])
+    sys.stdout.flush()
+    sys.stderr.write(response['errors'])
+    return response['exit_code']
+
+
+def _command_of(args: List[str]) -> str:
+    return ' '.join(args[:2])
+
+
+@click.command(name='serve', help='Keep a warm process to which the other commands are forwarded')
+@click.option("--socket", "path", type=click.Path(dir_okay=False), default=None, help="Unix socket to listen on. Default: in the cache directory, or $BITBUCKLET_SOCKET")
+@click.option("--refresh", type=click.IntRange(min=10), default=DEFAULT_REFRESH, show_default=True, help="Refresh the members, groups and repositories kept in memory every this many seconds")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=4, envvar='BITBUCKLET_CONCURRENCY', show_default=True, help="Number of concurrent requests when refreshing")
+def serve_cli(path: str, refresh: int, concurrency: int):
+    """Listens on a Unix socket, which only the current user can access, and
+    runs the commands forwarded by `bitbucklet` in this process: they share
+    the access token, the team UUID, the connection pool and an in-memory
+    snapshot of the members, groups and repositories.
+
+    The list commands are served from that snapshot while it is younger than
+    twice `--refresh`; any forwarded write makes it refresh right away. Set
+    `BITBUCKLET_DAEMON=0` to never forward.
+    """
+    import socketserver
+    from bitbucklet.batch import ThreadLocalStream, invoke
+    from bitbucklet.snapshot import serve_snapshot
+    from bitbucklet.teams import get_team_uuid
+    from bitbucklet.token import get_access_token
+
+    root = click.get_current_context().find_root()
+    path = Path(path) if path else socket_path()
+    fingerprint = config_fingerprint()
+
+    # Warm up.
+    get_access_token()
+    get_team_uuid()
+    refresher = _Refresher(refresh, concurrency, serve_snapshot)
+    refresher.refresh()
+    refresher.start()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline())
+                args = [str(arg) for arg in request['args']]
+            except (ValueError, KeyError, TypeError):
+                return self.__reply({'error': 'invalid request'})
+
+            if request.get('config') != fingerprint:
+                return self.__reply({'error': 'configuration mismatch'})
+            if _command_of(args) not in FORWARDED_COMMANDS:
+                return self.__reply({'error': f"{_command_of(args)} is not served"})
+
+            started_at = time.time()
+            with stdout.buffering() as output, stderr.buffering() as errors:
+                exit_code = invoke(root, args, errors)
+            if _command_of(args) not in READ_ONLY_COMMANDS:
+                refresher.invalidate()
+            logger.info(f"{' '.join(args)}: {exit_code} in {(time.time() - started_at) * 1000:.0f} ms")
+
+            self.__reply({'exit_code': exit_code, 'output': output.getvalue(), 'errors': errors.getvalue()})
+
+        def __reply(self, response: dict):
+            self.wfile.write(json.dumps(response).encode() + b'\n')
+
+    if path.exists():
+        if __is_listening(path):
+            raise click.ClickException(f"A server is already listening on {path}")
+        path.unlink()
+
+    with ThreadLocalStream('stdout') as stdout, ThreadLocalStream('stderr') as stderr:
+        # Restrict the socket to the current user from its creation on.
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+
+        # Stop as on Ctrl-C, removing the socket.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        logger.info(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            path.unlink()
+            serve_snapshot(None)
+
+
+def __is_listening(path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(CONNECT_TIMEOUT)
+        try:
+            client.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
+class _Refresher(threading.Thread):
+    """Keeps an in-memory snapshot of the members, groups and repositories
+    fresh, rebuilding it aside and swapping it in so that readers never see
+    a partial one."""
+
+    def __init__(self, interval: int, concurrency: int, serve_snapshot):
+        super().__init__(name='refresher', daemon=True)
+        self.interval = interval
+        self.concurrency = concurrency
+        self.serve_snapshot = serve_snapshot
+        self._wake_up = threading.Event()
+        # Bumped by every write, so that a refresh which started before it
+        # is not served.
+        self._generation = 0
+
+    def refresh(self):
+        from bitbucklet.snapshot import Snapshot
+        from bitbucklet.sync import sync_members, sync_groups, sync_repositories
+
+        started_at, generation = time.time(), self._generation
+        snapshot = Snapshot.in_memory()
+        sync_members(snapshot)
+        sync_groups(snapshot, self.concurrency)
+        sync_repositories(snapshot)
+        if generation != self._generation:
+            logger.info("Discarding the snapshot refreshed during a write")
+            return
+        self.serve_snapshot(snapshot, max_age=2 * self.interval)
+        logger.info(f"Refreshed the snapshot in {time.time() - started_at:.1f}s")
+
+    def invalidate(self):
+        self._generation += 1
+        self.serve_snapshot(None)
+        self._wake_up.set()
+
+    def run(self):
+        while True:
+            self._wake_up.wait(self.interval)
+            self._wake_up.clear()
+            try:
+                self.refresh()
+            except Exception:
+                logger.warning("Failed to refresh the snapshot", exc_info=True)
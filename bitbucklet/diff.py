@@ -0,0 +1,319 @@
+import click
+import heapq
+import json
+import logging
+import sqlite3
+import sys
+import tempfile
+from collections import Counter
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+logger = logging.getLogger("diff")
+
+# Records are sorted in memory by chunks of up to this many users, repositories
+# and groups, and the chunks are merged from temporary files.
+DEFAULT_CHUNK_ENTRIES = 250000
+
+# Characters read at once from a JSON array.
+JSON_CHUNK_SIZE = 1 << 16
+
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+
+class Record(NamedTuple):
+    """The accesses of one user. The access levels are `None` when the
+    export does not have them."""
+    account_id: str
+    display_name: str
+    repos: Dict[str, Optional[str]]
+    groups: List[str]
+
+
+class Change(NamedTuple):
+    change: str
+    account_id: str
+    display_name: str
+    repo: str = None
+    group: str = None
+    old: str = None
+    new: str = None
+
+
+@click.command(name='diff', help='Compare two exports of the accesses of all users')
+@click.argument('old', type=click.Path(exists=True, dir_okay=False))
+@click.argument('new', type=click.Path(exists=True, dir_okay=False))
+@click.option("-f", "--format", "format", type=click.Choice(['text', 'ndjson'], case_sensitive=False), default='text', show_default=True, help="Format the output")
+@click.option("--exit-code", is_flag=True, default=False, help="Exit with 1 when the exports differ, as diff does")
+def diff_cli(old: str, new: str, format: str, exit_code: bool):
+    """Prints the users, repository accesses and group memberships added to
+    or removed from OLD in NEW, and the changed access levels when both
+    exports have them.
+
+    OLD and NEW are each written by `accesses list-all --format json`,
+    `ndjson` or `matrix`, the checkpoint journal of `list-all --resume`, or a
+    snapshot of `bitbucklet sync`. They are streamed through a merge-join on
+    the account ids, sorting by chunks on disk those which are not sorted
+    already, so that the memory used does not grow with their size.
+
+    The text format prints one tab-separated change per line: `+user`,
+    `-user`, `+repo`, `-repo`, `~access`, `+group` or `-group`, the user,
+    their account id, then the repository or the group.
+    """
+    counts = Counter()
+    for change in diff(read_records(old), read_records(new)):
+        counts[change.change] += 1
+        if format == 'ndjson':
+            print(json.dumps({key: value for key, value in change._asdict().items() if value is not None}))
+        else:
+            print(__text(change))
+
+    click.echo(', '.join(f"{counts[kind]} {kind.replace('_', ' ')}" for kind in CHANGES if counts[kind]) or "No changes", err=True)
+    if exit_code and counts:
+        sys.exit(1)
+
+
+# In the order of the summary.
+CHANGES = ('user_added', 'user_removed', 'repo_added', 'repo_removed', 'access_changed', 'group_added', 'group_removed')
+
+TEXT_MARKS = {
+    'user_added': '+user',
+    'user_removed': '-user',
+    'repo_added': '+repo',
+    'repo_removed': '-repo',
+    'access_changed': '~access',
+    'group_added': '+group',
+    'group_removed': '-group',
+}
+
+
+def __text(change: Change) -> str:
+    fields = [TEXT_MARKS[change.change], change.display_name or '', change.account_id]
+    if change.repo is not None:
+        fields.append(change.repo)
+        if change.change == 'access_changed':
+            fields.append(f"{change.old} -> {change.new}")
+        elif change.old or change.new:
+            fields.append(change.old or change.new)
+    if change.group is not None:
+        fields.append(change.group)
+    return '\t'.join(fields)
+
+
+def diff(old: Iterable[Record], new: Iterable[Record]) -> Iterator[Change]:
+    """Merge-joins two streams of records sorted by account id, yielding
+    their differences."""
+    old, new = iter(old), iter(new)
+    before, after = next(old, None), next(new, None)
+    while before is not None or after is not None:
+        if after is None or (before is not None and before.account_id < after.account_id):
+            yield from _removed(before)
+            before = next(old, None)
+        elif before is None or after.account_id < before.account_id:
+            yield from _added(after)
+            after = next(new, None)
+        else:
+            yield from _changed(before, after)
+            before, after = next(old, None), next(new, None)
+
+
+def _added(record: Record) -> Iterator[Change]:
+    yield Change('user_added', record.account_id, record.display_name)
+    for repo, access in record.repos.items():
+        yield Change('repo_added', record.account_id, record.display_name, repo=repo, new=access)
+    for group in record.groups:
+        yield Change('group_added', record.account_id, record.display_name, group=group)
+
+
+def _removed(record: Record) -> Iterator[Change]:
+    yield Change('user_removed', record.account_id, record.display_name)
+    for repo, access in record.repos.items():
+        yield Change('repo_removed', record.account_id, record.display_name, repo=repo, old=access)
+    for group in record.groups:
+        yield Change('group_removed', record.account_id, record.display_name, group=group)
+
+
+def _changed(before: Record, after: Record) -> Iterator[Change]:
+    account_id, display_name = after.account_id, after.display_name
+    for repo, access in after.repos.items():
+        if repo not in before.repos:
+            yield Change('repo_added', account_id, display_name, repo=repo, new=access)
+        elif access and before.repos[repo] and access != before.repos[repo]:
+            yield Change('access_changed', account_id, display_name, repo=repo, old=before.repos[repo], new=access)
+    for repo, access in before.repos.items():
+        if repo not in after.repos:
+            yield Change('repo_removed', account_id, display_name, repo=repo, old=access)
+
+    groups = set(before.groups)
+    for group in after.groups:
+        if group not in groups:
+            yield Change('group_added', account_id, display_name, group=group)
+    groups = set(after.groups)
+    for group in before.groups:
+        if group not in groups:
+            yield Change('group_removed', account_id, display_name, group=group)
+
+
+def read_records(path: str, chunk_entries: int = DEFAULT_CHUNK_ENTRIES) -> Iterator[Record]:
+    """Streams the records of an export, whatever its format, sorted by
+    account id and keeping the last record of every user."""
+    with open(path, 'rb') as f:
+        magic = f.read(len(SQLITE_MAGIC))
+
+    from bitbucklet.matrix import MAGIC
+    if magic.startswith(MAGIC):
+        records = _read_matrix(path)
+    elif magic == SQLITE_MAGIC:
+        records = _read_snapshot(path)
+    else:
+        records = sort_by_account(_read_json_lines(path), chunk_entries)
+    return _latest(records)
+
+
+def _read_matrix(path: str) -> Iterator[Record]:
+    from bitbucklet.matrix import AccessMatrix, AccessMatrixError
+
+    try:
+        matrix = AccessMatrix.load(path)
+    except AccessMatrixError as e:
+        raise click.ClickException(f"{path}: {e}")
+    # Already sorted by account id.
+    for account_id, display_name in matrix.users:
+        yield Record(account_id, display_name, matrix.repos_of(account_id), matrix.groups_of(account_id))
+
+
+def _read_snapshot(path: str) -> Iterator[Record]:
+    from pathlib import Path
+    from bitbucklet.snapshot import Snapshot, ACCESSES
+
+    try:
+        with Snapshot.open_read_only(Path(path)) as snapshot:
+            if snapshot.synced_at(ACCESSES) is None:
+                raise click.ClickException(f"The snapshot {path} has no accesses. Run `bitbucklet sync` first.")
+            for display_name, account_id, repos, groups in snapshot.all_user_accesses(by_account_id=True):
+                yield Record(account_id, display_name, dict.fromkeys(repos), groups)
+    except sqlite3.Error as e:
+        raise click.ClickException(f"{path}: not a snapshot of `bitbucklet sync`: {e}")
+
+
+def _read_json_lines(path: str) -> Iterator[Record]:
+    # A JSON array, as written by `list-all --format json` one record per line
+    # or by `json.dumps(indent=2)`, or NDJSON.
+    with open(path) as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == '[':
+            number = 1
+            try:
+                for element in _iter_json_array(f):
+                    yield _to_record(element)
+                    number += 1
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise click.ClickException(f"{path}: record {number}: expected a JSON array of records, as written by `accesses list-all`")
+            return
+
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = _to_record(json.loads(line))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                raise click.ClickException(f"{path}:{number}: expected one JSON record per line, as written by `accesses list-all`")
+            yield record
+
+
+def _iter_json_array(f, chunk_size: int = JSON_CHUNK_SIZE) -> Iterator:
+    """Streams the elements of the JSON array of `f`, whatever its layout,
+    with about one element and `chunk_size` characters in memory."""
+    decoder = json.JSONDecoder()
+    buffer, position, eof, started = '', 0, False, False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n' + (',' if started else ''):
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError("Not a JSON array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # Most likely cut by the chunk: read on.
+                if eof:
+                    raise
+            else:
+                yield element
+                continue
+        elif eof:
+            raise ValueError("Unterminated JSON array")
+
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buffer, position = buffer[position:] + chunk, 0
+
+
+def _to_record(record: dict) -> Record:
+    repos = record['repos']
+    # The levels, if any, as `{repo: access}`.
+    repos = dict(repos) if isinstance(repos, dict) else dict.fromkeys(repos)
+    return Record(record['account_id'], record.get('display_name'), repos, list(record.get('groups') or []))
+
+
+def sort_by_account(records: Iterable[Record], chunk_entries: int = DEFAULT_CHUNK_ENTRIES) -> Iterator[Record]:
+    """Sorts records by account id, keeping their order otherwise, with at
+    most about `chunk_entries` users, repositories and groups in memory: an
+    external merge sort over temporary files."""
+    spills = []
+    chunk, entries = [], 0
+    try:
+        for record in records:
+            chunk.append(record)
+            entries += 1 + len(record.repos) + len(record.groups)
+            if entries >= chunk_entries:
+                spills.append(_spill(chunk))
+                chunk, entries = [], 0
+
+        chunk.sort(key=_account_id)
+        if not spills:
+            yield from chunk
+            return
+
+        logger.debug(f"Merging {len(spills) + 1} sorted chunks")
+        # `heapq.merge` is stable: the chunks are in the order of the input.
+        yield from heapq.merge(*(_unspill(spill) for spill in spills), chunk, key=_account_id)
+    finally:
+        for spill in spills:
+            spill.close()
+
+
+def _spill(chunk: List[Record]):
+    spill = tempfile.TemporaryFile('w+')
+    for record in sorted(chunk, key=_account_id):
+        spill.write(json.dumps(record) + '\n')
+    spill.seek(0)
+    return spill
+
+
+def _unspill(spill) -> Iterator[Record]:
+    for line in spill:
+        yield Record(*json.loads(line))
+
+
+def _account_id(record: Record) -> str:
+    return record.account_id
+
+
+def _latest(records: Iterable[Record]) -> Iterator[Record]:
+    # A checkpoint journal may have several records of a user: the last wins.
+    previous = None
+    for record in records:
+        if previous is not None and record.account_id != previous.account_id:
+            yield previous
+        previous = record
+    if previous is not None:
+        yield previous
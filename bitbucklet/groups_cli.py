@@ -2,10 +2,15 @@ import click
 import os
 import logging
 import json
+import sys
 
-import requests
 from requests import HTTPError
+from urllib.parse import quote
 
+from bitbucklet.bulk import execute, summarize, bulk_options
+from bitbucklet.ratelimit import TokenBucket
+from bitbucklet.session import get_session
+from bitbucklet.snapshot import Snapshot, snapshot_options, GROUPS
 from bitbucklet.token import get_access_token, BearerAuth
 from bitbucklet.urls import groups_url
 
@@ -20,35 +25,35 @@ def groups_cli():
 @click.command(name='add', help = 'Add a new group')
 @click.argument('group_name')
 def groups_add(group_name: str):
+    response = create_group(group_name)
+    print(response.text)
+
+def create_group(group_name: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
     # See
     # https://confluence.atlassian.com/bitbucket/groups-endpoint-296093143.html#groupsEndpoint-PUTnewmemberintoagroup
-    response = requests.post(
+    return get_session().post(
         f"{groups_url()}"
             .format(team=bitbucket_team_name),
         auth = BearerAuth(access_token),
         data = f"name={group_name}"
     )
 
-    print(response.text)
-
 @click.command(name='list', help = 'List all groups')
 @click.option('--verbose', is_flag=True, default=False, help="Print JSON output")
-def groups_list(verbose: bool):
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+@snapshot_options(GROUPS)
+def groups_list(verbose: bool, snapshot: Snapshot):
+    if snapshot is not None:
+        groups = snapshot.groups()
+    else:
+        groups = fetch_groups()
 
-    access_token = get_access_token()
-    response = requests.get(
-        groups_url().format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token),
-    )
     if verbose:
-        print(json.dumps(json.loads(response.text), indent=2))
+        print(json.dumps(groups, indent=2))
         return
 
-    groups = response.json()
     [print(group['slug']) for group in groups]
 
 @click.command(name='del', help = 'Delete a group')
@@ -59,7 +64,7 @@ def groups_del(group_name: str):
 
     # See
     # https://confluence.atlassian.com/bitbucket/groups-endpoint-296093143.html#groupsEndpoint-DELETEamember
-    response = requests.delete(
+    response = get_session().delete(
         f"{groups_url()}/{group_name}"
             .format(team=bitbucket_team_name),
         auth = BearerAuth(access_token)
@@ -74,27 +79,21 @@ def groups_del(group_name: str):
 @click.command(name='list-users', help = 'List all the users in a group')
 @click.option('--verbose', is_flag=True, default=False, help="Print JSON output")
 @click.argument('group_name')
-def groups_list_user(verbose: bool, group_name: str):
+@snapshot_options(GROUPS)
+def groups_list_user(verbose: bool, group_name: str, snapshot: Snapshot):
     from tabulate import tabulate
     from itertools import count
 
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
-
-    access_token = get_access_token()
-    response = requests.get(
-        f"{groups_url()}/{group_name}/members".format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token),
-    )
-
-    if response.status_code != 200:
-        raise HTTPError(response.text)
+    members = snapshot.group_members(group_name) if snapshot is not None else None
+    if members is None and snapshot is not None and snapshot.offline:
+        raise click.ClickException(f"Group {group_name} is not in the snapshot")
+    elif members is None:
+        members = fetch_group_members(group_name)
 
     if verbose:
-        print(json.dumps(json.loads(response.text), indent=2))
+        print(json.dumps(members, indent=2))
         return
 
-    members = response.json()
-
     table = [[member['display_name'], member['account_id'], member['uuid'], member['resource_uri']] for member in members ]
     headers = ['display_name', 'account_id', 'uuid', 'resource_uri']
     print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='github'))
@@ -107,14 +106,19 @@ def groups_add_user(group_name: str, username: str):
 
 # extracted it into a private method for re-use in users.py
 def __group_add_user(group_name: str, username: str):
+    response = put_group_member(group_name, username)
+    if response.status_code >= 300:
+        raise HTTPError(response.text, response=response)
+    print(response)
+
+def put_group_member(group_name: str, username: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
     # See
     # https://confluence.atlassian.com/bitbucket/groups-endpoint-296093143.html#groupsEndpoint-PUTnewmemberintoagroup
-    response = requests.put(
-        f"{groups_url()}/{group_name}/members/{username}"
-            .format(team=bitbucket_team_name),
+    return get_session().put(
+        group_member_url(bitbucket_team_name, group_name, username),
         auth = BearerAuth(access_token),
         # Required by the API
         headers = {
@@ -124,33 +128,142 @@ def __group_add_user(group_name: str, username: str):
         data = '{}'
     )
 
-    print(response)
-
 @click.command(name='del-user', help = 'Delete a user from a group')
 @click.argument('group_name')
 @click.argument('username')
 def groups_del_user(group_name: str, username: str):
+    response = delete_group_member(group_name, username)
+    if response.status_code == 204:
+        print('OK')
+        return
+
+    raise HTTPError(response.text)
+
+def delete_group_member(group_name: str, username: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
     # See
     # https://confluence.atlassian.com/bitbucket/groups-endpoint-296093143.html#groupsEndpoint-DELETEamember
-    response = requests.delete(
-        f"{groups_url()}/{group_name}/members/{username}"
-            .format(team=bitbucket_team_name),
+    return get_session().delete(
+        group_member_url(bitbucket_team_name, group_name, username),
         auth = BearerAuth(access_token)
     )
-    if response.status_code == 204:
-        print('OK')
-        return
 
-    raise HTTPError(response.text)
+def group_member_url(team: str, group_name: str, username: str) -> str:
+    # Given to `.format` rather than into the template: a UUID is in braces.
+    return f"{groups_url()}/{{group}}/members/{{user}}".format(
+        team=team,
+        group=quote(group_name, safe=''),
+        user=quote(username, safe=''))
+
+def fetch_group_members(group_name: str) -> list:
+    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+    access_token = get_access_token()
+
+    response = get_session().get(
+        f"{groups_url()}/{group_name}/members".format(team=bitbucket_team_name),
+        auth = BearerAuth(access_token),
+    )
+
+    if response.status_code != 200:
+        raise HTTPError(response.text, response=response)
+
+    return response.json()
+
+def member_identities(member: dict) -> set:
+    """Every id a group member may be referred to by: username, nickname, UUID or account id."""
+    return {str(member[key]) for key in ('username', 'nickname', 'uuid', 'account_id') if member.get(key)}
+
+def fetch_groups() -> list:
+    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+    access_token = get_access_token()
+
+    response = get_session().get(
+        groups_url().format(team=bitbucket_team_name),
+        auth = BearerAuth(access_token),
+    )
+
+    if response.status_code != 200:
+        raise HTTPError(response.text, response=response)
+
+    return response.json()
     
 
+@click.command(name='add-users', help = 'Add many users into a group')
+@click.argument('group_name')
+@click.argument('usernames', nargs=-1)
+@click.option('-f', '--file', 'file', type=click.File('r'), help="Read the usernames from this file, one per line. Use - for stdin.")
+@bulk_options
+def groups_add_users(group_name: str, usernames, file, concurrency: int, rate: float, burst: int):
+    """Adds the users who are not members yet, printing one JSON result per user."""
+    __change_members(group_name, __read_usernames(usernames, file), False, concurrency, rate, burst)
+
+@click.command(name='sync-members', help = 'Make the members of a group exactly the given users')
+@click.argument('group_name')
+@click.argument('usernames', nargs=-1)
+@click.option('-f', '--file', 'file', type=click.File('r'), help="Read the usernames from this file, one per line. Use - for stdin.")
+@bulk_options
+def groups_sync_members(group_name: str, usernames, file, concurrency: int, rate: float, burst: int):
+    """Adds the missing users and removes the members not given, printing one
+    JSON result per user.
+    """
+    __change_members(group_name, __read_usernames(usernames, file), True, concurrency, rate, burst)
+
+def __read_usernames(usernames, file) -> list:
+    usernames = list(usernames)
+    if file is None and not usernames and not sys.stdin.isatty():
+        file = sys.stdin
+    if file is not None:
+        usernames += [line.strip() for line in file if line.strip() and not line.lstrip().startswith('#')]
+    if not usernames:
+        raise click.UsageError("No usernames given")
+    # Keep the order, drop duplicates.
+    return list(dict.fromkeys(usernames))
+
+def __change_members(group_name: str, usernames: list, remove_others: bool, concurrency: int, rate: float, burst: int):
+    members = fetch_group_members(group_name)
+    wanted = set(usernames)
+
+    operations = []
+    for username in usernames:
+        if any(username in member_identities(member) for member in members):
+            print(json.dumps({'username': username, 'action': 'unchanged', 'ok': True}))
+        else:
+            operations.append(('add', username))
+    if remove_others:
+        for member in members:
+            if not member_identities(member) & wanted:
+                operations.append(('remove', member.get('uuid') or member.get('username')))
+
+    def change(operation):
+        action, username = operation
+        if action == 'add':
+            return put_group_member(group_name, username)
+        return delete_group_member(group_name, username)
+
+    results = []
+    for result in execute(operations, change, concurrency, TokenBucket(rate=rate, burst=burst)):
+        action, username = result.item
+        print(json.dumps({
+            'username': username,
+            'action': action,
+            'ok': result.ok,
+            'status': result.status,
+            'detail': result.detail
+        }), flush=True)
+        results.append(result)
+
+    summarize(results)
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
 groups_cli.add_command(groups_add)
 groups_cli.add_command(groups_list)
 groups_cli.add_command(groups_del)
 
 groups_cli.add_command(groups_add_user)
 groups_cli.add_command(groups_list_user)
-groups_cli.add_command(groups_del_user)
\ No newline at end of file
+groups_cli.add_command(groups_del_user)
+groups_cli.add_command(groups_add_users)
+groups_cli.add_command(groups_sync_members)
\ No newline at end of file
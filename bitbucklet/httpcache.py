@@ -0,0 +1,297 @@
+import click
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from bitbucklet import instrumentation
+from bitbucklet.config import cache_dir
+from bitbucklet.singleflight import resource_of, is_affected
+
+logger = logging.getLogger("httpcache")
+
+# Seconds a response is served from the disk without asking BitBucket, per
+# endpoint as named by `instrumentation.endpoint_of`, or per template. Past
+# it, the response is revalidated when it has an ETag or a Last-Modified.
+DEFAULT_TTL = 300
+ENDPOINT_TTLS = {
+    # The UUID of a team never changes.
+    'teams_url': 86400,
+    'teams_url/members': 600,
+    'projects_url': 3600,
+    'repos_url': 600,
+}
+
+# In MiB. The least recently used responses are evicted beyond.
+DEFAULT_MAX_SIZE = 100
+
+# Response headers stored along the body. The body is stored decoded, so
+# `Content-Encoding` is not.
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    team TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    url TEXT NOT NULL,
+    stored_at REAL NOT NULL,
+    used_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+"""
+
+
+def default_path() -> Path:
+    return cache_dir() / 'http-cache.sqlite'
+
+
+def is_enabled() -> bool:
+    return os.getenv('BITBUCKLET_HTTP_CACHE', '0') == '1'
+
+
+class HttpCache:
+    """A disk cache of GET responses, shared by the processes of the current
+    user and kept per team and credentials.
+
+    Opt-in with `BITBUCKLET_HTTP_CACHE=1`. `BITBUCKLET_HTTP_CACHE_TTL` sets the
+    default TTL, `BITBUCKLET_HTTP_CACHE_TTLS` the TTL of some endpoints (i.e
+    `groups_url=60,repos_url=3600`) and `BITBUCKLET_HTTP_CACHE_SIZE` its size
+    in MiB.
+    """
+
+    def __init__(self, path: Path, ttls: Dict[str, float] = None, default_ttl: float = DEFAULT_TTL,
+                 max_size: int = DEFAULT_MAX_SIZE * 1024 * 1024):
+        self._path = path
+        self.ttls = dict(ENDPOINT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=5)
+        os.chmod(path, 0o600)
+        # Lets other processes read while one writes.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+
+    @classmethod
+    def from_environment(cls) -> 'HttpCache':
+        ttls = {}
+        for pair in (os.getenv('BITBUCKLET_HTTP_CACHE_TTLS') or '').split(','):
+            if '=' in pair:
+                endpoint, ttl = pair.split('=', 1)
+                ttls[endpoint.strip()] = float(ttl)
+        return cls(
+            default_path(),
+            ttls = ttls,
+            default_ttl = float(os.getenv('BITBUCKLET_HTTP_CACHE_TTL') or DEFAULT_TTL),
+            max_size = int(float(os.getenv('BITBUCKLET_HTTP_CACHE_SIZE') or DEFAULT_MAX_SIZE) * 1024 * 1024),
+        )
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def ttl_of(self, endpoint: str) -> float:
+        if endpoint in self.ttls:
+            return self.ttls[endpoint]
+        return self.ttls.get(endpoint.split('/')[0], self.default_ttl)
+
+    def fetch(self, url: str, send: Callable[[dict], requests.Response]) -> requests.Response:
+        """Returns the response to a GET of `url`, from the disk while it is
+        fresh, otherwise from `send(headers)` given the conditional headers
+        revalidating the stored response, if any.
+
+        Only the endpoints of `bitbucklet.urls` are cached, and only their
+        200 responses.
+        """
+        endpoint = instrumentation.endpoint_of(url)
+        if not endpoint.split('/')[0].endswith('_url'):
+            return send({})
+
+        key = _key_of(url)
+        try:
+            stored = self.__load(key)
+        except sqlite3.Error as e:
+            logger.warning(f"Ignore the HTTP cache {self._path}: {e}")
+            return send({})
+
+        now = time.time()
+        if stored is not None and now - stored['stored_at'] <= self.ttl_of(endpoint):
+            self.__touch(key, now)
+            instrumentation.record_saved('disk cache')
+            return _to_response(url, stored)
+
+        validators = {}
+        if stored is not None:
+            if stored['headers'].get('ETag'):
+                validators['If-None-Match'] = stored['headers']['ETag']
+            if stored['headers'].get('Last-Modified'):
+                validators['If-Modified-Since'] = stored['headers']['Last-Modified']
+
+        response = send(validators)
+        if response.status_code == 304 and validators:
+            self.__touch(key, now, revalidated=True)
+            return _to_response(url, stored)
+        if response.status_code == 200:
+            self.__store(key, endpoint, url, response, now)
+        return response
+
+    def invalidate(self, url: str):
+        """Forgets the responses which a write to `url` may change."""
+        written = resource_of(url)
+        try:
+            with self._lock, self._db:
+                rows = self._db.execute("SELECT key, resource FROM responses WHERE team = ?", (_team(),)).fetchall()
+                stale = [(key,) for key, resource in rows if is_affected(tuple(json.loads(resource)), written)]
+                self._db.executemany("DELETE FROM responses WHERE key = ?", stale)
+        except sqlite3.Error as e:
+            logger.warning(f"Fail to invalidate the HTTP cache {self._path}: {e}")
+
+    def stats(self) -> list:
+        """Returns `(team, endpoint, responses, bytes, hits, oldest stored_at)` per team and endpoint."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT team, endpoint, COUNT(*), SUM(size), SUM(hits), MIN(stored_at) FROM responses"
+                " GROUP BY team, endpoint ORDER BY team, endpoint").fetchall()
+
+    def clear(self, team: str = None) -> int:
+        with self._lock, self._db:
+            if team is None:
+                return self._db.execute("DELETE FROM responses").rowcount
+            return self._db.execute("DELETE FROM responses WHERE team = ?", (team,)).rowcount
+
+    def __load(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT stored_at, headers, body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        stored_at, headers, body = row
+        return {'stored_at': stored_at, 'headers': json.loads(headers), 'body': body}
+
+    def __touch(self, key: str, now: float, revalidated: bool = False):
+        try:
+            with self._lock, self._db:
+                if revalidated:
+                    self._db.execute("UPDATE responses SET stored_at = ?, used_at = ?, hits = hits + 1 WHERE key = ?", (now, now, key))
+                else:
+                    self._db.execute("UPDATE responses SET used_at = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            logger.debug(f"Fail to touch {key} in the HTTP cache: {e}")
+
+    def __store(self, key: str, endpoint: str, url: str, response: requests.Response, now: float):
+        headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+        body = response.content or b''
+        try:
+            with self._lock, self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, team, endpoint, resource, url, stored_at, used_at, headers, body, size)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, _team(), endpoint, json.dumps(resource_of(url)), url, now, now, json.dumps(headers), body, len(body)))
+                self.__evict()
+        except sqlite3.Error as e:
+            logger.warning(f"Fail to store {url} into the HTTP cache: {e}")
+
+    def __evict(self):
+        (size,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if size <= self.max_size:
+            return
+        evicted = []
+        for key, entry_size in self._db.execute("SELECT key, size FROM responses ORDER BY used_at"):
+            if size <= self.max_size:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        logger.debug(f"Evicted {len(evicted)} responses from the HTTP cache")
+
+
+def _team() -> str:
+    return os.getenv('BITBUCKET_TEAM') or ''
+
+
+def _identity() -> str:
+    # The credentials the responses were fetched with: those of another OAuth
+    # consumer or browser session may not see the same, if anything.
+    credentials = f"{os.getenv('BITBUCKET_CLIENT_ID') or ''}\0{os.getenv('BITBUCKET_CLOUD_SESSION') or ''}"
+    return hashlib.sha256(credentials.encode()).hexdigest()
+
+
+def _key_of(url: str) -> str:
+    return hashlib.sha256(f"{_team()}\0{_identity()}\0{url}".encode()).hexdigest()
+
+
+def _to_response(url: str, stored: dict) -> requests.Response:
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.url = url
+    response.headers = CaseInsensitiveDict(stored['headers'])
+    response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+    response._content = stored['body']
+    return response
+
+
+@click.group(name='cache', help='Inspect or clear the HTTP response cache')
+def cache_cli():
+    pass
+
+
+@click.command(name='stats', help='Show the responses cached, per team and endpoint')
+def cache_stats():
+    from tabulate import tabulate
+
+    path = default_path()
+    if not is_enabled():
+        click.echo("The HTTP cache is disabled. Set BITBUCKLET_HTTP_CACHE=1 to enable it.", err=True)
+    if not path.exists():
+        print(f"No cache at {path}")
+        return
+
+    now = time.time()
+    with HttpCache.from_environment() as cache:
+        rows = [[team, endpoint, count, round(size / 1024, 1), hits, round(now - oldest), cache.ttl_of(endpoint)]
+            for team, endpoint, count, size, hits, oldest in cache.stats()]
+
+    headers = ['team', 'endpoint', 'responses', 'KiB', 'hits', 'oldest s', 'ttl s']
+    if rows:
+        print(tabulate(rows, headers=headers, tablefmt='github') + '\n')
+    total = sum(row[3] for row in rows)
+    print(f"{sum(row[2] for row in rows)} responses, {total / 1024:.1f} MiB of {cache.max_size / 1024 / 1024:.1f} MiB in {path}")
+
+
+@click.command(name='clear', help='Forget the cached responses')
+@click.option('--team', default=None, help="Only forget the responses of this team")
+def cache_clear(team: str):
+    path = default_path()
+    if not path.exists():
+        print(f"No cache at {path}")
+        return
+
+    with HttpCache.from_environment() as cache:
+        print(f"Forgot {cache.clear(team)} responses")
+
+
+cache_cli.add_command(cache_stats)
+cache_cli.add_command(cache_clear)
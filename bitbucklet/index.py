@@ -0,0 +1,91 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+# Access levels, from the lowest to the highest.
+LEVELS = ('read', 'write', 'admin')
+RANKS = {level: rank for rank, level in enumerate(LEVELS)}
+
+
+class Principal(NamedTuple):
+    """A user who can access a repository, and how."""
+    uuid: str
+    display_name: str
+    account_id: str
+    access: str
+    # `direct` and/or `group:<slug>`
+    via: tuple
+
+
+class PermissionIndex:
+    """An in-memory index of the effective access of every user on every
+    repository, expanding group privileges through group memberships.
+
+    Build it with `PermissionIndex.build` from the team-wide privileges and
+    the group members, either fetched live or read from a snapshot. Lookups
+    by repository (`who_can`) and by user and repository (`access_of`) are
+    dictionary lookups.
+    """
+
+    def __init__(self):
+        # repo -> user uuid -> (access rank, via)
+        self._by_repo: Dict[str, Dict[str, tuple]] = {}
+        # uuid -> user object
+        self._users: Dict[str, dict] = {}
+
+    @classmethod
+    def build(cls, group_privileges: Iterable[dict], user_privileges: Iterable[dict], group_members: Dict[str, List[dict]]) -> 'PermissionIndex':
+        """Builds the index.
+
+        `group_privileges` and `user_privileges` are in the shape returned by
+        `repos.fetch_team_group_privileges` / `fetch_team_user_privileges`, and
+        `group_members` maps each group slug to its members.
+        """
+        index = cls()
+        for privilege in group_privileges:
+            slug = privilege['group']['slug']
+            for member in group_members.get(slug, []):
+                index._grant(privilege['repo'], member, privilege['privilege'], f"group:{slug}")
+        for privilege in user_privileges:
+            index._grant(privilege['repo'], privilege['user'], privilege['privilege'], 'direct')
+        return index
+
+    def _grant(self, repo: str, user: dict, access: str, via: str):
+        key = user.get('uuid') or user.get('account_id') or user.get('username')
+        self._users.setdefault(key, user)
+        users = self._by_repo.setdefault(repo, {})
+        rank = RANKS[access]
+        current = users.get(key)
+        if current is None:
+            users[key] = (rank, (via,))
+        else:
+            users[key] = (max(current[0], rank), current[1] + (via,))
+
+    def repos(self) -> Set[str]:
+        return set(self._by_repo)
+
+    def who_can(self, repo: str, access: str = 'read') -> List[Principal]:
+        """Lists the users having at least `access` on `repo`, highest access first."""
+        minimum = RANKS[access]
+        principals = [self.__principal(key, rank, via)
+            for key, (rank, via) in self._by_repo.get(repo, {}).items()
+            if rank >= minimum]
+        return sorted(principals, key=lambda p: (-RANKS[p.access], p.display_name or ''))
+
+    def access_of(self, user: str, repo: str) -> Optional[str]:
+        """Returns the effective access of a user (by UUID) on a repo, or `None`."""
+        entry = self._by_repo.get(repo, {}).get(user)
+        return LEVELS[entry[0]] if entry else None
+
+    def accesses_by_account(self) -> Dict[str, Dict[str, str]]:
+        """Returns the effective access of every user on every repository, as
+        `{account_id: {repo: access}}`."""
+        accesses: Dict[str, Dict[str, str]] = {}
+        for repo, users in self._by_repo.items():
+            for key, (rank, _) in users.items():
+                account_id = self._users[key].get('account_id')
+                if account_id:
+                    accesses.setdefault(account_id, {})[repo] = LEVELS[rank]
+        return accesses
+
+    def __principal(self, key: str, rank: int, via: tuple) -> Principal:
+        user = self._users[key]
+        return Principal(key, user.get('display_name'), user.get('account_id'), LEVELS[rank], via)
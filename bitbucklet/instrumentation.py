@@ -0,0 +1,205 @@
+import functools
+import json
+import re
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+# Upper bounds, in milliseconds, of the latency histogram buckets. The last
+# bucket is unbounded.
+LATENCY_BUCKETS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Path segments kept as is after an endpoint template, e.g `teams_url/members`.
+# Any other segment is an identifier and becomes `*`.
+KNOWN_SEGMENTS = frozenset(['members'])
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, status: Optional[int], elapsed: float, bytes_sent: int, bytes_received: int, retries: int):
+        self.count += 1
+        if status is None or status >= 400:
+            self.errors += 1
+        if status == 429:
+            self.rate_limited += 1
+        self.retries += retries
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.histogram[_bucket_of(elapsed * 1000)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Returns the upper bound, in ms, of the bucket holding the `fraction`
+        percentile. Only the max is known beyond the last bound."""
+        rank, seen = fraction * self.count, 0
+        for index, count in enumerate(self.histogram):
+            seen += count
+            if seen >= rank and count:
+                bound = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float('inf')
+                return min(bound, self.max_time * 1000)
+        return 0.0
+
+
+class Recorder:
+    """Collects the outbound requests of this process, per endpoint template,
+    and optionally writes one JSON line per request into a trace file.
+
+    Thread-safe: the bulk commands send from many threads.
+    """
+
+    def __init__(self, trace_file=None):
+        self.started_at = time.time()
+        self.endpoints: Dict[str, EndpointStats] = {}
+        self.rate_limit_wait = 0.0
+        # reason -> number of requests not sent, see `bitbucklet.singleflight`.
+        self.saved: Dict[str, int] = {}
+        self._trace_file = trace_file
+        self._lock = threading.Lock()
+
+    def record(self, method: str, url: str, status: Optional[int], elapsed: float,
+               bytes_sent: int = 0, bytes_received: int = 0, retries: int = 0, error: str = None):
+        endpoint = endpoint_of(url)
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.add(status, elapsed, bytes_sent, bytes_received, retries)
+            self.__trace({
+                'method': method,
+                'url': url,
+                'endpoint': endpoint,
+                'status': status,
+                'elapsed_ms': round(elapsed * 1000, 1),
+                'bytes_sent': bytes_sent,
+                'bytes_received': bytes_received,
+                'retries': retries,
+                'error': error,
+            })
+
+    def record_wait(self, seconds: float, reason: str):
+        with self._lock:
+            self.rate_limit_wait += seconds
+            self.__trace({'event': 'wait', 'reason': reason, 'seconds': round(seconds, 3)})
+
+    def record_saved(self, reason: str):
+        with self._lock:
+            self.saved[reason] = self.saved.get(reason, 0) + 1
+
+    def __trace(self, event: dict):
+        if self._trace_file is not None:
+            event = dict(ts=round(time.time(), 3), thread=threading.current_thread().name, **event)
+            self._trace_file.write(json.dumps(event) + '\n')
+
+    def close(self):
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+    def print_summary(self, file=None):
+        from tabulate import tabulate
+
+        file = file or sys.stderr
+
+        headers = ['endpoint', 'requests', 'errors', '429', 'retries', 'KiB in', 'KiB out', 'total s', 'mean ms', 'p50 ms', 'p95 ms', 'max ms']
+        rows = []
+        for endpoint, stats in sorted(self.endpoints.items(), key=lambda item: -item[1].total_time):
+            rows.append([
+                endpoint, stats.count, stats.errors, stats.rate_limited, stats.retries,
+                round(stats.bytes_received / 1024, 1), round(stats.bytes_sent / 1024, 1),
+                round(stats.total_time, 2), round(stats.total_time / stats.count * 1000),
+                round(stats.percentile(0.5)), round(stats.percentile(0.95)), round(stats.max_time * 1000),
+            ])
+        if rows:
+            print(tabulate(rows, headers=headers, tablefmt='github') + '\n', file=file)
+
+        total = sum(stats.count for stats in self.endpoints.values())
+        print(f"{total} requests in {time.time() - self.started_at:.2f}s, "
+              f"{self.rate_limit_wait:.2f}s waiting for the rate limit", file=file)
+        if self.saved:
+            print("Not sent: " + ', '.join(f"{count} {reason}" for reason, count in sorted(self.saved.items())), file=file)
+
+
+_recorder: Optional[Recorder] = None
+
+
+def enable(trace_path: str = None) -> Recorder:
+    """Starts recording the requests of this process, and tracing them into
+    `trace_path` when given."""
+    global _recorder
+    trace_file = open(trace_path, 'w', buffering=1) if trace_path else None
+    _recorder = Recorder(trace_file)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+def get_recorder() -> Optional[Recorder]:
+    return _recorder
+
+
+def record_wait(seconds: float, reason: str = 'rate limit'):
+    recorder = _recorder
+    if recorder is not None and seconds > 0:
+        recorder.record_wait(seconds, reason)
+
+
+def record_saved(reason: str):
+    recorder = _recorder
+    if recorder is not None:
+        recorder.record_saved(reason)
+
+
+def endpoint_of(url: str) -> str:
+    """Names the endpoint of `url` after the template of `bitbucklet.urls` it
+    was built from, e.g `groups_url/*/members` for the members of a group."""
+    parts = urlsplit(url)
+    location = f"{parts.scheme}://{parts.netloc}{parts.path}".rstrip('/')
+    for name, pattern in _templates():
+        match = pattern.match(location)
+        if match:
+            rest = [segment if segment in KNOWN_SEGMENTS else '*'
+                for segment in (match.group('rest') or '').split('/') if segment]
+            return '/'.join([name] + rest)
+    return f"{parts.netloc}{parts.path}"
+
+
+def _templates() -> List[tuple]:
+    # The base URLs can be overridden at any time: only the compilation is cached.
+    from bitbucklet import urls
+
+    return _compile(tuple(
+        (name, getattr(urls, name)().split('?')[0].rstrip('/'))
+        for name in dir(urls) if name.endswith('_url')))
+
+
+@functools.lru_cache(maxsize=4)
+def _compile(templates: tuple) -> List[tuple]:
+    compiled = []
+    # The most specific first, e.g `repo_groups_privileges_url` before `team_groups_privileges_url`.
+    for name, template in sorted(templates, key=lambda template: -template[1].count('/')):
+        regex = re.sub(r'\\\{\w+\\\}', '[^/]+', re.escape(template))
+        compiled.append((name, re.compile(f"^{regex}(?P<rest>/.*)?$")))
+    return compiled
+
+
+def _bucket_of(milliseconds: float) -> int:
+    for index, bound in enumerate(LATENCY_BUCKETS):
+        if milliseconds <= bound:
+            return index
+    return len(LATENCY_BUCKETS)
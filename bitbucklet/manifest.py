@@ -0,0 +1,103 @@
+import csv
+import fnmatch
+import json
+from pathlib import Path
+from typing import Iterable, List, NamedTuple
+
+import click
+
+ACCESSES = ('read', 'write', 'admin', 'none')
+PRINCIPAL_TYPES = ('user', 'group')
+FIELDS = ['principal', 'repo', 'access']
+
+
+class Grant(NamedTuple):
+    """One line of a permission manifest.
+
+    `principal` is either `user:<account id or uuid>` or `group:<slug>`.
+    `access` is `none` to revoke any access of the principal.
+    """
+    principal_type: str
+    principal: str
+    repo: str
+    access: str
+
+    def principal_ref(self) -> str:
+        return f"{self.principal_type}:{self.principal}"
+
+
+def read_manifest(path: str) -> List[Grant]:
+    """Reads a manifest of `(principal, repo, access)` from a CSV or, given
+    PyYAML is installed, a YAML file (a list of mappings with the same keys).
+
+    Example (CSV):
+
+        principal,repo,access
+        group:developers,awesome-*,write
+        user:557058:c0b7...,legacy-repo,none
+    """
+    if path.endswith(('.yml', '.yaml')):
+        rows = read_document(path) or []
+    else:
+        with click.open_file(path) as f:
+            rows = list(csv.DictReader(line for line in f if not line.lstrip().startswith('#')))
+
+    return [__parse_row(row, index) for index, row in enumerate(rows, start=1)]
+
+
+def read_document(path: str):
+    """Loads a JSON or, given PyYAML is installed, a YAML document."""
+    if path.endswith(('.yml', '.yaml')):
+        try:
+            import yaml
+        except ImportError:
+            raise click.ClickException(f"Reading {path} requires PyYAML: pip install pyyaml")
+        with click.open_file(path) as f:
+            return yaml.safe_load(f)
+
+    with click.open_file(path) as f:
+        try:
+            return json.load(f)
+        except ValueError as e:
+            raise click.ClickException(f"{path} is not a valid JSON document: {e}")
+
+
+def __parse_row(row: dict, index: int) -> Grant:
+    try:
+        principal, repo, access = (str(row[field]).strip() for field in FIELDS)
+    except (KeyError, TypeError):
+        raise click.ClickException(f"Line {index}: expected the fields {', '.join(FIELDS)}")
+
+    principal_type, _, principal_id = principal.partition(':')
+    if principal_type not in PRINCIPAL_TYPES or not principal_id:
+        raise click.ClickException(f"Line {index}: principal must be user:<id> or group:<slug>, not {principal!r}")
+
+    access = access.lower()
+    if access not in ACCESSES:
+        raise click.ClickException(f"Line {index}: access must be one of {', '.join(ACCESSES)}, not {access!r}")
+
+    return Grant(principal_type, principal_id, repo, access)
+
+
+def has_glob(repo: str) -> bool:
+    return any(c in repo for c in '*?[')
+
+
+def expand_globs(grants: Iterable[Grant], repo_slugs: Iterable[str]) -> List[Grant]:
+    """Replaces every grant whose repo is a glob by one grant per matching repository."""
+    repo_slugs = sorted(repo_slugs)
+    expanded = []
+    for grant in grants:
+        if not has_glob(grant.repo):
+            expanded.append(grant)
+            continue
+        expanded.extend(grant._replace(repo=slug) for slug in fnmatch.filter(repo_slugs, grant.repo))
+    return expanded
+
+
+def write_manifest(grants: Iterable[Grant], path: Path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for grant in grants:
+            writer.writerow([grant.principal_ref(), grant.repo, grant.access])
@@ -0,0 +1,227 @@
+import logging
+import struct
+import zlib
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from bitbucklet.index import LEVELS
+
+logger = logging.getLogger("matrix")
+
+# A compact, self-contained encoding of the accesses of every user of a team:
+#
+#   header   MAGIC, VERSION, then the number of users, repositories and groups
+#            (little-endian unsigned 32-bit integers)
+#   payload  zlib-compressed:
+#            - the repository names, group slugs, account ids and display
+#              names, each list as one length-prefixed blob of NUL-separated
+#              UTF-8 strings
+#            - per user, 2 bits per repository: 0 for no access, otherwise
+#              1 + the rank of the access in `LEVELS`
+#            - per user, 1 bit per group
+#
+# Users are sorted by account id, repositories and groups by name, so that two
+# exports can be merged without sorting them again.
+MAGIC = b'BBAM'
+VERSION = 1
+HEADER = struct.Struct('<4sBIII')
+LENGTH = struct.Struct('<I')
+
+# 2 bits per repository.
+REPOS_PER_BYTE = 4
+
+# The access codes of the 4 repositories of every byte.
+_CODES = [tuple(byte >> (2 * shift) & 3 for shift in range(REPOS_PER_BYTE)) for byte in range(256)]
+
+
+class AccessMatrixError(ValueError):
+    pass
+
+
+class AccessMatrix:
+    """The user × repository × access level matrix of a team, with the groups
+    of every user, written by `accesses list-all --format matrix`.
+
+    Loading one is decompressing it and splitting its names: the rows are
+    decoded on lookup. `records` yields the same tuples as
+    `accesses.iter_all_user_accesses`.
+    """
+
+    def __init__(self, repos: List[str], groups: List[str], users: List[Tuple[str, str]], accesses: bytes, memberships: bytes):
+        # `users` are `(account_id, display_name)`.
+        self.repos = repos
+        self.groups = groups
+        self.users = users
+        self._accesses = accesses
+        self._memberships = memberships
+        self._access_row = -(-len(repos) // REPOS_PER_BYTE)
+        self._group_row = -(-len(groups) // 8)
+        self._user_index = {account_id: i for i, (account_id, _) in enumerate(users)}
+        self._repo_index = {repo: j for j, repo in enumerate(repos)}
+
+    @classmethod
+    def build(cls, all_member_accesses: Iterable[Tuple[str, str, List[str], List[str]]],
+              access_of: Callable[[str, str], Optional[str]] = None) -> 'AccessMatrix':
+        """Builds the matrix from `(display_name, account_id, repos, groups)`
+        tuples, as yielded by `accesses.iter_all_user_accesses`.
+
+        `access_of(account_id, repo)` returns the level of an access; the
+        accesses it does not know, or all without it, are `read`, with a
+        warning in the former case. A level not in `LEVELS` raises an
+        `AccessMatrixError`.
+        """
+        records = sorted(all_member_accesses, key=lambda record: record[1])
+        repos = sorted({repo for record in records for repo in record[2]})
+        groups = sorted({group for record in records for group in record[3]})
+        repo_index = {repo: j for j, repo in enumerate(repos)}
+        group_index = {group: k for k, group in enumerate(groups)}
+        access_row = -(-len(repos) // REPOS_PER_BYTE)
+        group_row = -(-len(groups) // 8)
+
+        accesses = bytearray(access_row * len(records))
+        memberships = bytearray(group_row * len(records))
+        unknown = 0
+        for i, (_, account_id, user_repos, user_groups) in enumerate(records):
+            for repo in user_repos:
+                level = access_of(account_id, repo) if access_of else LEVELS[0]
+                if level is None:
+                    unknown += 1
+                    level = LEVELS[0]
+                elif level not in LEVELS:
+                    raise AccessMatrixError(f"Unknown access level {level!r} of {account_id} on {repo}")
+                j = repo_index[repo]
+                accesses[i * access_row + j // REPOS_PER_BYTE] |= (LEVELS.index(level) + 1) << (2 * (j % REPOS_PER_BYTE))
+            for group in user_groups:
+                k = group_index[group]
+                memberships[i * group_row + k // 8] |= 1 << (k % 8)
+
+        if unknown:
+            logger.warning(f"The level of {unknown} accesses is unknown, written as {LEVELS[0]}")
+        users = [(account_id, display_name or '') for display_name, account_id, _, _ in records]
+        return cls(repos, groups, users, bytes(accesses), bytes(memberships))
+
+    @classmethod
+    def load(cls, path: str) -> 'AccessMatrix':
+        with open(path, 'rb') as f:
+            return cls.read(f)
+
+    @classmethod
+    def read(cls, file: BinaryIO) -> 'AccessMatrix':
+        header = file.read(HEADER.size)
+        if len(header) != HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise AccessMatrixError("Not an access matrix")
+        _, version, user_count, repo_count, group_count = HEADER.unpack(header)
+        if version != VERSION:
+            raise AccessMatrixError(f"Unsupported access matrix version {version}")
+
+        try:
+            payload = memoryview(zlib.decompress(file.read()))
+        except zlib.error as e:
+            raise AccessMatrixError(f"Corrupted access matrix: {e}")
+
+        offset = 0
+        names = []
+        for count in (repo_count, group_count, user_count, user_count):
+            (length,) = LENGTH.unpack_from(payload, offset)
+            offset += LENGTH.size
+            blob = bytes(payload[offset:offset + length]).decode('utf-8')
+            offset += length
+            names.append(blob.split('\0') if count else [])
+        repos, groups, account_ids, display_names = names
+        if (len(repos), len(groups), len(account_ids)) != (repo_count, group_count, user_count):
+            raise AccessMatrixError("Corrupted access matrix: unexpected number of names")
+
+        access_size = -(-repo_count // REPOS_PER_BYTE) * user_count
+        accesses = bytes(payload[offset:offset + access_size])
+        memberships = bytes(payload[offset + access_size:])
+        return cls(repos, groups, list(zip(account_ids, display_names)), accesses, memberships)
+
+    def dump(self, path: str):
+        with open(path, 'wb') as f:
+            self.write(f)
+
+    def write(self, file: BinaryIO):
+        file.write(HEADER.pack(MAGIC, VERSION, len(self.users), len(self.repos), len(self.groups)))
+        compressor = zlib.compressobj(9)
+        names = (self.repos, self.groups, [account_id for account_id, _ in self.users], [display_name for _, display_name in self.users])
+        for strings in names:
+            blob = '\0'.join(string.replace('\0', '') for string in strings).encode('utf-8')
+            file.write(compressor.compress(LENGTH.pack(len(blob)) + blob))
+        file.write(compressor.compress(self._accesses))
+        file.write(compressor.compress(self._memberships))
+        file.write(compressor.flush())
+
+    # Lookups
+
+    def access_of(self, account_id: str, repo: str) -> Optional[str]:
+        """Returns the access of a user on a repository, or `None`."""
+        i, j = self._user_index.get(account_id), self._repo_index.get(repo)
+        if i is None or j is None:
+            return None
+        return self.__level(i, j)
+
+    def repos_of(self, account_id: str) -> Dict[str, str]:
+        """Returns the access of a user on every repository they can access."""
+        i = self._user_index.get(account_id)
+        if i is None:
+            return {}
+        return {repo: level for repo, level in zip(self.repos, self.__row(i)) if level}
+
+    def users_of(self, repo: str) -> Dict[str, str]:
+        """Returns the access on a repository of every user who can access it, by account id."""
+        j = self._repo_index.get(repo)
+        if j is None:
+            return {}
+        accesses = {}
+        for i, (account_id, _) in enumerate(self.users):
+            level = self.__level(i, j)
+            if level:
+                accesses[account_id] = level
+        return accesses
+
+    def groups_of(self, account_id: str) -> List[str]:
+        i = self._user_index.get(account_id)
+        if i is None:
+            return []
+        row = self._memberships[i * self._group_row:(i + 1) * self._group_row]
+        return [group for k, group in enumerate(self.groups) if row[k // 8] >> (k % 8) & 1]
+
+    def records(self) -> Iterator[Tuple[str, str, List[str], List[str]]]:
+        """Yields `(display_name, account_id, repos, groups)` for every user, by account id."""
+        for account_id, display_name in self.users:
+            yield (display_name, account_id, list(self.repos_of(account_id)), self.groups_of(account_id))
+
+    def to_arrow(self):
+        """Returns the accesses as a `pyarrow.Table` of dictionary-encoded
+        `account_id`, `display_name`, `repo` and `access` columns, one row per
+        access. Requires pyarrow."""
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError("AccessMatrix.to_arrow requires pyarrow: pip install pyarrow")
+
+        user_indices, repo_indices, level_indices = [], [], []
+        for i in range(len(self.users)):
+            for j, level in enumerate(self.__row(i)):
+                if level:
+                    user_indices.append(i)
+                    repo_indices.append(j)
+                    level_indices.append(LEVELS.index(level))
+
+        account_ids = pyarrow.array([account_id for account_id, _ in self.users])
+        display_names = pyarrow.array([display_name for _, display_name in self.users])
+        users = pyarrow.array(user_indices, pyarrow.int32())
+        return pyarrow.table({
+            'account_id': pyarrow.DictionaryArray.from_arrays(users, account_ids),
+            'display_name': pyarrow.DictionaryArray.from_arrays(users, display_names),
+            'repo': pyarrow.DictionaryArray.from_arrays(pyarrow.array(repo_indices, pyarrow.int32()), pyarrow.array(self.repos)),
+            'access': pyarrow.DictionaryArray.from_arrays(pyarrow.array(level_indices, pyarrow.int8()), pyarrow.array(LEVELS)),
+        })
+
+    def __level(self, i: int, j: int) -> Optional[str]:
+        code = self._accesses[i * self._access_row + j // REPOS_PER_BYTE] >> (2 * (j % REPOS_PER_BYTE)) & 3
+        return LEVELS[code - 1] if code else None
+
+    def __row(self, i: int) -> List[Optional[str]]:
+        row = self._accesses[i * self._access_row:(i + 1) * self._access_row]
+        codes = [code for byte in row for code in _CODES[byte]]
+        return [LEVELS[code - 1] if code else None for code in codes[:len(self.repos)]]
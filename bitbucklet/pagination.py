@@ -0,0 +1,114 @@
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Tuple
+
+from requests import HTTPError
+
+from bitbucklet.ratelimit import inheriting
+from bitbucklet.session import get_session
+
+logger = logging.getLogger("pagination")
+
+# The maximum `pagelen` accepted by most of BitBucket Cloud API 2.0 endpoints.
+MAX_PAGELEN = 100
+
+# Put by a crawler of `paginate_concurrently` once its query is exhausted.
+_DONE = object()
+
+
+def __get_page(url: str, params: dict, options: dict) -> dict:
+    response = get_session().get(url, params=params, **options)
+    if response.status_code != 200:
+        logger.error(response.text)
+        raise HTTPError(f"Fail to obtain page {url}", response=response)
+    return response.json()
+
+
+def iter_pages(url: str, params: dict = None, pagelen: int = MAX_PAGELEN, prefetch: bool = False, **options) -> Iterator[dict]:
+    """Lazily yields the pages of a BitBucket Cloud API 2.0 paged response
+    by following their `next` links.
+
+    When `prefetch` is set, the next page is requested in background while the
+    current one is being consumed. `options` (i.e `auth`, `cookies`) are passed
+    along to every request.
+
+    References:
+    ====
+
+    https://developer.atlassian.com/cloud/bitbucket/rest/intro/#pagination
+    """
+    params = dict(params or {})
+    params.setdefault('pagelen', pagelen)
+
+    if not prefetch:
+        while url:
+            page = __get_page(url, params, options)
+            yield page
+            # `next` already carries the query parameters.
+            url, params = page.get('next'), None
+        return
+
+    get_page = inheriting(__get_page)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(get_page, url, params, options)
+        while pending is not None:
+            page = pending.result()
+            next_url = page.get('next')
+            pending = executor.submit(get_page, next_url, None, options) if next_url else None
+            yield page
+
+
+def paginate(url: str, params: dict = None, pagelen: int = MAX_PAGELEN, prefetch: bool = False, **options) -> Iterator[dict]:
+    """Lazily yields every item in `values` across all the pages. See `iter_pages`."""
+    for page in iter_pages(url, params, pagelen=pagelen, prefetch=prefetch, **options):
+        yield from page.get('values', [])
+
+
+def paginate_concurrently(queries: Iterable[Tuple[str, dict]], concurrency: int, pagelen: int = MAX_PAGELEN, **options) -> Iterator[dict]:
+    """Lazily yields every item of many paged queries, given as `(url, params)`,
+    following up to `concurrency` of them at once. See `iter_pages`.
+
+    Items are yielded as their pages arrive, so the queries are interleaved
+    page by page. At most a couple of pages per crawler are held in memory,
+    however slowly they are consumed. The first failing query raises.
+    """
+    queries = list(queries)
+    pages = queue.Queue(maxsize=2 * concurrency)
+    stopped = threading.Event()
+
+    def crawl(url: str, params: dict):
+        try:
+            if stopped.is_set():
+                return
+            for page in iter_pages(url, params, pagelen=pagelen, **options):
+                if stopped.is_set():
+                    return
+                pages.put(page.get('values', []))
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(_DONE)
+
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    for url, params in queries:
+        executor.submit(inheriting(crawl), url, params)
+
+    remaining = len(queries)
+    try:
+        while remaining:
+            values = pages.get()
+            if values is _DONE:
+                remaining -= 1
+            elif isinstance(values, Exception):
+                raise values
+            else:
+                yield from values
+    finally:
+        # Make the crawlers give up, unblocking those waiting for room.
+        stopped.set()
+        while remaining:
+            if pages.get() is _DONE:
+                remaining -= 1
+        executor.shutdown(wait=True)
@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Callable, Iterator, Optional
+
+from bitbucklet import instrumentation
+
+logger = logging.getLogger("ratelimit")
+
+# BitBucket Cloud allows roughly 1000 requests per hour per resource
+# for authenticated calls. The internal endpoints used by `accesses`
+# seem to be stricter, so the defaults are conservative.
+DEFAULT_RATE = 2.0
+DEFAULT_BURST = 5
+DEFAULT_CONCURRENCY = 4
+
+# How many times a request refused with 429 is sent.
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """A thread-safe token bucket.
+
+    Every outbound request must `acquire()` a token first. Tokens are refilled
+    at `rate` per second up to `burst`. When the server answers with a 429,
+    `penalize()` pauses every caller and halves the effective rate; the rate
+    slowly recovers back to the configured one on successful responses.
+
+    References:
+    ====
+
+    https://support.atlassian.com/bitbucket-cloud/docs/api-request-limits/
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self._max_rate = float(rate)
+        self._rate = float(rate)
+        self._burst = max(1, int(burst))
+        self._tokens = float(self._burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self._rate
+
+    def _refill(self, now: float):
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._tokens = min(self._burst, self._tokens + elapsed * self._rate)
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    delay = (1 - self._tokens) / self._rate
+                self.waited += delay
+            instrumentation.record_wait(delay)
+            time.sleep(delay)
+
+    def penalize(self, retry_after: Optional[float] = None):
+        """Backs off after the server refused a request with 429."""
+        with self._lock:
+            self._rate = max(self._max_rate / 16, self._rate / 2)
+            self._tokens = 0
+            delay = retry_after if retry_after is not None else 1 / self._rate
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            logger.warning(f"Rate limited. Pausing {delay:.1f}s, rate lowered to {self._rate:.2f}/s")
+
+    def slow_down(self):
+        """Lowers the rate without pausing, i.e when the server warns it is near the limit."""
+        with self._lock:
+            self._rate = max(self._max_rate / 16, self._rate * 0.75)
+
+    def recover(self):
+        """Additively increases the rate back towards the configured one."""
+        with self._lock:
+            if self._rate < self._max_rate:
+                self._rate = min(self._max_rate, self._rate + self._max_rate / 10)
+
+
+def retry_after_seconds(response) -> Optional[float]:
+    """Reads `Retry-After` (either seconds or an HTTP date) from a response."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def observe(bucket: TokenBucket, response) -> bool:
+    """Feeds a response back into `bucket`.
+
+    Returns `True` when the request was rate limited and should be retried.
+    """
+    if response.status_code == 429:
+        bucket.penalize(retry_after_seconds(response))
+        return True
+
+    headers = response.headers
+    near_limit = headers.get('X-RateLimit-NearLimit', '').lower() == 'true'
+    remaining = headers.get('X-RateLimit-Remaining')
+    limit = headers.get('X-RateLimit-Limit')
+    if remaining is not None and limit:
+        try:
+            near_limit = near_limit or int(remaining) < int(limit) * 0.05
+        except ValueError:
+            pass
+
+    if near_limit:
+        bucket.slow_down()
+    else:
+        bucket.recover()
+    return False
+
+
+def send(bucket: Optional[TokenBucket], request: Callable, max_attempts: int = MAX_ATTEMPTS):
+    """Calls `request()`, which sends one HTTP request, once a token is available
+    in `bucket` and sends it again while it is refused with 429.
+
+    Returns the last response.
+    """
+    for attempt in range(1, max_attempts + 1):
+        if bucket is not None:
+            bucket.acquire()
+
+        response = request()
+
+        if bucket is not None:
+            rate_limited = observe(bucket, response)
+        else:
+            rate_limited = response.status_code == 429
+            if rate_limited and attempt < max_attempts:
+                retry_after = retry_after_seconds(response)
+                delay = retry_after if retry_after is not None else 2 ** attempt
+                instrumentation.record_wait(delay)
+                time.sleep(delay)
+
+        if not rate_limited:
+            break
+        logger.debug(f"Rate limited on attempt {attempt}: {response.url}")
+    return response
+
+
+# The bucket of the requests sent by the current thread, see `limited`.
+_context = threading.local()
+
+
+@contextmanager
+def limited(bucket: Optional[TokenBucket]) -> Iterator[None]:
+    """Sends every request of the current thread through `send(bucket, ...)`
+    within the block, i.e every page of a paginated read."""
+    previous = current_bucket()
+    _context.bucket = bucket
+    try:
+        yield
+    finally:
+        _context.bucket = previous
+
+
+def current_bucket() -> Optional[TokenBucket]:
+    return getattr(_context, 'bucket', None)
+
+
+def inheriting(function: Callable) -> Callable:
+    """Wraps `function` to run under the bucket of the calling thread, when
+    it is given to another thread."""
+    bucket = current_bucket()
+    if bucket is None:
+        return function
+
+    def run(*args, **kwargs):
+        with limited(bucket):
+            return function(*args, **kwargs)
+    return run
@@ -0,0 +1,255 @@
+import click
+import logging
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set
+
+from bitbucklet.bulk import execute, summarize, bulk_options
+from bitbucklet.groups_cli import create_group, fetch_groups, fetch_group_members, put_group_member, delete_group_member, member_identities
+from bitbucklet.manifest import read_document, ACCESSES
+from bitbucklet.ratelimit import TokenBucket, DEFAULT_CONCURRENCY
+from bitbucklet.repos import put_group_privilege, put_user_privilege, delete_group_privilege, delete_user_privilege, \
+    fetch_team_group_privileges, fetch_team_user_privileges
+
+logger = logging.getLogger("reconcile")
+
+# Changes are executed phase by phase: a membership needs its group, and a
+# group privilege needs its group too.
+GROUP = 'group'
+MEMBER = 'member'
+PRIVILEGE = 'privilege'
+PHASES = (GROUP, MEMBER, PRIVILEGE)
+
+
+class Change(NamedTuple):
+    """One write needed to reach the desired state.
+
+    `action` is `+` (create/add/grant), `-` (remove/revoke) or `~` (change the
+    access). For privileges, `target` is the repo and `principal` is
+    `group:<slug>` or `user:<id>`; for memberships, `target` is the group.
+    """
+    phase: str
+    action: str
+    target: str
+    principal: str = ''
+    access: str = ''
+    current_access: str = ''
+
+    def __str__(self):
+        if self.phase == GROUP:
+            return f"{self.action} group {self.target}"
+        if self.phase == MEMBER:
+            return f"{self.action} member {self.target} {self.principal}"
+        access = f"{self.current_access} -> {self.access}" if self.action == '~' else (self.access or self.current_access)
+        return f"{self.action} privilege {self.target} {self.principal} {access}"
+
+
+class DesiredState(NamedTuple):
+    # slug -> display name
+    groups: Dict[str, str]
+    # slug -> member ids. Groups without `members` are not in here.
+    memberships: Dict[str, Set[str]]
+    # repo -> group slug -> access. Repos without `groups` are not in here.
+    group_privileges: Dict[str, Dict[str, str]]
+    # repo -> user id -> access. Repos without `users` are not in here.
+    user_privileges: Dict[str, Dict[str, str]]
+
+
+class CurrentState(NamedTuple):
+    groups: Set[str]
+    # slug -> member objects as returned by the API
+    memberships: Dict[str, List[dict]]
+    group_privileges: Dict[str, Dict[str, str]]
+    # repo -> user object -> access, as `(user, access)` pairs
+    user_privileges: Dict[str, List[tuple]]
+
+
+def read_desired_state(path: str) -> DesiredState:
+    """Reads a desired-state file (JSON, or YAML given PyYAML is installed):
+
+        groups:
+          developers:
+            name: Developers        # optional, defaults to the slug. BitBucket
+                                    # derives the slug of a new group from it
+            members: [alice, "{0a1b...}"]
+        repositories:
+          awesome-repo:
+            groups: {developers: write}
+            users: {"{0a1b...}": admin}
+
+    Only what is listed is managed: a group without `members` keeps its
+    members, a repo without `users` keeps its user privileges, and groups or
+    repos not listed at all are left alone. Within what is listed, anything
+    not desired is removed.
+    """
+    document = read_document(path) or {}
+    groups, memberships, group_privileges, user_privileges = {}, {}, {}, {}
+
+    for slug, spec in (document.get('groups') or {}).items():
+        spec = spec or {}
+        groups[slug] = spec.get('name', slug)
+        if 'members' in spec:
+            memberships[slug] = {str(member) for member in spec['members'] or []}
+
+    for repo, spec in (document.get('repositories') or {}).items():
+        spec = spec or {}
+        for key, privileges in (('groups', group_privileges), ('users', user_privileges)):
+            if key not in spec:
+                continue
+            privileges[repo] = {}
+            for principal, access in (spec[key] or {}).items():
+                access = str(access).lower()
+                if access not in ACCESSES:
+                    raise click.ClickException(f"{repo}: access of {principal} must be one of {', '.join(ACCESSES)}, not {access!r}")
+                if access != 'none':
+                    privileges[repo][str(principal)] = access
+
+    return DesiredState(groups, memberships, group_privileges, user_privileges)
+
+
+def fetch_current_state(desired: DesiredState, concurrency: int) -> CurrentState:
+    """Fetches, in bulk, only what `desired` manages."""
+    groups = {group['slug'] for group in fetch_groups()}
+
+    slugs = [slug for slug in desired.memberships if slug in groups]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        memberships = dict(zip(slugs, executor.map(fetch_group_members, slugs)))
+
+    group_privileges = {}
+    if desired.group_privileges:
+        for privilege in fetch_team_group_privileges():
+            repo = privilege['repo']
+            if repo in desired.group_privileges:
+                group_privileges.setdefault(repo, {})[privilege['group']['slug']] = privilege['privilege']
+
+    user_privileges = {}
+    if desired.user_privileges:
+        for privilege in fetch_team_user_privileges():
+            repo = privilege['repo']
+            if repo in desired.user_privileges:
+                user_privileges.setdefault(repo, []).append((privilege['user'], privilege['privilege']))
+
+    return CurrentState(groups, memberships, group_privileges, user_privileges)
+
+
+def compute_plan(desired: DesiredState, current: CurrentState) -> List[Change]:
+    """Computes the minimal list of changes, in execution order."""
+    changes = []
+
+    for slug, name in desired.groups.items():
+        if slug not in current.groups:
+            # BitBucket derives the slug of a new group from its name: any
+            # other slug would create a group the plan never finds.
+            if slug_of(name) != slug:
+                raise click.ClickException(f"Group {slug}: BitBucket would create {name!r} as {slug_of(name)}. Key it {slug_of(name)}, or name it after {slug}.")
+            changes.append(Change(GROUP, '+', slug))
+
+    for slug, members in desired.memberships.items():
+        current_members = current.memberships.get(slug, [])
+        for member in sorted(members):
+            if not any(member in member_identities(m) for m in current_members):
+                changes.append(Change(MEMBER, '+', slug, member))
+        for current_member in current_members:
+            if not member_identities(current_member) & members:
+                changes.append(Change(MEMBER, '-', slug, __identifier(current_member)))
+
+    for repo, privileges in desired.group_privileges.items():
+        current_privileges = current.group_privileges.get(repo, {})
+        for slug, access in sorted(privileges.items()):
+            changes.extend(__privilege_change(repo, f"group:{slug}", access, current_privileges.get(slug)))
+        for slug, current_access in sorted(current_privileges.items()):
+            if slug not in privileges:
+                changes.append(Change(PRIVILEGE, '-', repo, f"group:{slug}", current_access=current_access))
+
+    for repo, privileges in desired.user_privileges.items():
+        current_privileges = current.user_privileges.get(repo, [])
+        for user_id, access in sorted(privileges.items()):
+            current_access = next((a for user, a in current_privileges if user_id in member_identities(user)), None)
+            changes.extend(__privilege_change(repo, f"user:{user_id}", access, current_access))
+        for user, current_access in current_privileges:
+            if not member_identities(user) & set(privileges):
+                changes.append(Change(PRIVILEGE, '-', repo, f"user:{__identifier(user)}", current_access=current_access))
+
+    return changes
+
+
+def apply_change(change: Change, desired: DesiredState):
+    if change.phase == GROUP:
+        return create_group(desired.groups[change.target])
+
+    if change.phase == MEMBER:
+        if change.action == '+':
+            return put_group_member(change.target, change.principal)
+        return delete_group_member(change.target, change.principal)
+
+    principal_type, _, principal = change.principal.partition(':')
+    if change.action == '-':
+        if principal_type == 'group':
+            return delete_group_privilege(principal, change.target)
+        return delete_user_privilege(principal, change.target)
+    if principal_type == 'group':
+        return put_group_privilege(principal, change.access, change.target)
+    return put_user_privilege(principal, change.access, change.target)
+
+
+def slug_of(name: str) -> str:
+    """The slug BitBucket gives to a group named `name`."""
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+def __privilege_change(repo: str, principal: str, access: str, current_access: Optional[str]) -> Iterable[Change]:
+    if current_access is None:
+        yield Change(PRIVILEGE, '+', repo, principal, access)
+    elif current_access != access:
+        yield Change(PRIVILEGE, '~', repo, principal, access, current_access)
+
+
+def __identifier(user: dict) -> str:
+    for key in ('uuid', 'account_id', 'username'):
+        if user.get(key):
+            return str(user[key])
+    raise ValueError(f"User without any id: {user}")
+
+
+def __plan(path: str, concurrency: int):
+    desired = read_desired_state(path)
+    current = fetch_current_state(desired, concurrency)
+    return desired, compute_plan(desired, current)
+
+
+@click.command(name='plan', help='Show the changes to reach a desired state')
+@click.argument("desired_state", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, envvar='BITBUCKLET_CONCURRENCY', show_default=True, help="Number of concurrent requests")
+def plan_cli(desired_state: str, concurrency: int):
+    _, changes = __plan(desired_state, concurrency)
+    for change in changes:
+        print(change)
+    click.echo(f"{len(changes)} changes", err=True)
+
+
+@click.command(name='apply', help='Apply a desired state of groups and permissions')
+@click.argument("desired_state", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@bulk_options
+def apply_cli(desired_state: str, concurrency: int, rate: float, burst: int):
+    """Runs the changes of `plan` concurrently, phase by phase: groups, then
+    memberships, then privileges. A phase with failures stops the later ones.
+    """
+    desired, changes = __plan(desired_state, concurrency)
+    bucket = TokenBucket(rate=rate, burst=burst)
+
+    results = []
+    for phase in PHASES:
+        phase_changes = [change for change in changes if change.phase == phase]
+        phase_results = list(execute(phase_changes, lambda change: apply_change(change, desired), concurrency, bucket))
+        for result in phase_results:
+            print(f"{'OK' if result.ok else 'FAILED'}\t{result.status or '-'}\t{result.item}\t{result.detail}", flush=True)
+        results.extend(phase_results)
+
+        if not all(result.ok for result in phase_results):
+            click.echo(f"Stopping after failures in the {phase} phase", err=True)
+            break
+
+    summarize(results)
+    if not all(result.ok for result in results):
+        sys.exit(1)
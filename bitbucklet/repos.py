@@ -2,13 +2,23 @@ import click
 import os
 import logging
 import json
-from typing import Tuple
+import sys
+from typing import Tuple, Iterator, Sequence
 
-import requests
 from requests import HTTPError
 
+from bitbucklet.bulk import execute, summarize, bulk_options
+from bitbucklet.manifest import Grant, read_manifest, has_glob, expand_globs, write_manifest
+from bitbucklet.pagination import paginate, paginate_concurrently
+from bitbucklet.ratelimit import TokenBucket, DEFAULT_CONCURRENCY
+from bitbucklet.session import get_session
+from bitbucklet.snapshot import Snapshot, snapshot_options, REPOSITORIES
+from bitbucklet.teams import with_team_uuid
 from bitbucklet.token import get_access_token, BearerAuth
-from bitbucklet.urls import teams_url, users_privileges_url, groups_privileges_url, repos_url
+from bitbucklet.urls import users_privileges_url, groups_privileges_url, repos_url, projects_url, team_groups_privileges_url, team_users_privileges_url
+
+# Printed by `repos list` by default.
+DEFAULT_FIELDS = 'name'
 
 @click.group(name='repos', help = 'Managing repositories and their permissions')
 def repos_cli():
@@ -16,28 +26,116 @@ def repos_cli():
 
 @click.command(name = 'list-in-project', help = 'List repositories in a project')
 @click.argument("project")
-def list_in_project(project: str) -> None:
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
-    access_token = get_access_token()
+@snapshot_options(REPOSITORIES)
+def list_in_project(project: str, snapshot: Snapshot) -> None:
+    if snapshot is not None:
+        repositories = snapshot.repositories(project_key=project)
+    else:
+        repositories = iter_repositories(project=project)
 
-    get_repos_in_project_response = requests.get(
-        repos_url()
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token),
+    for repo in repositories:
+        print(repo['name'], flush=True)
+
+@click.command(name = 'list', help = 'List the repositories of the team, or of some of its projects')
+@click.option("-p", "--project", "projects", multiple=True, help="Key of a project. Can be repeated. Default: every project")
+@click.option("--fields", default=DEFAULT_FIELDS, show_default=True, help="Comma-separated fields to print, i.e name,slug,project.key,updated_on")
+@click.option("-f", "--format", "format", type=click.Choice(['tsv', 'ndjson'], case_sensitive=False), default='tsv', show_default=True, help="Format the output")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, envvar='BITBUCKLET_CONCURRENCY', show_default=True, help="Number of projects paginated concurrently")
+@snapshot_options(REPOSITORIES)
+def list_repositories(projects: Tuple[str], fields: str, format: str, concurrency: int, snapshot: Snapshot) -> None:
+    """Prints the repositories as they are fetched, one per line.
+
+    Every project is paginated by its own stream, up to `--concurrency` at
+    once, so the projects are interleaved in the output. Only the printed
+    `--fields` are requested.
+    """
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    if not fields:
+        raise click.BadParameter("expected at least one field", param_hint="--fields")
+
+    if snapshot is not None:
+        repositories = (repo for project in (projects or [None]) for repo in snapshot.repositories(project_key=project))
+    else:
+        repositories = iter_all_repositories(projects, fields, concurrency)
+
+    for repo in repositories:
+        values = [pick(repo, field) for field in fields]
+        if format == 'ndjson':
+            print(json.dumps(dict(zip(fields, values))), flush=True)
+        else:
+            print('\t'.join('' if value is None else json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+                for value in values), flush=True)
+
+def iter_all_repositories(projects: Sequence[str] = (), fields: Sequence[str] = None, concurrency: int = DEFAULT_CONCURRENCY) -> Iterator[dict]:
+    """Lazily yields the repositories of `projects`, or of every project of
+    the team, paginating up to `concurrency` projects at once.
+
+    Only `fields`, when given, are requested, i.e `['slug', 'project.key']`.
+    """
+    partial = partial_fields(fields) if fields else None
+    if not projects:
+        projects = list(iter_project_keys())
+
+    url = repos_url().format(team=os.getenv('BITBUCKET_TEAM'))
+    queries = []
+    for project in projects:
+        params = {'q': f"project.key=\"{project}\""}
+        if partial is not None:
+            params['fields'] = partial
+        queries.append((url, params))
+
+    return paginate_concurrently(queries, concurrency, auth = BearerAuth(get_access_token()))
+
+def iter_project_keys() -> Iterator[str]:
+    for project in paginate(
+        projects_url()
+            .format(team=os.getenv('BITBUCKET_TEAM')),
         params = {
-            'q': f"project.key=\"{project}\"",
-            'pagelen': 100
-        }
-    )
-    
-    if get_repos_in_project_response.status_code != 200:
-        logging.error(get_repos_in_project_response.text)
-        raise RuntimeError(f"Fail to obtain repositories in project {project} in team {bitbucket_team_name}")
+            'fields': 'next,values.key'
+        },
+        prefetch = True,
+        auth = BearerAuth(get_access_token()),
+    ):
+        yield project['key']
+
+def partial_fields(fields: Sequence[str]) -> str:
+    """Returns the `fields` parameter of a paged partial response holding
+    only `fields` of every item.
+
+    References:
+    ====
+
+    https://developer.atlassian.com/cloud/bitbucket/rest/intro/#partial-response
+    """
+    return ','.join(['next'] + [f"values.{field}" for field in fields])
 
-    repositories = get_repos_in_project_response.json()['values']
-    names = [repo['name'] for repo in repositories]
-    for name in names:
-        print(name)
+def pick(item: dict, field: str):
+    """Returns the value of a dotted `field` of `item`, i.e `project.key`, or `None`."""
+    value = item
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+def iter_repositories(project: str = None, fields: str = None) -> Iterator[dict]:
+    """Lazily yields the repositories of the team, or of one of its projects.
+
+    `fields` is passed along as BitBucket's partial response parameter.
+    """
+    params = {}
+    if project is not None:
+        params['q'] = f"project.key=\"{project}\""
+    if fields is not None:
+        params['fields'] = fields
+
+    return paginate(
+        repos_url()
+            .format(team=os.getenv('BITBUCKET_TEAM')),
+        params = params,
+        prefetch = True,
+        auth = BearerAuth(get_access_token()),
+    )
 
 @click.command(name = 'grant', help = 'Grant access to user or group')
 @click.option("-u", "--user", "user", help="Id (bitbucket) of the user. Mutual exists with --group")
@@ -56,22 +154,17 @@ def grant_access(access: str, repo: str, user: str, group: str):
 
 def __grant_group_access(group_slug: str, access: str, repo: str):
     logging.info(f"Grant group {group_slug} to {access} on {repo}")
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
-    access_token = get_access_token()
+    print(put_group_privilege(group_slug, access, repo))
 
-    get_team_response = requests.get(
-        teams_url()
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token)
-    )
-    
-    if get_team_response.status_code != 200:
-        logging.error(get_team_response)
-        raise RuntimeError(f"Fail to obtain team {bitbucket_team_name}")
+def __grant_user_access(user_id: str, access: str, repo: str):
+    logging.info(f"Grant user {user_id} to {access} on {repo}")
+    print(put_user_privilege(user_id, access, repo))
 
-    bitbucket_team_uuid = get_team_response.json()['uuid']
+def put_group_privilege(group_slug: str, access: str, repo: str):
+    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+    access_token = get_access_token()
 
-    response = requests.put(
+    return with_team_uuid(lambda bitbucket_team_uuid: get_session().put(
         groups_privileges_url()
             .format(
                 team=bitbucket_team_name,
@@ -83,16 +176,13 @@ def __grant_group_access(group_slug: str, access: str, repo: str):
             'Content-Type': 'text/plain'
         },
         data = access,
-    )
+    ))
 
-    print(response)
-
-def __grant_user_access(user_id: str, access: str, repo: str):
-    logging.info(f"Grant user {user_id} to {access} on {repo}")
+def put_user_privilege(user_id: str, access: str, repo: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
-    response = requests.put(
+    return get_session().put(
         users_privileges_url()
             .format(
                 team=bitbucket_team_name,
@@ -105,8 +195,6 @@ def __grant_user_access(user_id: str, access: str, repo: str):
         data = access,
     )
 
-    print(response)
-
 @click.command(name = 'revoke', help = 'Revoke access to user or group')
 @click.option("-u", "--user", "user", help="Id (bitbucket) of the user. Mutual exists with --group")
 @click.option("-g", "--group", "group", help="Group slug. Mutual exists with --user")
@@ -124,22 +212,17 @@ def revoke_access(repo: str, user: str, group: str):
 
 def __revoke_group_access(group_slug: str, repo: str):
     logging.info(f"Revoke group {group_slug} to access on {repo}")
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
-    access_token = get_access_token()
+    print(delete_group_privilege(group_slug, repo))
 
-    get_team_response = requests.get(
-        teams_url()
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token)
-    )
-    
-    if get_team_response.status_code != 200:
-        logging.error(get_team_response)
-        raise RuntimeError(f"Fail to obtain team {bitbucket_team_name}")
+def __revoke_user_access(user_id: str, repo: str):
+    logging.info(f"Revoke user {user_id} to access on {repo}")
+    print(delete_user_privilege(user_id, repo))
 
-    bitbucket_team_uuid = get_team_response.json()['uuid']
+def delete_group_privilege(group_slug: str, repo: str):
+    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+    access_token = get_access_token()
 
-    response = requests.delete(
+    return with_team_uuid(lambda bitbucket_team_uuid: get_session().delete(
         groups_privileges_url()
             .format(
                 team=bitbucket_team_name,
@@ -147,16 +230,13 @@ def __revoke_group_access(group_slug: str, repo: str):
                 repo=repo,
                 group=group_slug),
         auth = BearerAuth(access_token),
-    )
-
-    print(response)
+    ))
 
-def __revoke_user_access(user_id: str, repo: str):
-    logging.info(f"Revoke user {user_id} to access on {repo}")
+def delete_user_privilege(user_id: str, repo: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
-    response = requests.delete(
+    return get_session().delete(
         users_privileges_url()
             .format(
                 team=bitbucket_team_name,
@@ -165,8 +245,79 @@ def __revoke_user_access(user_id: str, repo: str):
         auth = BearerAuth(access_token),
     )
 
-    print(response)
+def fetch_team_group_privileges() -> list:
+    """Lists the privileges granted to groups on every repository of the team."""
+    return __get_privileges(team_groups_privileges_url())
+
+def fetch_team_user_privileges() -> list:
+    """Lists the privileges granted directly to users on every repository of the team."""
+    return __get_privileges(team_users_privileges_url())
+
+def __get_privileges(url: str) -> list:
+    response = get_session().get(
+        url
+            .format(team=os.getenv('BITBUCKET_TEAM')),
+        auth = BearerAuth(get_access_token()),
+    )
+
+    if response.status_code != 200:
+        raise HTTPError(response.text, response=response)
+
+    # v1 refers to the repo as `team/slug`.
+    return [dict(privilege, repo=privilege['repo'].split('/', 1)[-1]) for privilege in response.json()]
+
+def apply_grant(grant: Grant):
+    """Sends the PUT (or DELETE, when its access is `none`) of a manifest line."""
+    if grant.principal_type == 'group':
+        if grant.access == 'none':
+            return delete_group_privilege(grant.principal, grant.repo)
+        return put_group_privilege(grant.principal, grant.access, grant.repo)
+
+    if grant.access == 'none':
+        return delete_user_privilege(grant.principal, grant.repo)
+    return put_user_privilege(grant.principal, grant.access, grant.repo)
+
+@click.command(name = 'apply', help = 'Grant or revoke accesses listed in a CSV/YAML manifest')
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option("--failed", "failed_path", type=click.Path(dir_okay=False, writable=True), help="Write the failed lines into this file, as a manifest to retry")
+@click.option("-n", "--dry-run", is_flag=True, default=False, help="Only print what would be applied")
+@bulk_options
+def apply_manifest(manifest: str, failed_path: str, dry_run: bool, concurrency: int, rate: float, burst: int):
+    """Applies every line of the manifest over one pooled, rate-limited pipeline.
+
+    Repos may be globs (i.e `awesome-*`) matched against the slugs of all the
+    repositories of the team. Prints one tab-separated result per line and a
+    summary on stderr; exits with 1 if any line failed.
+    """
+    grants = read_manifest(manifest)
+    if any(has_glob(grant.repo) for grant in grants):
+        grants = expand_globs(grants, __list_repo_slugs())
+
+    if dry_run:
+        for grant in grants:
+            print(f"{grant.principal_ref()}\t{grant.repo}\t{grant.access}")
+        return
+
+    results = []
+    for result in execute(grants, apply_grant, concurrency, TokenBucket(rate=rate, burst=burst)):
+        grant = result.item
+        print(f"{'OK' if result.ok else 'FAILED'}\t{result.status or '-'}\t{grant.principal_ref()}\t{grant.repo}\t{grant.access}\t{result.detail}", flush=True)
+        results.append(result)
+
+    summarize(results)
+
+    failed = [result.item for result in results if not result.ok]
+    if failed and failed_path:
+        write_manifest(failed, failed_path)
+        click.echo(f"Failed lines written into {failed_path}", err=True)
+    if failed:
+        sys.exit(1)
+
+def __list_repo_slugs():
+    return [repo['slug'] for repo in iter_repositories(fields='next,values.slug')]
 
 repos_cli.add_command(grant_access)
 repos_cli.add_command(revoke_access)
 repos_cli.add_command(list_in_project)
+repos_cli.add_command(list_repositories)
+repos_cli.add_command(apply_manifest)
@@ -0,0 +1,225 @@
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from bitbucklet import instrumentation, ratelimit
+from bitbucklet.singleflight import SingleFlight, DEFAULT_TTL
+
+logger = logging.getLogger("session")
+
+# (connect, read) in seconds.
+DEFAULT_TIMEOUT = (5, 60)
+DEFAULT_POOL_SIZE = 16
+DEFAULT_RETRIES = 3
+
+IDEMPOTENT_METHODS = frozenset(['HEAD', 'GET', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'])
+
+# Requests which do not change anything: the others are writes.
+SAFE_METHODS = frozenset(['HEAD', 'GET', 'OPTIONS', 'TRACE'])
+
+# The headers which, with the URL, identify a GET to coalesce.
+KEY_HEADERS = ('Authorization', 'Cookie', 'Accept', 'If-None-Match', 'If-Modified-Since')
+
+# 429 is deliberately not here: it is handled by `bitbucklet.ratelimit`
+# which needs to see it to slow down every worker.
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+
+
+class JitteredRetry(Retry):
+    """Exponential backoff with full jitter so that concurrent workers
+    do not retry in lockstep.
+
+    References:
+    ====
+
+    https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+    """
+
+    # urllib3 retries these when they carry `Retry-After`, whatever
+    # `status_forcelist`: 429 must reach `bitbucklet.ratelimit` instead.
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 503])
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return random.uniform(0, backoff) if backoff > 0 else 0
+
+
+class BitbuckletSession(requests.Session):
+    """A `requests.Session` which applies a default timeout to every request,
+    and reports them to `bitbucklet.instrumentation` when it is enabled.
+
+    Identical GETs are coalesced by `single_flight`, then served by
+    `http_cache` when there is one, and every write invalidates the responses
+    it may change.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, single_flight: SingleFlight = None, http_cache=None):
+        super().__init__()
+        self.timeout = timeout
+        self.single_flight = single_flight or SingleFlight()
+        self.http_cache = http_cache
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        method = method.upper()
+
+        if method == 'GET' and not kwargs.get('stream'):
+            prepared = self.__prepare(method, url, kwargs)
+            # Whatever tells two requests apart: the URL with its query, the
+            # credentials, and the validators of a conditional GET, whose 304
+            # must not answer a plain one.
+            key = (method, prepared.url) + tuple(prepared.headers.get(name) for name in KEY_HEADERS)
+            return self.single_flight.get(key, url, lambda: self.__fetch(method, url, prepared.url, **kwargs))
+
+        try:
+            return self.__send(method, url, **kwargs)
+        finally:
+            if method not in SAFE_METHODS:
+                self.single_flight.invalidate(url)
+                if self.http_cache is not None:
+                    self.http_cache.invalidate(url)
+
+    def __prepare(self, method, url, kwargs) -> requests.PreparedRequest:
+        return self.prepare_request(requests.Request(
+            method, url,
+            params = kwargs.get('params'),
+            headers = kwargs.get('headers'),
+            cookies = kwargs.get('cookies'),
+            auth = kwargs.get('auth'),
+        ))
+
+    def __fetch(self, method, url, prepared_url, **kwargs):
+        if self.http_cache is None:
+            return self.__send(method, url, **kwargs)
+
+        def send(validators: dict):
+            headers = dict(kwargs.get('headers') or {}, **validators)
+            return self.__send(method, url, **dict(kwargs, headers=headers))
+
+        return self.http_cache.fetch(prepared_url, send)
+
+    def __send(self, method, url, **kwargs):
+        bucket = ratelimit.current_bucket()
+        if bucket is not None:
+            # Within `ratelimit.limited`: the other requests it sends, i.e
+            # for a new access token, are not limited again.
+            with ratelimit.limited(None):
+                return ratelimit.send(bucket, lambda: self.__record(method, url, **kwargs))
+        return self.__record(method, url, **kwargs)
+
+    def __record(self, method, url, **kwargs):
+        recorder = instrumentation.get_recorder()
+        if recorder is None:
+            return super().request(method, url, **kwargs)
+
+        started_at = time.perf_counter()
+        try:
+            response = super().request(method, url, **kwargs)
+        except Exception as e:
+            recorder.record(method, url, None, time.perf_counter() - started_at, error=f"{type(e).__name__}: {e}")
+            raise
+
+        body = response.request.body or b''
+        retries = getattr(response.raw, 'retries', None)
+        recorder.record(
+            method,
+            url,
+            response.status_code,
+            time.perf_counter() - started_at,
+            bytes_sent = len(body.encode() if isinstance(body, str) else body),
+            bytes_received = len(response.content or b''),
+            retries = len(retries.history) if retries is not None else 0,
+        )
+        return response
+
+
+def _make_retry(retries: int) -> Retry:
+    options = dict(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=0.5,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+        respect_retry_after_header=True,
+    )
+    # `method_whitelist` was renamed to `allowed_methods` in urllib3 1.26.
+    try:
+        return JitteredRetry(allowed_methods=IDEMPOTENT_METHODS, **options)
+    except TypeError:
+        return JitteredRetry(method_whitelist=IDEMPOTENT_METHODS, **options)
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _open_http_cache():
+    from bitbucklet import httpcache
+
+    if not httpcache.is_enabled():
+        return None
+    try:
+        return httpcache.HttpCache.from_environment()
+    except Exception as e:
+        logger.warning(f"Running without the HTTP cache: {e}")
+        return None
+
+
+def new_session() -> BitbuckletSession:
+    """Creates a session with keep-alive connection pools for BitBucket hosts.
+
+    The pool size can be tuned with `BITBUCKLET_POOL_SIZE` and should be at least
+    the concurrency used by bulk commands. `BITBUCKLET_TIMEOUT` overrides the read
+    timeout and `BITBUCKLET_RETRIES` the number of retries of idempotent requests.
+    `BITBUCKLET_DEDUP_TTL` is how long, in seconds, a GET response is served again
+    to identical GETs; 0 only coalesces the concurrent ones. `BITBUCKLET_HTTP_CACHE=1`
+    also caches them on disk, see `bitbucklet.httpcache`.
+    """
+    pool_size = _env_int('BITBUCKLET_POOL_SIZE', DEFAULT_POOL_SIZE)
+    retries = _env_int('BITBUCKLET_RETRIES', DEFAULT_RETRIES)
+    read_timeout = _env_int('BITBUCKLET_TIMEOUT', DEFAULT_TIMEOUT[1])
+    dedup_ttl = _env_int('BITBUCKLET_DEDUP_TTL', DEFAULT_TTL)
+
+    session = BitbuckletSession(
+        timeout=(DEFAULT_TIMEOUT[0], read_timeout),
+        single_flight=SingleFlight(ttl=dedup_ttl),
+        http_cache=_open_http_cache(),
+    )
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'User-Agent': 'bitbucklet',
+    })
+
+    # One pool per host (api.bitbucket.org and bitbucket.org), each keeping up to
+    # `pool_size` connections alive.
+    adapter = HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=pool_size,
+        max_retries=_make_retry(retries),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> BitbuckletSession:
+    """Returns the session shared by every command in this process."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = new_session()
+    return _session
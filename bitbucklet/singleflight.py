@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Tuple
+from urllib.parse import unquote, urlsplit
+
+from bitbucklet import instrumentation
+
+logger = logging.getLogger("singleflight")
+
+# Seconds a response is served again to identical GETs. Short: long enough to
+# absorb the repeated lookups of one command, too short to notice changes
+# made elsewhere late.
+DEFAULT_TTL = 5
+DEFAULT_MAX_ENTRIES = 128
+
+# Leading path segments which do not name a resource.
+PREFIX_SEGMENTS = frozenset(['!api', '1.0', '2.0', 'internal'])
+
+# Resources derived from all the others, i.e the access summary of a user:
+# any write invalidates them.
+DERIVED_RESOURCES = frozenset(['user'])
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces identical GETs of a process: concurrent ones share a single
+    request, and successful responses are served again to those sent within
+    `ttl` seconds, from an LRU of `max_entries`.
+
+    Writes call `invalidate`, which forgets the responses about the written
+    resource, its parents and its children.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._calls: Dict[tuple, _Call] = {}
+        # key -> (stored at, resource, response)
+        self._responses: 'OrderedDict[tuple, Tuple[float, tuple, object]]' = OrderedDict()
+        # Bumped by every write, so that a response requested before it is not stored.
+        self._generation = 0
+
+    def get(self, key: tuple, url: str, send: Callable):
+        """Returns the response of `send()`, or of an identical request,
+        identified by `key`, either in flight or sent within `ttl`."""
+        with self._lock:
+            cached = self._responses.get(key)
+            if cached is not None:
+                stored_at, _, response = cached
+                if time.monotonic() - stored_at <= self.ttl:
+                    self._responses.move_to_end(key)
+                    instrumentation.record_saved('cached')
+                    return response
+                del self._responses[key]
+
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                generation = self._generation
+
+        if not leader:
+            call.done.wait()
+            instrumentation.record_saved('coalesced')
+            if call.error is not None:
+                raise call.error
+            return call.response
+
+        try:
+            call.response = send()
+            return call.response
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                if self.__is_storable(call.response) and generation == self._generation:
+                    self._responses[key] = (time.monotonic(), resource_of(url), call.response)
+                    while len(self._responses) > self.max_entries:
+                        self._responses.popitem(last=False)
+            call.done.set()
+
+    def __is_storable(self, response) -> bool:
+        return self.ttl > 0 and response is not None and response.status_code == 200
+
+    def invalidate(self, url: str):
+        written = resource_of(url)
+        with self._lock:
+            self._generation += 1
+            stale = [key for key, (_, resource, _) in self._responses.items() if is_affected(resource, written)]
+            for key in stale:
+                del self._responses[key]
+        if stale:
+            logger.debug(f"{url} invalidated {len(stale)} cached responses")
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._responses.clear()
+
+
+def resource_of(url: str) -> tuple:
+    """Names the resource of `url` by its path, whatever the host and the
+    version of the API, e.g `('groups', 'team', 'developers', 'members')`."""
+    segments = [unquote(segment) for segment in urlsplit(url).path.split('/') if segment]
+    while segments and segments[0] in PREFIX_SEGMENTS:
+        segments.pop(0)
+    return tuple(segments)
+
+
+def is_affected(resource: tuple, written: tuple) -> bool:
+    """Tells whether a write to `written` may change `resource`, both named by `resource_of`."""
+    if resource[:1] and resource[0] in DERIVED_RESOURCES:
+        return True
+    shortest = min(len(resource), len(written))
+    return resource[:shortest] == written[:shortest]
@@ -0,0 +1,414 @@
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import click
+
+from bitbucklet.config import cache_dir
+
+logger = logging.getLogger("snapshot")
+
+# Datasets mirrored by `bitbucklet sync`. Each has its own sync time so that
+# a partial sync never makes the other datasets look fresh.
+MEMBERS = 'members'
+GROUPS = 'groups'
+REPOSITORIES = 'repositories'
+ACCESSES = 'accesses'
+PRIVILEGES = 'privileges'
+DATASETS = (MEMBERS, GROUPS, REPOSITORIES, ACCESSES, PRIVILEGES)
+
+IN_MEMORY = ':memory:'
+
+# Set by `bitbucklet serve`: a warm snapshot kept in memory, which the list
+# commands use when it is younger than `_served_max_age` and neither
+# `--offline` nor `--max-age` is given.
+_served_snapshot = None
+_served_max_age = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS members (
+    account_id TEXT PRIMARY KEY,
+    uuid TEXT,
+    display_name TEXT,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_uuid ON members (uuid);
+CREATE TABLE IF NOT EXISTS groups (
+    slug TEXT PRIMARY KEY,
+    name TEXT,
+    raw TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS group_members (
+    group_slug TEXT NOT NULL,
+    account_id TEXT NOT NULL,
+    raw TEXT NOT NULL,
+    PRIMARY KEY (group_slug, account_id)
+);
+CREATE INDEX IF NOT EXISTS group_members_account_id ON group_members (account_id);
+CREATE TABLE IF NOT EXISTS repositories (
+    uuid TEXT PRIMARY KEY,
+    slug TEXT,
+    name TEXT,
+    project_key TEXT,
+    updated_on TEXT,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS repositories_project_key ON repositories (project_key);
+CREATE INDEX IF NOT EXISTS repositories_name ON repositories (name);
+CREATE TABLE IF NOT EXISTS user_accesses (
+    account_id TEXT PRIMARY KEY,
+    display_name TEXT,
+    fetched_at REAL
+);
+CREATE TABLE IF NOT EXISTS user_repos (
+    account_id TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    PRIMARY KEY (account_id, repo)
+);
+CREATE INDEX IF NOT EXISTS user_repos_repo ON user_repos (repo);
+CREATE TABLE IF NOT EXISTS user_groups (
+    account_id TEXT NOT NULL,
+    group_slug TEXT NOT NULL,
+    PRIMARY KEY (account_id, group_slug)
+);
+CREATE TABLE IF NOT EXISTS privileges (
+    repo TEXT NOT NULL,
+    principal_type TEXT NOT NULL,
+    access TEXT NOT NULL,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS privileges_repo ON privileges (repo);
+"""
+
+
+class Snapshot:
+    """A local SQLite mirror of the team: members, groups and their members,
+    repositories and the accesses of every member.
+
+    It is written by `bitbucklet sync` and read by the list commands given
+    `--offline` or `--max-age`.
+    """
+
+    def __init__(self, path: Path, read_only: bool = False):
+        self._path = path
+        # Set when the snapshot is the only source, i.e `--offline`.
+        self.offline = False
+        if read_only:
+            # Neither created, migrated nor chmod-ed: it may be someone else's.
+            self._db = sqlite3.connect(f"{Path(path).resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+            return
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        if str(path) != IN_MEMORY:
+            os.chmod(path, 0o600)
+
+    @classmethod
+    def default_path(cls, team: str = None) -> Path:
+        if os.getenv('BITBUCKLET_SNAPSHOT'):
+            return Path(os.getenv('BITBUCKLET_SNAPSHOT'))
+        team = team or os.getenv('BITBUCKET_TEAM')
+        safe_team = re.sub(r'[^A-Za-z0-9_.-]', '_', team or '')
+        return cache_dir() / f"snapshot-{safe_team}.sqlite"
+
+    @classmethod
+    def open(cls, path: Path = None) -> 'Snapshot':
+        return cls(path or cls.default_path())
+
+    @classmethod
+    def open_read_only(cls, path: Path) -> 'Snapshot':
+        return cls(path, read_only=True)
+
+    @classmethod
+    def in_memory(cls) -> 'Snapshot':
+        return cls(IN_MEMORY)
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Freshness
+
+    def synced_at(self, dataset: str) -> Optional[float]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (f"synced_at.{dataset}",)).fetchone()
+        return float(row[0]) if row else None
+
+    def age(self, dataset: str) -> Optional[float]:
+        synced_at = self.synced_at(dataset)
+        return None if synced_at is None else time.time() - synced_at
+
+    def get_meta(self, key: str) -> Optional[str]:
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def mark_synced(self, dataset: str, synced_at: float = None):
+        self.set_meta(f"synced_at.{dataset}", str(synced_at or time.time()))
+
+    # Writes. Every `replace_*` swaps the whole dataset in one transaction.
+
+    def replace_members(self, members: Iterable[dict]):
+        with self._db:
+            self._db.execute("DELETE FROM members")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO members (account_id, uuid, display_name, raw) VALUES (?, ?, ?, ?)",
+                ((m['account_id'], m.get('uuid'), m.get('display_name'), json.dumps(m)) for m in members))
+
+    def replace_groups(self, groups: Iterable[dict], memberships: Iterable[Tuple[str, dict]]):
+        with self._db:
+            self._db.execute("DELETE FROM groups")
+            self._db.execute("DELETE FROM group_members")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO groups (slug, name, raw) VALUES (?, ?, ?)",
+                ((g['slug'], g.get('name'), json.dumps(g)) for g in groups))
+            self._db.executemany(
+                "INSERT OR REPLACE INTO group_members (group_slug, account_id, raw) VALUES (?, ?, ?)",
+                ((slug, m['account_id'], json.dumps(m)) for slug, m in memberships))
+
+    def replace_repositories(self, repositories: Iterable[dict]):
+        with self._db:
+            self._db.execute("DELETE FROM repositories")
+            self._write_repositories(repositories)
+
+    def upsert_repositories(self, repositories: Iterable[dict]):
+        with self._db:
+            self._write_repositories(repositories)
+
+    def _write_repositories(self, repositories: Iterable[dict]):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO repositories (uuid, slug, name, project_key, updated_on, raw) VALUES (?, ?, ?, ?, ?, ?)",
+            ((r['uuid'], r.get('slug'), r.get('name'), (r.get('project') or {}).get('key'), r.get('updated_on'), json.dumps(r))
+                for r in repositories))
+
+    def replace_user_accesses(self, all_member_accesses: Iterable[Tuple[str, str, List[str], List[str]]]):
+        with self._db:
+            self._db.execute("DELETE FROM user_accesses")
+            self._db.execute("DELETE FROM user_repos")
+            self._db.execute("DELETE FROM user_groups")
+            for member_accesses in all_member_accesses:
+                self._write_user_accesses(member_accesses)
+
+    def upsert_user_accesses(self, member_accesses: Tuple[str, str, List[str], List[str]]):
+        with self._db:
+            self._write_user_accesses(member_accesses)
+
+    def _write_user_accesses(self, member_accesses: Tuple[str, str, List[str], List[str]]):
+        display_name, account_id, repos, groups = member_accesses
+        self._db.execute("DELETE FROM user_repos WHERE account_id = ?", (account_id,))
+        self._db.execute("DELETE FROM user_groups WHERE account_id = ?", (account_id,))
+        self._db.execute(
+            "INSERT OR REPLACE INTO user_accesses (account_id, display_name, fetched_at) VALUES (?, ?, ?)",
+            (account_id, display_name, time.time()))
+        self._db.executemany(
+            "INSERT OR IGNORE INTO user_repos (account_id, repo) VALUES (?, ?)",
+            ((account_id, repo) for repo in repos))
+        self._db.executemany(
+            "INSERT OR IGNORE INTO user_groups (account_id, group_slug) VALUES (?, ?)",
+            ((account_id, group) for group in groups))
+
+    def replace_privileges(self, group_privileges: Iterable[dict], user_privileges: Iterable[dict]):
+        with self._db:
+            self._db.execute("DELETE FROM privileges")
+            for principal_type, privileges in (('group', group_privileges), ('user', user_privileges)):
+                self._db.executemany(
+                    "INSERT INTO privileges (repo, principal_type, access, raw) VALUES (?, ?, ?, ?)",
+                    ((p['repo'], principal_type, p['privilege'], json.dumps(p)) for p in privileges))
+
+    # Reads
+
+    def members(self) -> Iterator[dict]:
+        for (raw,) in self._db.execute("SELECT raw FROM members ORDER BY rowid"):
+            yield json.loads(raw)
+
+    def groups(self) -> List[dict]:
+        return [json.loads(raw) for (raw,) in self._db.execute("SELECT raw FROM groups ORDER BY rowid")]
+
+    def group_members(self, group_slug: str) -> Optional[List[dict]]:
+        """Returns the members of a group, or `None` when it is not in the snapshot."""
+        if self._db.execute("SELECT 1 FROM groups WHERE slug = ?", (group_slug,)).fetchone() is None:
+            return None
+        return [json.loads(raw) for (raw,) in self._db.execute(
+            "SELECT raw FROM group_members WHERE group_slug = ? ORDER BY rowid", (group_slug,))]
+
+    def repositories(self, project_key: str = None) -> Iterator[dict]:
+        if project_key is None:
+            cursor = self._db.execute("SELECT raw FROM repositories ORDER BY rowid")
+        else:
+            cursor = self._db.execute("SELECT raw FROM repositories WHERE project_key = ? ORDER BY rowid", (project_key,))
+        for (raw,) in cursor:
+            yield json.loads(raw)
+
+    def privileges(self, principal_type: str) -> List[dict]:
+        """Returns the `group` or `user` privileges as returned by the API."""
+        return [json.loads(raw) for (raw,) in self._db.execute(
+            "SELECT raw FROM privileges WHERE principal_type = ? ORDER BY rowid", (principal_type,))]
+
+    def all_group_members(self) -> dict:
+        """Returns the members of every group, by slug."""
+        result = {}
+        for slug, raw in self._db.execute("SELECT group_slug, raw FROM group_members ORDER BY rowid"):
+            result.setdefault(slug, []).append(json.loads(raw))
+        return result
+
+    def member_account_ids(self) -> set:
+        return {account_id for (account_id,) in self._db.execute("SELECT account_id FROM members")}
+
+    def memberships(self) -> dict:
+        """Returns the slugs of the groups of every account id."""
+        result = {}
+        for slug, account_id in self._db.execute("SELECT group_slug, account_id FROM group_members"):
+            result.setdefault(account_id, set()).add(slug)
+        return result
+
+    def repository_uuids(self) -> set:
+        return {uuid for (uuid,) in self._db.execute("SELECT uuid FROM repositories")}
+
+    def repository_names(self, uuids: Iterable[str]) -> set:
+        uuids = list(uuids)
+        names = set()
+        # Stay below SQLITE_MAX_VARIABLE_NUMBER.
+        for i in range(0, len(uuids), 500):
+            chunk = uuids[i:i + 500]
+            names.update(name for (name,) in self._db.execute(
+                f"SELECT name FROM repositories WHERE uuid IN ({','.join('?' * len(chunk))})", chunk))
+        return names
+
+    def delete_repositories(self, uuids: Iterable[str]):
+        with self._db:
+            self._db.executemany("DELETE FROM repositories WHERE uuid = ?", ((uuid,) for uuid in uuids))
+
+    def accounts_with_repos(self, repo_names: Iterable[str]) -> set:
+        return {account_id for repo in repo_names for (account_id,) in self._db.execute(
+            "SELECT account_id FROM user_repos WHERE repo = ?", (repo,))}
+
+    def user_accesses_account_ids(self) -> set:
+        return {account_id for (account_id,) in self._db.execute("SELECT account_id FROM user_accesses")}
+
+    def delete_user_accesses(self, account_ids: Iterable[str]):
+        with self._db:
+            for account_id in account_ids:
+                self._db.execute("DELETE FROM user_accesses WHERE account_id = ?", (account_id,))
+                self._db.execute("DELETE FROM user_repos WHERE account_id = ?", (account_id,))
+                self._db.execute("DELETE FROM user_groups WHERE account_id = ?", (account_id,))
+
+    def user_accesses(self, user: str) -> Optional[Tuple[str, str, str, List[str], List[str]]]:
+        """Returns `(display_name, account_id, uuid, repos, groups)` of a user
+        given either their account id or UUID.
+        """
+        row = self._db.execute(
+            "SELECT a.account_id, a.display_name, m.uuid FROM user_accesses a"
+            " LEFT JOIN members m ON m.account_id = a.account_id"
+            " WHERE a.account_id = ? OR m.uuid = ?", (user, user)).fetchone()
+        if row is None:
+            return None
+        account_id, display_name, uuid = row
+        repos = [repo for (repo,) in self._db.execute(
+            "SELECT repo FROM user_repos WHERE account_id = ? ORDER BY rowid", (account_id,))]
+        groups = [group for (group,) in self._db.execute(
+            "SELECT group_slug FROM user_groups WHERE account_id = ? ORDER BY rowid", (account_id,))]
+        return (display_name, account_id, uuid, repos, groups)
+
+    def all_user_accesses(self, by_account_id: bool = False) -> Iterator[Tuple[str, str, List[str], List[str]]]:
+        """Yields the accesses of every user in the same shape as
+        `accesses.iter_all_user_accesses`, in the order they were synced or
+        sorted by account id."""
+        order = 'account_id' if by_account_id else 'rowid'
+        for account_id, display_name in self._db.execute(
+                f"SELECT account_id, display_name FROM user_accesses ORDER BY {order}").fetchall():
+            repos = [repo for (repo,) in self._db.execute(
+                "SELECT repo FROM user_repos WHERE account_id = ? ORDER BY rowid", (account_id,))]
+            groups = [group for (group,) in self._db.execute(
+                "SELECT group_slug FROM user_groups WHERE account_id = ? ORDER BY rowid", (account_id,))]
+            yield (display_name, account_id, repos, groups)
+
+
+def serve_snapshot(snapshot: Optional['Snapshot'], max_age: int = None):
+    """Replaces the snapshot served by this process, or stops serving one
+    given `None`."""
+    global _served_snapshot, _served_max_age
+    _served_snapshot, _served_max_age = snapshot, max_age
+
+
+def snapshot_options(dataset: str):
+    """Adds `--offline` and `--max-age` to a list command.
+
+    The decorated command receives `snapshot`: an opened `Snapshot` when the
+    result should be served from it, otherwise `None` (query the API live).
+    """
+    def decorator(command):
+        @click.option('--offline', is_flag=True, default=False, help="Serve the result from the local snapshot (see `bitbucklet sync`)")
+        @click.option('--max-age', type=click.IntRange(min=0), default=None, help="Serve the result from the local snapshot if it is younger than this many seconds")
+        @functools.wraps(command)
+        def wrapper(*args, offline: bool, max_age: Optional[int], **kwargs):
+            snapshot = __open_if_fresh(dataset, offline, max_age)
+            if snapshot is None and not offline and max_age is None:
+                served = __served_if_fresh(dataset)
+                if served is not None:
+                    return command(*args, snapshot=served, **kwargs)
+            try:
+                return command(*args, snapshot=snapshot, **kwargs)
+            finally:
+                if snapshot is not None:
+                    snapshot.close()
+        return wrapper
+    return decorator
+
+
+def __open_if_fresh(dataset: str, offline: bool, max_age: Optional[int]) -> Optional[Snapshot]:
+    if not offline and max_age is None:
+        return None
+
+    path = Snapshot.default_path()
+    if not path.exists():
+        if offline:
+            raise click.ClickException(f"No snapshot at {path}. Run `bitbucklet sync` first.")
+        return None
+
+    snapshot = Snapshot.open(path)
+    age = snapshot.age(dataset)
+    if age is None:
+        snapshot.close()
+        if offline:
+            raise click.ClickException(f"The snapshot has no {dataset}. Run `bitbucklet sync` first.")
+        return None
+
+    if offline or age <= max_age:
+        logger.debug(f"Serving {dataset} from {path} synced {age:.0f}s ago")
+        snapshot.offline = offline
+        return snapshot
+
+    snapshot.close()
+    return None
+
+
+def __served_if_fresh(dataset: str) -> Optional[Snapshot]:
+    # Read once: the server swaps it while refreshing.
+    snapshot, max_age = _served_snapshot, _served_max_age
+    if snapshot is None:
+        return None
+    age = snapshot.age(dataset)
+    if age is None or age > max_age:
+        return None
+    logger.debug(f"Serving {dataset} from memory, synced {age:.0f}s ago")
+    return snapshot
@@ -0,0 +1,224 @@
+import click
+import os
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from requests import HTTPError
+
+from bitbucklet.accesses import iter_all_user_accesses
+from bitbucklet.pagination import paginate
+from bitbucklet.ratelimit import DEFAULT_RATE, DEFAULT_BURST, DEFAULT_CONCURRENCY
+from bitbucklet.repos import fetch_team_group_privileges, fetch_team_user_privileges, iter_repositories
+from bitbucklet.session import get_session
+from bitbucklet.snapshot import Snapshot, MEMBERS, GROUPS, REPOSITORIES, ACCESSES, PRIVILEGES, DATASETS
+from bitbucklet.token import get_access_token, BearerAuth
+from bitbucklet.urls import groups_url, repos_url, repo_groups_privileges_url
+from bitbucklet.users import iter_members
+
+logger = logging.getLogger("sync")
+
+@click.command(name='sync', help='Mirror the team into a local snapshot for --offline queries')
+@click.option("-o", "--only", "only", multiple=True, type=click.Choice(DATASETS, case_sensitive=False), help="Only sync these datasets. Can be repeated.")
+@click.option("-i", "--incremental", is_flag=True, default=False, help="Only fetch what changed since the last sync")
+@click.option("-c", "--concurrency", type=click.IntRange(min=1), default=DEFAULT_CONCURRENCY, envvar='BITBUCKLET_CONCURRENCY', show_default=True, help="Number of concurrent requests")
+@click.option("--rate", type=click.FloatRange(min=0.01), default=DEFAULT_RATE, envvar='BITBUCKLET_RATE', show_default=True, help="Maximum requests per second when fetching accesses")
+@click.option("--burst", type=click.IntRange(min=1), default=DEFAULT_BURST, envvar='BITBUCKLET_BURST', show_default=True, help="Maximum requests sent in a burst when fetching accesses")
+def sync_cli(only, incremental: bool, concurrency: int, rate: float, burst: int):
+    datasets = set(only) if only else set(DATASETS)
+
+    if ACCESSES in datasets and not os.getenv('BITBUCKET_CLOUD_SESSION'):
+        logger.warning("BITBUCKET_CLOUD_SESSION is not set. Skipping accesses.")
+        datasets.discard(ACCESSES)
+
+    with Snapshot.open() as snapshot:
+        # Accounts whose accesses may have changed, as found by the other datasets.
+        stale_accounts = set()
+        removed_accounts = set()
+
+        if MEMBERS in datasets:
+            added, removed = sync_members(snapshot)
+            stale_accounts |= added
+            removed_accounts |= removed
+        if GROUPS in datasets:
+            stale_accounts |= sync_groups(snapshot, concurrency, incremental)
+        if REPOSITORIES in datasets:
+            if incremental and snapshot.synced_at(REPOSITORIES) is not None:
+                stale_accounts |= sync_repositories_incrementally(snapshot, concurrency)
+            else:
+                sync_repositories(snapshot)
+        if PRIVILEGES in datasets:
+            sync_privileges(snapshot)
+        if ACCESSES in datasets:
+            if incremental and snapshot.synced_at(ACCESSES) is not None:
+                sync_accesses_incrementally(snapshot, stale_accounts, removed_accounts, concurrency, rate, burst)
+            else:
+                sync_accesses(snapshot, concurrency, rate, burst)
+        print(snapshot.path)
+
+def sync_members(snapshot: Snapshot):
+    """Replaces the members. Returns the account ids `(added, removed)`."""
+    started_at = time.time()
+    before = snapshot.member_account_ids()
+    snapshot.replace_members(iter_members())
+    snapshot.mark_synced(MEMBERS, started_at)
+    after = snapshot.member_account_ids()
+    logger.info(f"Synced {MEMBERS} in {time.time() - started_at:.1f}s: {len(after - before)} added, {len(before - after)} removed")
+    return (after - before, before - after)
+
+def sync_groups(snapshot: Snapshot, concurrency: int, incremental: bool = False):
+    """Replaces the groups and their members.
+
+    Returns the account ids whose group memberships changed. When `incremental`,
+    the lists are revalidated with `If-None-Match` so that unchanged ones cost
+    no payload.
+    """
+    started_at = time.time()
+    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+    auth = BearerAuth(get_access_token())
+    before = snapshot.memberships()
+
+    groups = __get_json(snapshot, groups_url().format(team=bitbucket_team_name), auth, incremental)
+
+    def fetch_members(group):
+        members = __get_json(
+            snapshot,
+            f"{groups_url()}/{group['slug']}/members".format(team=bitbucket_team_name),
+            auth,
+            incremental)
+        return [(group['slug'], member) for member in members]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        memberships = [membership
+            for members in executor.map(fetch_members, groups)
+            for membership in members]
+
+    snapshot.replace_groups(groups, memberships)
+    snapshot.mark_synced(GROUPS, started_at)
+
+    after = snapshot.memberships()
+    changed = {account_id
+        for account_id in set(before) | set(after)
+        if before.get(account_id, set()) != after.get(account_id, set())}
+    logger.info(f"Synced {GROUPS} in {time.time() - started_at:.1f}s: memberships of {len(changed)} users changed")
+    return changed
+
+def sync_repositories(snapshot: Snapshot):
+    started_at = time.time()
+    snapshot.replace_repositories(iter_repositories())
+    snapshot.mark_synced(REPOSITORIES, started_at)
+    logger.info(f"Synced {REPOSITORIES} in {time.time() - started_at:.1f}s")
+
+def sync_repositories_incrementally(snapshot: Snapshot, concurrency: int):
+    """Fetches only the repositories updated since the last sync, and the
+    UUIDs of all repositories to find the deleted ones.
+
+    Returns the account ids which had, or may have been given, access to a
+    changed repository.
+    """
+    started_at = time.time()
+    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
+    auth = BearerAuth(get_access_token())
+    since = datetime.fromtimestamp(snapshot.synced_at(REPOSITORIES), timezone.utc).isoformat()
+    before = snapshot.repository_uuids()
+
+    changed = list(paginate(
+        repos_url().format(team=bitbucket_team_name),
+        params = {
+            'q': f"updated_on > {since}"
+        },
+        auth = auth,
+    ))
+    current = {repo['uuid'] for repo in paginate(
+        repos_url().format(team=bitbucket_team_name),
+        params = {
+            'fields': 'next,values.uuid'
+        },
+        prefetch = True,
+        auth = auth,
+    )}
+    deleted = before - current
+
+    stale_accounts = snapshot.accounts_with_repos(
+        snapshot.repository_names(deleted) | {repo['name'] for repo in changed})
+
+    # Nobody in the snapshot has access to a new repository yet. Its members
+    # are granted through groups; look them up to know whom to refetch.
+    created = [repo for repo in changed if repo['uuid'] not in before]
+    if created:
+        memberships = snapshot.memberships()
+
+        def fetch_group_slugs(repo):
+            privileges = __get_json(
+                snapshot,
+                repo_groups_privileges_url().format(team=bitbucket_team_name, repo=repo['slug']),
+                auth,
+                conditional = False)
+            return {privilege['group']['slug'] for privilege in privileges}
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            granted_groups = set().union(*executor.map(fetch_group_slugs, created))
+        stale_accounts |= {account_id
+            for account_id, slugs in memberships.items()
+            if slugs & granted_groups}
+
+    snapshot.upsert_repositories(changed)
+    snapshot.delete_repositories(deleted)
+    snapshot.mark_synced(REPOSITORIES, started_at)
+    logger.info(f"Synced {REPOSITORIES} in {time.time() - started_at:.1f}s: {len(changed)} changed ({len(created)} new), {len(deleted)} deleted")
+    return stale_accounts
+
+def sync_privileges(snapshot: Snapshot):
+    # Two requests for the whole team: always synced in full.
+    started_at = time.time()
+    snapshot.replace_privileges(fetch_team_group_privileges(), fetch_team_user_privileges())
+    snapshot.mark_synced(PRIVILEGES, started_at)
+    logger.info(f"Synced {PRIVILEGES} in {time.time() - started_at:.1f}s")
+
+def sync_accesses(snapshot: Snapshot, concurrency: int, rate: float, burst: int):
+    started_at = time.time()
+    snapshot.replace_user_accesses(iter_all_user_accesses(concurrency=concurrency, rate=rate, burst=burst))
+    snapshot.mark_synced(ACCESSES, started_at)
+    logger.info(f"Synced {ACCESSES} in {time.time() - started_at:.1f}s")
+
+def sync_accesses_incrementally(snapshot: Snapshot, stale_accounts: set, removed_accounts: set, concurrency: int, rate: float, burst: int):
+    """Refetches the accesses of the stale members and of the members which
+    have none in the snapshot yet; forgets those of removed members.
+    """
+    started_at = time.time()
+    known = snapshot.user_accesses_account_ids()
+    members = [(member['display_name'], member['account_id'])
+        for member in snapshot.members()
+        if member['account_id'] in stale_accounts or member['account_id'] not in known]
+
+    snapshot.delete_user_accesses(removed_accounts | (known - snapshot.member_account_ids()))
+    for member_accesses in iter_all_user_accesses(concurrency=concurrency, rate=rate, burst=burst, members=members):
+        snapshot.upsert_user_accesses(member_accesses)
+
+    snapshot.mark_synced(ACCESSES, started_at)
+    logger.info(f"Synced {ACCESSES} in {time.time() - started_at:.1f}s: {len(members)} users refetched")
+
+def __get_json(snapshot: Snapshot, url: str, auth, conditional: bool = True):
+    """GETs `url`. When `conditional`, sends the ETag of the previous response
+    in `If-None-Match` and reuses its body from the snapshot on 304.
+    """
+    etag_key, body_key = f"etag:{url}", f"body:{url}"
+    etag = snapshot.get_meta(etag_key) if conditional else None
+    headers = {'If-None-Match': etag} if etag else {}
+
+    response = get_session().get(url, auth = auth, headers = headers)
+    if response.status_code == 304:
+        cached = snapshot.get_meta(body_key)
+        if cached is not None:
+            return json.loads(cached)
+        response = get_session().get(url, auth = auth)
+
+    if response.status_code != 200:
+        raise HTTPError(response.text, response=response)
+
+    if response.headers.get('ETag'):
+        snapshot.set_meta(etag_key, response.headers['ETag'])
+        snapshot.set_meta(body_key, response.text)
+    return response.json()
@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+import threading
+from typing import Callable
+
+from bitbucklet.config import cache_dir, write_private_file
+from bitbucklet.session import get_session
+from bitbucklet.token import get_access_token, BearerAuth
+from bitbucklet.urls import teams_url
+
+logger = logging.getLogger("teams")
+
+# Status codes which suggest that a cached team UUID is stale.
+STALE_STATUSES = (403, 404)
+
+_team_uuids = {}
+_team_uuids_lock = threading.Lock()
+
+
+def __cache_file():
+    return cache_dir() / 'teams.json'
+
+
+def __load_disk_cache() -> dict:
+    path = __cache_file()
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError) as e:
+        logger.debug(f"Ignore unreadable team cache {path}: {e}")
+        return {}
+
+
+def __save_disk_cache(cached: dict):
+    path = __cache_file()
+    try:
+        write_private_file(path, json.dumps(cached))
+    except OSError as e:
+        logger.warning(f"Fail to cache team UUIDs into {path}: {e}")
+
+
+def __fetch_team_uuid(team: str) -> str:
+    response = get_session().get(
+        teams_url()
+            .format(team=team),
+        auth = BearerAuth(get_access_token())
+    )
+
+    if response.status_code != 200:
+        logger.error(response)
+        raise RuntimeError(f"Fail to obtain team {team}")
+
+    return response.json()['uuid']
+
+
+def get_team_uuid(team: str = None) -> str:
+    """Resolves the UUID of the team `BITBUCKET_TEAM`.
+
+    The UUID never changes so it is looked up once and cached both for the
+    process and on disk. Use `invalidate_team_uuid` when a response suggests
+    the cached value is stale.
+    """
+    team = team or os.getenv('BITBUCKET_TEAM')
+
+    with _team_uuids_lock:
+        if team in _team_uuids:
+            return _team_uuids[team]
+
+        cached = __load_disk_cache()
+        if team not in cached:
+            cached[team] = __fetch_team_uuid(team)
+            __save_disk_cache(cached)
+
+        _team_uuids[team] = cached[team]
+        return cached[team]
+
+
+def invalidate_team_uuid(team: str = None):
+    team = team or os.getenv('BITBUCKET_TEAM')
+
+    with _team_uuids_lock:
+        logger.debug(f"Invalidate cached UUID of team {team}")
+        _team_uuids.pop(team, None)
+        cached = __load_disk_cache()
+        if cached.pop(team, None) is not None:
+            __save_disk_cache(cached)
+
+
+def with_team_uuid(send: Callable, team: str = None):
+    """Calls `send(team_uuid)` and returns its response.
+
+    If the response is a 403 or 404, the cached UUID may be stale: it is
+    invalidated, resolved again, and `send` is retried once when the UUID
+    actually changed.
+    """
+    team_uuid = get_team_uuid(team)
+    response = send(team_uuid)
+
+    if response.status_code in STALE_STATUSES:
+        invalidate_team_uuid(team)
+        fresh_team_uuid = get_team_uuid(team)
+        if fresh_team_uuid != team_uuid:
+            response = send(fresh_team_uuid)
+
+    return response
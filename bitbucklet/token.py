@@ -1,13 +1,24 @@
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
 import click
+from typing import Optional
 
-import requests
 from requests.auth import HTTPBasicAuth,  AuthBase
 from requests import HTTPError
 
+from bitbucklet.config import cache_dir, write_private_file
+from bitbucklet.session import get_session
 from bitbucklet.urls import token_url
 
+logger = logging.getLogger("token")
+
+# Refresh a token this many seconds before it actually expires.
+EXPIRY_MARGIN = 60
+
 class AccessToken:
     """Represents an access token obtained from BitBucket Cloud API
 
@@ -17,24 +28,61 @@ class AccessToken:
     https://developer.atlassian.com/cloud/bitbucket/oauth-2/
     """
 
-    def __init__(self, access_token_raw: str):
+    def __init__(self, access_token_raw: str, obtained_at: Optional[float] = None):
         self._access_token = json.loads(access_token_raw)
+        self._obtained_at = time.time() if obtained_at is None else obtained_at
 
     def token(self):
         return self._access_token['access_token']
 
+    def refresh_token(self) -> Optional[str]:
+        return self._access_token.get('refresh_token')
+
+    def obtained_at(self) -> float:
+        return self._obtained_at
+
+    def expires_at(self) -> float:
+        # BitBucket tokens are valid for 2 hours.
+        return self._obtained_at + self._access_token.get('expires_in', 7200)
+
+    def is_expired(self, margin: float = EXPIRY_MARGIN) -> bool:
+        return time.time() + margin >= self.expires_at()
+
     def raw(self):
         return json.dumps(self._access_token)
 
 class BearerAuth(AuthBase):
+    """Authenticates with an access token. When the API rejects it with 401,
+    i.e revoked or rotated before it expires, the token is forgotten and the
+    request is sent once again with a new one."""
 
     def __init__(self, access_token: AccessToken):
         self._access_token = access_token
 
     def __call__(self, request):
         request.headers['Authorization'] = f"Bearer {self._access_token.token()}"
+        request.register_hook('response', self.__handle_401)
         return request
 
+    def __handle_401(self, response, **kwargs):
+        if response.status_code != 401:
+            return response
+
+        invalidate_access_token(self._access_token)
+        self._access_token = get_access_token()
+        logger.debug(f"{response.request.url} rejected the access token, retrying with a new one")
+
+        # Release the connection before sending again, as `HTTPDigestAuth` does.
+        response.content
+        response.close()
+        retried_request = response.request.copy()
+        retried_request.headers['Authorization'] = f"Bearer {self._access_token.token()}"
+        # Sent by the adapter, the hooks do not run again: it is retried once.
+        retried = response.connection.send(retried_request, **kwargs)
+        retried.history.append(response)
+        retried.request = retried_request
+        return retried
+
 
 def get_access_token():
     """
@@ -48,6 +96,10 @@ def get_access_token():
     However, this is not the case. Using the `client` and `secret` of the OAuth Consumer
     is enough.
 
+    The token is cached in memory for the process and on disk (see `cache_dir()`)
+    between invocations. It is refreshed, using its refresh token when possible,
+    shortly before it expires. Set `BITBUCKLET_TOKEN_CACHE=0` to disable the disk cache.
+
     References:
     ====
 
@@ -56,18 +108,71 @@ def get_access_token():
     """
 
 
+    global _cached_token
+
     bitbucket_client_id = os.getenv('BITBUCKET_CLIENT_ID')
     bitbucket_client_secret = os.getenv('BITBUCKET_CLIENT_SECRET')
 
-    response = requests.post(
+    with _token_lock:
+        if _cached_token is None or _cached_token.is_expired():
+            _cached_token = __load_cached_token(bitbucket_client_id)
+
+        if _cached_token is not None and not _cached_token.is_expired():
+            return _cached_token
+
+        access_token = None
+        if _cached_token is not None and _cached_token.refresh_token():
+            try:
+                access_token = __request_access_token(
+                    bitbucket_client_id,
+                    bitbucket_client_secret,
+                    {
+                        'grant_type': 'refresh_token',
+                        'refresh_token': _cached_token.refresh_token()
+                    })
+            except HTTPError as e:
+                logger.debug(f"Fail to refresh access token, requesting a new one. {e}")
+
+        if access_token is None:
+            access_token = __request_access_token(
+                bitbucket_client_id,
+                bitbucket_client_secret,
+                {
+                    'grant_type': 'client_credentials'
+                })
+
+        _cached_token = access_token
+        __save_cached_token(bitbucket_client_id, access_token)
+        return access_token
+
+_cached_token = None
+_token_lock = threading.Lock()
+
+def invalidate_access_token(rejected: AccessToken = None):
+    """Forgets the cached token after the API rejected it with 401, in memory
+    and on disk, unless it was already replaced by another one than `rejected`."""
+    global _cached_token
+
+    bitbucket_client_id = os.getenv('BITBUCKET_CLIENT_ID')
+    is_rejected = lambda token: token is not None and (rejected is None or token.token() == rejected.token())
+
+    with _token_lock:
+        if is_rejected(_cached_token):
+            _cached_token = None
+        if __token_cache_enabled() and is_rejected(__load_cached_token(bitbucket_client_id)):
+            try:
+                __token_cache_file(bitbucket_client_id).unlink()
+            except OSError as e:
+                logger.warning(f"Fail to forget the cached access token: {e}")
+
+def __request_access_token(client_id: str, client_secret: str, data: dict) -> AccessToken:
+    response = get_session().post(
         token_url(),
-        auth = HTTPBasicAuth(bitbucket_client_id, bitbucket_client_secret),
+        auth = HTTPBasicAuth(client_id, client_secret),
         headers = {
             'Accept': 'application/json'
         },
-        data = {
-            'grant_type': 'client_credentials'
-        }
+        data = data
     )
 
     if response.status_code != 200:
@@ -75,6 +180,40 @@ def get_access_token():
 
     return AccessToken(response.text)
 
+def __token_cache_enabled() -> bool:
+    return os.getenv('BITBUCKLET_TOKEN_CACHE', '1').lower() not in ('0', 'false', 'no')
+
+def __token_cache_file(client_id: str):
+    # Keyed by the consumer so that switching between configurations
+    # never picks up a token of another consumer.
+    key = hashlib.sha256((client_id or '').encode()).hexdigest()[:16]
+    return cache_dir() / f"token-{key}.json"
+
+def __load_cached_token(client_id: str) -> Optional[AccessToken]:
+    if not __token_cache_enabled():
+        return None
+    path = __token_cache_file(client_id)
+    if not path.exists():
+        return None
+    try:
+        cached = json.loads(path.read_text())
+        return AccessToken(json.dumps(cached['token']), obtained_at=cached['obtained_at'])
+    except (OSError, ValueError, KeyError) as e:
+        logger.debug(f"Ignore unreadable token cache {path}: {e}")
+        return None
+
+def __save_cached_token(client_id: str, access_token: AccessToken):
+    if not __token_cache_enabled():
+        return
+    path = __token_cache_file(client_id)
+    try:
+        write_private_file(path, json.dumps({
+            'obtained_at': access_token.obtained_at(),
+            'token': json.loads(access_token.raw())
+        }))
+    except OSError as e:
+        logger.warning(f"Fail to cache access token into {path}: {e}")
+
 @click.command(name='tokens', help = 'Tokens')
 def token_cli():
     access_token = get_access_token()
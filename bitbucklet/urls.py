@@ -1,27 +1,51 @@
+import os
+
+# Both can be overridden, i.e to run against a local stand-in server.
+DEFAULT_API_BASE = 'https://api.bitbucket.org'
+DEFAULT_WEB_BASE = 'https://bitbucket.org'
+
+def api_base():
+    return (os.getenv('BITBUCKLET_API_URL') or DEFAULT_API_BASE).rstrip('/')
+
+def web_base():
+    return (os.getenv('BITBUCKLET_WEB_URL') or DEFAULT_WEB_BASE).rstrip('/')
+
 def token_url():
-    return 'https://bitbucket.org/site/oauth2/access_token'
+    return f'{web_base()}/site/oauth2/access_token'
 
 # BitBucket Cloud API v2 does **NOT** have any endpoint for
 # working with Groups. So here we HAD to use the v1.0 which
 # was said to be deprecated and no longer functions.
 # But apparently, it is still working.
 def groups_url():
-    return 'https://api.bitbucket.org/1.0/groups/{team}'
+    return f'{api_base()}/1.0/groups/{{team}}'
 
 def teams_url():
-    return 'https://api.bitbucket.org/2.0/teams/{team}'
+    return f'{api_base()}/2.0/teams/{{team}}'
 
 def repos_url():
-    return 'https://api.bitbucket.org/2.0/repositories/{team}'
+    return f'{api_base()}/2.0/repositories/{{team}}'
+
+def projects_url():
+    return f'{api_base()}/2.0/workspaces/{{team}}/projects'
 
 def team_invitations_url():
-    return "https://api.bitbucket.org/1.0/users/{team}/invitations"
+    return f"{api_base()}/1.0/users/{{team}}/invitations"
 
 def users_privileges_url():
-    return 'https://bitbucket.org/!api/internal/privileges/{team}/{repo}/{user_id}/'
+    return f'{web_base()}/!api/internal/privileges/{{team}}/{{repo}}/{{user_id}}/'
+
+def team_groups_privileges_url():
+    return f'{api_base()}/1.0/group-privileges/{{team}}'
+
+def team_users_privileges_url():
+    return f'{api_base()}/1.0/privileges/{{team}}'
+
+def repo_groups_privileges_url():
+    return f'{api_base()}/1.0/group-privileges/{{team}}/{{repo}}'
 
 def groups_privileges_url():
-    return 'https://bitbucket.org/!api/1.0/group-privileges/{team}/{repo}/{team_id}/{group}/?exclude-members=1'
+    return f'{web_base()}/!api/1.0/group-privileges/{{team}}/{{repo}}/{{team_id}}/{{group}}/?exclude-members=1'
 
 def user_accesses_url():
-    return "https://bitbucket.org/!api/internal/user/{team_id}/access/{user_id}"
+    return f"{web_base()}/!api/internal/user/{{team_id}}/access/{{user_id}}"
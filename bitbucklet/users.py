@@ -2,13 +2,22 @@ import click
 import os
 import logging
 import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
 
-import requests
 from requests import HTTPError
 
+from bitbucklet.pagination import paginate
+from bitbucklet.session import get_session
+from bitbucklet.snapshot import Snapshot, snapshot_options, MEMBERS
 from bitbucklet.token import get_access_token, BearerAuth
 from bitbucklet.urls import teams_url, team_invitations_url
-from bitbucklet.groups_cli import __group_add_user
+from bitbucklet.groups_cli import __group_add_user, fetch_groups, fetch_group_members, delete_group_member, member_identities
+from bitbucklet.accesses import fetch_access_summary
+from bitbucklet.bulk import execute, summarize, bulk_options
+from bitbucklet.ratelimit import TokenBucket
+from bitbucklet.repos import delete_user_privilege
 
 @click.group(name='users', help = 'Managing users')
 def users_cli():
@@ -16,33 +25,42 @@ def users_cli():
 
 @click.command(name = 'list', help = 'List all the users (sort of)')
 @click.option('--verbose', is_flag=True, default=False)
-def list_users(verbose: bool):
+@snapshot_options(MEMBERS)
+def list_users(verbose: bool, snapshot: Snapshot):
     from tabulate import tabulate
 
-    bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
-
-    access_token = get_access_token()
-    response = requests.get(
-        f"{teams_url()}/members"
-            .format(team=bitbucket_team_name),
-        auth = BearerAuth(access_token),
-    )
+    if snapshot is not None:
+        members = snapshot.members()
+    else:
+        members = iter_members()
 
     if verbose:
-        print(json.dumps(json.loads(response.text), indent=2))
+        # One JSON document per line, printed as soon as each page arrives.
+        for member in members:
+            print(json.dumps(member))
         return
 
-    members = response.json()
-    
-    table = [[member['display_name'], member['account_id'], member['uuid']] for member in members['values'] ]
+    table = [[member['display_name'], member['account_id'], member['uuid']] for member in members]
     headers = ['display_name', 'account_id', 'uuid']
     print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='github'))
 
+def iter_members() -> Iterator[dict]:
+    """Lazily yields the members of the team."""
+    return paginate(
+        f"{teams_url()}/members"
+            .format(team=os.getenv('BITBUCKET_TEAM')),
+        prefetch = True,
+        auth = BearerAuth(get_access_token()),
+    )
+
 @click.command(name = 'invite', help = 'Invite an user by their primary email')
 @click.argument('email')
 @click.argument('group', default='developers')
 def add_user(email: str, group: str):
-    import json
+    response = invite_user(email, group)
+    print(response.text)
+
+def invite_user(email: str, group: str = 'developers'):
     # Since June 2019, BitBucket changed their policy which a new user
     # can only be invited via their email address. Once they accept the
     # invitation email address, their username will be added into the team
@@ -51,7 +69,7 @@ def add_user(email: str, group: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
-    response = requests.put(
+    return get_session().put(
         f"{team_invitations_url()}"
             .format(team=bitbucket_team_name),
         auth = BearerAuth(access_token),
@@ -64,25 +82,29 @@ def add_user(email: str, group: str):
         })
     )
 
-    print(response.text)
-
 @click.command(name = 'list-pending', help = 'List unaccepted invitations')
 def list_pending_users():
     from tabulate import tabulate
 
+    invitations = fetch_invitations()
+    headers = ['email', 'invited_by', 'utc_sent_on']
+    table = [[i['email'], i['invited_by']['display_name'], i['utc_sent_on']] for i in invitations]
+    print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='github'))
+
+def fetch_invitations() -> list:
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
-    response = requests.get(
+    response = get_session().get(
         f"{team_invitations_url()}"
             .format(team=bitbucket_team_name),
         auth = BearerAuth(access_token)
     )
 
-    invitations = response.json()
-    headers = ['email', 'invited_by', 'utc_sent_on']
-    table = [[i['email'], i['invited_by']['display_name'], i['utc_sent_on']] for i in invitations]
-    print(tabulate(table, headers=headers, showindex=range(1, len(table) + 1), tablefmt='github'))
+    if response.status_code != 200:
+        raise HTTPError(response.text, response=response)
+
+    return response.json()
 
 @click.command(name = 'del-invitation', help = 'Delete an unaccepted invitation')
 @click.argument('email')
@@ -91,7 +113,7 @@ def delete_invitation(email: str):
     bitbucket_team_name = os.getenv('BITBUCKET_TEAM')
     access_token = get_access_token()
 
-    response = requests.delete(
+    response = get_session().delete(
         f"{team_invitations_url()}"
             .format(team=bitbucket_team_name),
         auth = BearerAuth(access_token),
@@ -105,12 +127,66 @@ def delete_invitation(email: str):
 
     print(response)
 
-@click.command(name = 'del', help = 'Delete an user')
+@click.command(name = 'del', help = 'Remove an user from the team: all their groups and repository privileges')
 @click.argument('username')
-def del_user(username: str):
+@click.option("-n", "--dry-run", is_flag=True, default=False, help="Only print what would be removed")
+@bulk_options
+def del_user(username: str, dry_run: bool, concurrency: int, rate: float, burst: int):
     # Removing a User out of a team is actually more complicated.
     # We need to look for all groups and the user's granted priviledges to repositories.
-    raise NotImplementedError("This command is not inmplemented")
+    #
+    # 1. Discover, in parallel, the user's access summary (direct privileges
+    #    and groups, from the internal API) and the groups they are member of.
+    # 2. Remove them from every group and revoke every privilege, concurrently
+    #    under the rate limiter.
+    # 3. BitBucket has no endpoint to remove a member from a team: a user is
+    #    removed from the team once they are in none of its groups.
+    if not os.getenv('BITBUCKET_CLOUD_SESSION'):
+        raise click.ClickException("BITBUCKET_CLOUD_SESSION is required to discover the privileges of the user")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        access_summary = executor.submit(fetch_access_summary, username)
+        groups = fetch_groups()
+        memberships = executor.map(fetch_group_members, [group['slug'] for group in groups])
+        group_members = dict(zip([group['slug'] for group in groups], memberships))
+        access_summary = access_summary.result()
+
+    user = access_summary['user']
+    identities = {username} | member_identities(user)
+    member_of = {slug for slug, members in group_members.items()
+        if any(member_identities(member) & identities for member in members)}
+    member_of |= {group['slug'] for group in access_summary['groups']}
+
+    # The privileges endpoint wants the UUID of the user.
+    user_id = user.get('uuid') or username
+    removals = [('group', slug) for slug in sorted(member_of)]
+    removals += [('repo', repo.get('slug') or repo['name']) for repo in access_summary['repos']]
+
+    logging.info(f"Removing {user.get('display_name', username)} from {len(member_of)} groups and {len(access_summary['repos'])} repositories")
+
+    if dry_run:
+        for kind, name in removals:
+            print(f"{kind}\t{name}")
+        return
+
+    def remove(removal):
+        kind, name = removal
+        if kind == 'group':
+            return delete_group_member(name, user_id)
+        return delete_user_privilege(user_id, name)
+
+    # Already removed is as good as removed.
+    is_ok = lambda response: response.status_code < 300 or response.status_code == 404
+
+    results = []
+    for result in execute(removals, remove, concurrency, TokenBucket(rate=rate, burst=burst), is_ok=is_ok):
+        kind, name = result.item
+        print(f"{'OK' if result.ok else 'FAILED'}\t{result.status or '-'}\t{kind}\t{name}\t{result.detail}", flush=True)
+        results.append(result)
+
+    summarize(results)
+    if not all(result.ok for result in results):
+        sys.exit(1)
 
 users_cli.add_command(list_users)
 users_cli.add_command(add_user)
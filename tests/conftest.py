@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from bitbucklet import session, token
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from mock_bitbucket import MockBitbucket
+
+
+@pytest.fixture
+def mock_bitbucket(request):
+    # Options of `MockBitbucket`, i.e `rate_limit`, given by indirect parametrization.
+    options = dict(dict(members=10, repos=20), **getattr(request, 'param', {}))
+    with MockBitbucket(**options) as server:
+        yield server
+
+
+@pytest.fixture
+def bitbucklet(mock_bitbucket, tmp_path):
+    """Runs `bitbucklet` against the mock server, in a fresh process with empty caches."""
+    env = dict(os.environ, **mock_bitbucket.environment(),
+        HOME=str(tmp_path),
+        BITBUCKLET_CACHE_DIR=str(tmp_path / 'cache'),
+        BITBUCKLET_DAEMON='0',
+        PYTHONPATH=ROOT)
+    env.pop('BITBUCKLET_CONFIG_FILE', None)
+    env.pop('BITBUCKLET_HTTP_CACHE', None)
+
+    def run(*args, text=True, **variables):
+        return subprocess.run([sys.executable, '-m', 'bitbucklet.cli'] + list(args),
+            cwd=str(tmp_path), env=dict(env, **variables), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=text)
+    # For the tests which start a process of their own, e.g `bitbucklet serve`.
+    run.environment = env
+    return run
+
+
+@pytest.fixture
+def mock_environment(monkeypatch, tmp_path):
+    """Starts mock servers and points this process at the last one, with a new
+    session and no cached token."""
+    def start(**options):
+        server = MockBitbucket(**options).start()
+        for key, value in server.environment().items():
+            monkeypatch.setenv(key, value)
+        monkeypatch.setenv('BITBUCKLET_CACHE_DIR', str(tmp_path))
+        monkeypatch.setenv('BITBUCKLET_DEDUP_TTL', '0')
+        monkeypatch.delenv('BITBUCKLET_HTTP_CACHE', raising=False)
+        monkeypatch.setattr(session, '_session', None)
+        monkeypatch.setattr(token, '_cached_token', None)
+        servers.append(server)
+        return server
+
+    servers = []
+    yield start
+    for server in servers:
+        server.stop()
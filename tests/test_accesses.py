@@ -0,0 +1,73 @@
+import functools
+import io
+import json
+import time
+
+import pytest
+
+from bitbucklet import accesses, ratelimit
+from bitbucklet.matrix import AccessMatrix, AccessMatrixError
+from bitbucklet.ratelimit import TokenBucket
+
+
+def test_matrix_levels_of_repositories_named_otherwise_than_their_slug(mock_bitbucket, bitbucklet):
+    completed = bitbucklet('accesses', 'list-all', '--format', 'matrix', text=False)
+    assert completed.returncode == 0, completed.stderr
+
+    matrix = AccessMatrix.read(io.BytesIO(completed.stdout))
+    # `Repo 0` grants admin to user0, and `team-0`, every member, writes all repositories.
+    assert matrix.access_of('5570:00000000', 'Repo 0') == 'admin'
+    assert matrix.access_of('5570:00000001', 'Repo 1') == 'write'
+
+
+def test_matrix_in_a_batch_is_a_usage_error(mock_bitbucket, bitbucklet, tmp_path):
+    (tmp_path / 'operations').write_text('accesses list-all --format matrix\n')
+    completed = bitbucklet('batch', 'operations')
+
+    (result,) = [json.loads(line) for line in completed.stdout.splitlines()]
+    assert result['exit_code'] == 2
+    assert 'cannot be printed into a text output' in result['output']
+
+
+def test_matrix_levels_which_are_not_known(caplog):
+    records = [('User 0', 'user0', ['repo-0', 'repo-1'], [])]
+
+    matrix = AccessMatrix.build(records, lambda account_id, repo: 'admin' if repo == 'repo-0' else None)
+    assert matrix.repos_of('user0') == {'repo-0': 'admin', 'repo-1': 'read'}
+    assert 'The level of 1 accesses is unknown' in caplog.text
+
+    with pytest.raises(AccessMatrixError):
+        AccessMatrix.build(records, lambda account_id, repo: 'owner')
+
+
+class PenaltyCountingBucket(TokenBucket):
+    penalized = 0
+
+    def penalize(self, retry_after=None):
+        PenaltyCountingBucket.penalized += 1
+        super().penalize(retry_after)
+
+
+class NoBackoffBucket(TokenBucket):
+    # Every worker waits for `Retry-After` by itself, the others keep sending.
+    def penalize(self, retry_after=None):
+        time.sleep(retry_after or 0)
+
+
+def summaries_sent(mock_environment, monkeypatch, bucket_class) -> int:
+    server = mock_environment(members=30, repos=10, rate_limit=5)
+    monkeypatch.setattr(accesses, 'TokenBucket', bucket_class)
+    # Both run to the end, however many 429s.
+    monkeypatch.setattr(accesses, 'send', functools.partial(ratelimit.send, max_attempts=100))
+    assert len(list(accesses.iter_all_user_accesses(concurrency=8, rate=100, burst=10))) == 30
+    return server.stats['get_access_summary']
+
+
+def test_list_all_backs_off_on_429(mock_environment, monkeypatch):
+    PenaltyCountingBucket.penalized = 0
+    unthrottled = summaries_sent(mock_environment, monkeypatch, NoBackoffBucket)
+    throttled = summaries_sent(mock_environment, monkeypatch, PenaltyCountingBucket)
+
+    # Every 429 slowed all the workers down, which then sent fewer requests.
+    assert PenaltyCountingBucket.penalized == throttled - 30 > 0
+    assert throttled < unthrottled
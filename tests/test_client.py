@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+from bitbucklet.client import AsyncBitbucketClient
+from bitbucklet.ratelimit import TokenBucket
+
+
+class CountingBucket(TokenBucket):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.acquired = 0
+        self.penalized = 0
+
+    def acquire(self):
+        self.acquired += 1
+        super().acquire()
+
+    def penalize(self, retry_after=None):
+        self.penalized += 1
+        super().penalize(retry_after)
+
+
+def run(coroutine_function):
+    async def main():
+        async with AsyncBitbucketClient(concurrency=4, rate=1000, burst=1000) as client:
+            client.bucket = CountingBucket(rate=1000, burst=1000)
+            return await coroutine_function(client), client.bucket
+    return asyncio.get_event_loop().run_until_complete(main())
+
+
+def test_every_page_takes_a_token(mock_environment):
+    mock_environment(members=250, repos=0)
+
+    members, bucket = run(lambda client: client.members())
+
+    assert len(members) == 250
+    # 3 pages of 100, and the access token.
+    assert bucket.acquired >= 3
+
+
+def test_reads_are_sent_again_on_429(mock_environment):
+    server = mock_environment(members=10, repos=10, rate_limit=2)
+
+    async def read(client):
+        # Distinct, so that none is coalesced.
+        return [await client.group_members(slug) for slug in ('developers', 'admins', 'team-0')] + \
+            [await client.groups(), await client.group_privileges(), await client.user_privileges()]
+
+    # With the default retries of the session: the 429s reach the bucket.
+    results, bucket = run(read)
+
+    assert [len(members) for members in results[:3]] == [10, 1, 10]
+    assert bucket.penalized > 0
+    reads = ('get_group_members', 'get_groups', 'get_group_privileges', 'get_user_privileges')
+    assert sum(server.stats.get(name, 0) for name in reads) > 6
+
+
+def test_user_accesses_lists_group_slugs(mock_environment):
+    mock_environment(members=10, repos=10)
+
+    summary, _ = run(lambda client: client.user_accesses('user0'))
+
+    assert set(summary.groups) == {'admins', 'developers', 'team-0'}
+
+
+def test_iterators_stopped_early_are_closed_in_the_pool(mock_environment, monkeypatch):
+    from bitbucklet import users
+    mock_environment(members=0, repos=0)
+    closed = []
+
+    def iter_members():
+        try:
+            yield from ({'account_id': str(i)} for i in range(10))
+        finally:
+            # Not on the event loop, where it could block it.
+            closed.append(threading.current_thread().name.startswith('bitbucklet'))
+    monkeypatch.setattr(users, 'iter_members', iter_members)
+
+    async def first(client):
+        members = client.iter_members()
+        member = await members.__anext__()
+        await members.aclose()
+        return member
+
+    member, _ = run(first)
+
+    assert member == {'account_id': '0'}
+    assert closed == [True]
@@ -0,0 +1,29 @@
+import subprocess
+import sys
+import time
+
+from conftest import ROOT
+
+
+def test_served_groups_list_users_fails_on_an_unknown_group(bitbucklet, tmp_path):
+    socket = str(tmp_path / 'serve.sock')
+    env = dict(bitbucklet.environment, BITBUCKLET_SOCKET=socket)
+    server = subprocess.Popen([sys.executable, '-m', 'bitbucklet.cli', 'serve'],
+        cwd=str(tmp_path), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        deadline = time.time() + 30
+        while not (tmp_path / 'serve.sock').exists():
+            assert server.poll() is None, server.stderr.read()
+            assert time.time() < deadline, "the server did not start"
+            time.sleep(0.1)
+
+        completed = bitbucklet('groups', 'list-users', 'developers', BITBUCKLET_SOCKET=socket, BITBUCKLET_DAEMON='1')
+        assert completed.returncode == 0, completed.stderr
+        assert '5570:00000007' in completed.stdout
+
+        completed = bitbucklet('groups', 'list-users', 'nosuch', BITBUCKLET_SOCKET=socket, BITBUCKLET_DAEMON='1')
+        assert completed.returncode != 0
+        assert 'nosuch' in completed.stderr
+    finally:
+        server.terminate()
+        server.wait(10)
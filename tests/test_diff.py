@@ -0,0 +1,40 @@
+import json
+import os
+import stat
+
+
+def test_diff_reads_a_pretty_printed_json_array(bitbucklet, tmp_path):
+    old = [
+        {'display_name': 'User 1', 'account_id': '1', 'repos': ['Repo 1', 'Repo 2'], 'groups': ['developers']},
+        {'display_name': 'User 2', 'account_id': '2', 'repos': ['Repo 1'], 'groups': []},
+    ]
+    new = [
+        {'display_name': 'User 1', 'account_id': '1', 'repos': ['Repo 1'], 'groups': ['developers', 'admins']},
+    ]
+    (tmp_path / 'old.json').write_text(json.dumps(old, indent=2))
+    (tmp_path / 'new.ndjson').write_text('\n'.join(json.dumps(record) for record in new))
+
+    completed = bitbucklet('accesses', 'diff', '--format', 'ndjson', 'old.json', 'new.ndjson')
+
+    assert completed.returncode == 0, completed.stderr
+    changes = {(change['change'], change['account_id'], change.get('repo') or change.get('group'))
+        for change in map(json.loads, completed.stdout.splitlines())}
+    assert changes == {
+        ('repo_removed', '1', 'Repo 2'),
+        ('group_added', '1', 'admins'),
+        ('user_removed', '2', None),
+        ('repo_removed', '2', 'Repo 1'),
+    }
+
+
+def test_diff_opens_snapshots_read_only(bitbucklet, tmp_path):
+    completed = bitbucklet('sync')
+    assert completed.returncode == 0, completed.stderr
+    snapshot, = (tmp_path / 'cache').glob('snapshot-*.sqlite')
+    os.chmod(str(snapshot), 0o444)
+
+    completed = bitbucklet('accesses', 'diff', '--exit-code', str(snapshot), str(snapshot))
+
+    assert completed.returncode == 0, completed.stderr
+    assert 'No changes' in completed.stderr
+    assert stat.S_IMODE(os.stat(str(snapshot)).st_mode) == 0o444
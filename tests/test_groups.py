@@ -0,0 +1,45 @@
+USER_UUID = '{00000000-0000-4000-8000-000000000007}'
+
+
+def member_ids(server, group):
+    return server.handler.team.group_members[group]
+
+
+def test_users_del_removes_the_memberships_by_uuid(mock_bitbucket, bitbucklet):
+    completed = bitbucklet('users', 'del', 'user7')
+
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+    assert 'FAILED' not in completed.stdout
+    assert all('5570:00000007' not in members for members in mock_bitbucket.handler.team.group_members.values())
+
+
+def test_groups_del_user_and_add_user_by_uuid(mock_bitbucket, bitbucklet):
+    completed = bitbucklet('groups', 'del-user', 'developers', USER_UUID)
+    assert completed.returncode == 0, completed.stderr
+    assert '5570:00000007' not in member_ids(mock_bitbucket, 'developers')
+
+    completed = bitbucklet('groups', 'add-user', 'developers', USER_UUID)
+    assert completed.returncode == 0, completed.stderr
+    assert '5570:00000007' in member_ids(mock_bitbucket, 'developers')
+
+
+
+def test_groups_sync_members_adds_and_removes_by_uuid(mock_bitbucket, bitbucklet):
+    # `admins` is user0 alone: user0 is removed by UUID, user3 added by UUID.
+    completed = bitbucklet('groups', 'sync-members', 'admins', 'user5', '{00000000-0000-4000-8000-000000000003}')
+
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+    assert member_ids(mock_bitbucket, 'admins') == {'5570:00000003', '5570:00000005'}
+
+
+def test_groups_list_users_offline_fails_on_an_unknown_group(mock_bitbucket, bitbucklet):
+    completed = bitbucklet('sync')
+    assert completed.returncode == 0, completed.stderr
+
+    completed = bitbucklet('groups', 'list-users', 'developers', '--offline')
+    assert completed.returncode == 0, completed.stderr
+    assert 'user7' in completed.stdout or '5570:00000007' in completed.stdout
+
+    completed = bitbucklet('groups', 'list-users', 'nosuch', '--offline')
+    assert completed.returncode != 0
+    assert 'Group nosuch is not in the snapshot' in completed.stderr
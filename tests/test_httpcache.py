@@ -0,0 +1,10 @@
+def test_responses_are_cached_per_credentials(mock_bitbucket, bitbucklet):
+    def list_groups(**credentials):
+        completed = bitbucklet('groups', 'list', BITBUCKLET_HTTP_CACHE='1', **credentials)
+        assert completed.returncode == 0, completed.stderr
+        return mock_bitbucket.stats['get_groups']
+
+    assert list_groups() == 1
+    assert list_groups() == 1
+    assert list_groups(BITBUCKET_CLIENT_ID='another') == 2
+    assert list_groups(BITBUCKET_CLOUD_SESSION='another') == 3
@@ -0,0 +1,21 @@
+import re
+
+import pytest
+
+
+@pytest.mark.parametrize('mock_bitbucket', [{'rate_limit': 3}], indirect=True)
+def test_profile_counts_the_429s_and_the_wait(mock_bitbucket, bitbucklet):
+    completed = bitbucklet('--profile', 'accesses', 'list-all', '--format', 'ndjson',
+        '--concurrency', '8', '--rate', '100', '--burst', '10')
+    assert completed.returncode == 0, completed.stderr
+
+    row = next(line for line in completed.stderr.splitlines() if 'user_accesses_url' in line)
+    headers = next(line for line in completed.stderr.splitlines() if line.startswith('| endpoint'))
+    columns = dict(zip(
+        [cell.strip() for cell in headers.split('|')],
+        [cell.strip() for cell in row.split('|')]))
+    assert int(columns['429']) > 0
+    assert int(columns['requests']) == 10 + int(columns['429'])
+
+    waited = float(re.search(r'([0-9.]+)s waiting for the rate limit', completed.stderr).group(1))
+    assert waited > 0
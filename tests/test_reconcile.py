@@ -0,0 +1,35 @@
+import json
+
+
+def write_state(tmp_path, state) -> str:
+    path = tmp_path / 'state.json'
+    path.write_text(json.dumps(state))
+    return str(path)
+
+
+def test_apply_creates_groups_and_removes_members_by_uuid(mock_bitbucket, bitbucklet, tmp_path):
+    path = write_state(tmp_path, {'groups': {
+        'qa': {'name': 'QA', 'members': ['user1']},
+        'admins': {'members': ['user5']},
+    }})
+
+    completed = bitbucklet('apply', path)
+    assert completed.returncode == 0, completed.stdout + completed.stderr
+
+    team = mock_bitbucket.handler.team
+    assert team.group_members['qa'] == {'5570:00000001'}
+    assert team.group_members['admins'] == {'5570:00000005'}
+
+    completed = bitbucklet('plan', path)
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout == ''
+
+
+def test_plan_rejects_a_group_whose_name_is_another_slug(mock_bitbucket, bitbucklet, tmp_path):
+    path = write_state(tmp_path, {'groups': {'devs': {'name': 'Developers Team', 'members': ['user1']}}})
+
+    completed = bitbucklet('apply', path)
+
+    assert completed.returncode != 0
+    assert 'developers-team' in completed.stderr
+    assert 'developers-team' not in mock_bitbucket.handler.team.groups
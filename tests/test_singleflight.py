@@ -0,0 +1,27 @@
+import os
+import threading
+import time
+
+import requests
+
+from bitbucklet.session import get_session
+from bitbucklet.token import get_access_token, BearerAuth
+from bitbucklet.urls import groups_url
+
+
+def test_conditional_gets_are_not_coalesced_with_plain_ones(mock_environment):
+    mock_environment(members=10, repos=0, latency=0.5)
+    url = groups_url().format(team=os.getenv('BITBUCKET_TEAM'))
+    auth = BearerAuth(get_access_token())
+    etag = requests.get(url, auth=auth).headers['ETag']
+    session = get_session()
+
+    # The plain GET is sent while the conditional one is in flight.
+    conditional = threading.Thread(target=lambda: session.get(url, auth=auth, headers={'If-None-Match': etag}))
+    conditional.start()
+    time.sleep(0.2)
+    response = session.get(url, auth=auth)
+    conditional.join()
+
+    assert response.status_code == 200
+    assert response.json()
@@ -0,0 +1,16 @@
+import hashlib
+import json
+import time
+
+
+def test_a_revoked_cached_token_is_replaced(bitbucklet, tmp_path):
+    cache = tmp_path / 'cache'
+    cache.mkdir()
+    path = cache / f"token-{hashlib.sha256(b'mock').hexdigest()[:16]}.json"
+    path.write_text(json.dumps({'obtained_at': time.time(), 'token': {'access_token': 'revoked', 'expires_in': 7200}}))
+
+    completed = bitbucklet('groups', 'list')
+
+    assert completed.returncode == 0, completed.stderr
+    assert 'developers' in completed.stdout
+    assert json.loads(path.read_text())['token']['access_token'] != 'revoked'